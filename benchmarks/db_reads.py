@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# Latency of SMSDatabase.get_one from several threads, on an idle database
+# and while a burst of status updates is being written.
+#   python benchmarks/db_reads.py [rows] [reader threads] [lookups per thread]
+import sys, os, time, tempfile, shutil, logging, random, Queue
+from threading import Thread, Event
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sgdatabase, sgmodem
+
+def fill(db, rows):
+    for i in range(1, rows + 1, 5000):
+        for j in range(i, min(i + 5000, rows + 1)):
+            db.put('id', 'sms', dict(id=j, request_status=sgmodem.DELIVERED, number='+15550100',
+                                     message='Benchmark {}'.format(j), segments=1, created_at=time.time()))
+        db.put('id', 'sms', dict(id=j), wait=True)
+
+def burst(db, rows, stopped, rate=5000):
+    # rate status updates a second, in chunks of 100
+    while not stopped.is_set():
+        for i in range(100):
+            db.put('id', 'sms', dict(id=random.randint(1, rows), request_status=sgmodem.ENROUTE,
+                                     status=0, reference=i % 256))
+        time.sleep(100.0 / rate)
+
+def lookups(db, rows, count, times):
+    for i in range(count):
+        start = time.time()
+        db.get_one(dict(id=random.randint(1, rows)), 'sms')
+        times.append(time.time() - start)
+
+def measure(db, rows, threads, count):
+    times = []
+    workers = [Thread(target=lookups, args=(db, rows, count, times)) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    times.sort()
+    return dict(per_sec=len(times) / elapsed, p50=times[len(times) // 2] * 1000,
+                p99=times[int(len(times) * 0.99)] * 1000, max=times[-1] * 1000)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = sgdatabase.SMSDatabase(url='sqlite:///' + os.path.join(tmpdir, 'database.db'))
+        db.start_thread(Queue.Queue())
+        fill(db, rows)
+        print('{} rows, {} reader threads, {} lookups each'.format(rows, threads, count))
+        result = measure(db, rows, threads, count)
+        print('idle:         {per_sec:.0f} lookups/s, p50 {p50:.2f}ms, p99 {p99:.2f}ms, max {max:.2f}ms'.format(**result))
+        stopped = Event()
+        writer = Thread(target=burst, args=(db, rows, stopped))
+        writer.start()
+        time.sleep(1)
+        result = measure(db, rows, threads, count)
+        stopped.set()
+        writer.join()
+        print('write burst:  {per_sec:.0f} lookups/s, p50 {p50:.2f}ms, p99 {p99:.2f}ms, max {max:.2f}ms'.format(**result))
+        db.put('id', 'sms', dict(id=1), wait=True)
+        db.stop_thread()
+        db.thread.join()
+    finally:
+        shutil.rmtree(tmpdir)
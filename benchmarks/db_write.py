@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# Compares SMS table write throughput of one upsert per PUT against the
+# group commit path of SMSDatabase.update_loop.
+#   python benchmarks/db_write.py [messages]
+import sys, os, time, tempfile, shutil, logging, Queue
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dataset
+import sgdatabase, sgmodem
+
+def updates(messages):
+    # every message is written three times: queued, enroute and its status report
+    for i in range(1, messages + 1):
+        yield dict(id=i, request_status=sgmodem.QUEUED, number='0', message='Benchmark {}'.format(i))
+    for i in range(1, messages + 1):
+        yield dict(id=i, request_status=sgmodem.ENROUTE)
+    for i in range(1, messages + 1):
+        yield dict(id=i, request_status=sgmodem.ENROUTE, status=0, reference=i % 256, deliveryStatus=0)
+
+def single_upserts(url, messages):
+    table = dataset.connect(url).get_table('sms')
+    str(table) # initialize the table the same way SMSDatabase.connect does
+    start = time.time()
+    for data in updates(messages):
+        table.upsert(data, ['id'])
+    return time.time() - start
+
+def group_commit(url, messages):
+    db = sgdatabase.SMSDatabase(url=url)
+    db.start_thread(Queue.Queue())
+    start = time.time()
+    for data in updates(messages):
+        db.put('id', 'sms', data)
+    db.put('id', 'sms', dict(id=messages), wait=True)
+    elapsed = time.time() - start
+    db.stop_thread()
+    db.thread.join()
+    return elapsed, db.stats
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    writes = messages * 3
+    tmpdir = tempfile.mkdtemp()
+    try:
+        before = single_upserts('sqlite:///' + os.path.join(tmpdir, 'single.db'), messages)
+        after, stats = group_commit('sqlite:///' + os.path.join(tmpdir, 'group.db'), messages)
+    finally:
+        shutil.rmtree(tmpdir)
+    print('{} writes for {} messages'.format(writes, messages))
+    print('single upserts: {:.2f}s {:.0f} writes/s'.format(before, writes / before))
+    print('group commit:   {:.2f}s {:.0f} writes/s ({batches} batches, {upserts} upserts)'.format(
+        after, writes / after, **stats))
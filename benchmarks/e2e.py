@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# End to end benchmark.  Starts sgserver against a temporary database with
+# simulated modems, or the loopback number when --modems is 0, and drives
+# /v1/sendsms and /v1/smsstatus at a fixed concurrency.  Reports latency per
+# endpoint, accepted messages per second, time from accept to ENROUTE (the
+# first status after QUEUED, which is DELIVERED for the loopback number), and
+# database write throughput, and writes them as JSON so runs
+# of different versions can be compared.
+#   python benchmarks/e2e.py [-n requests] [-c concurrency] [-m modems] [-o results.json]
+#   python benchmarks/e2e.py --replay requests.jsonl [--speed 2]
+#
+# A request log has one JSON object per line:
+#   {"t": secs since the first request, "method": "POST", "path": "/v1/sendsms", "body": {...}}
+# --record writes the generated requests in that format.
+import sys, os, time, json, tempfile, shutil, subprocess, socket, signal, getopt, random, re, urllib2
+from tornado import gen, ioloop
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+import sgsimulator
+
+port = 18890
+base = 'http://localhost:{}'.format(port)
+QUEUED = -1
+
+def start_server(tmpdir, com, interval):
+    server = subprocess.Popen([sys.executable, os.path.join(root, 'sgserver.py'),
+                            '-d', os.path.join(tmpdir, 'database.db'), '-l', tmpdir,
+                            '-p', str(port), '-c', com, '-t', str(interval)],
+                            cwd=tmpdir, stdout=open(os.devnull, 'w'), preexec_fn=os.setsid)
+    for i in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.kill()
+    raise Exception('Server did not start')
+
+def start_modems(tmpdir, count, report_delay):
+    simulators = []
+    for i in range(count):
+        simulator = sgsimulator.ModemSimulator(os.path.join(tmpdir, 'modem{}'.format(i)), report_delay=report_delay)
+        simulator.open()
+        simulator.start()
+        simulators.append(simulator)
+    return simulators
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return dict(count=0)
+    def rank(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+    return dict(count=len(values), mean=sum(values) / len(values), p50=rank(0.50),
+                p95=rank(0.95), p99=rank(0.99), max=values[-1])
+
+def scrape(name):
+    # sum of the samples of one metric from /metrics
+    text = urllib2.urlopen(base + '/metrics').read()
+    pattern = re.compile(r'^smsgateway_{}(\{{[^}}]*\}})? (\S+)$'.format(name), re.M)
+    return sum(float(value) for labels, value in pattern.findall(text))
+
+def generate(requests, status_ratio, number):
+    # the send requests, with a status check of an earlier message in between
+    for i in range(requests):
+        yield dict(t=0, method='POST', path='/v1/sendsms',
+                   body={'key': '', 'number': number, 'message': 'Benchmark {}'.format(i)})
+        if random.random() < status_ratio:
+            yield dict(t=0, method='GET', path='/v1/smsstatus/{reference}')
+
+def endpoint(path):
+    return re.sub(r'/[0-9]+$', '/<id>', path.split('?')[0])
+
+class Benchmark(object):
+    def __init__(self, concurrency, speed):
+        self.concurrency = concurrency
+        self.speed = speed
+        self.latencies = {} # endpoint -> secs per request
+        self.errors = {}
+        self.accepted_at = {} # reference -> time
+        self.progressed_at = {} # reference -> time of the first status after QUEUED
+        self.client = AsyncHTTPClient(max_clients=concurrency + 1)
+
+    def on_event(self, chunk, buffer=[]):
+        # Server-Sent Events arrive in arbitrary chunks
+        buffer.append(chunk)
+        events = ''.join(buffer).split('\n\n')
+        buffer[:] = [events.pop()]
+        now = time.time()
+        for event in events:
+            for line in event.split('\n'):
+                if line.startswith('data: '):
+                    data = json.loads(line[6:])
+                    if int(data['status']) != QUEUED:
+                        self.progressed_at.setdefault(int(data['reference']), now)
+
+    def follow(self):
+        request = HTTPRequest(base + '/v1/smsstatus/stream', headers={'Accept': 'text/event-stream'},
+                              streaming_callback=self.on_event, request_timeout=3600)
+        self.client.fetch(request, raise_error=False)
+
+    @gen.coroutine
+    def send(self, item):
+        path = item['path']
+        if '{reference}' in path:
+            if not self.accepted_at:
+                return
+            path = path.format(reference=random.choice(list(self.accepted_at)))
+        body = json.dumps(item['body']) if item.get('body') is not None else None
+        request = HTTPRequest(base + path, method=item['method'], body=body,
+                              headers={'Content-Type': 'application/json'}, request_timeout=60)
+        name = endpoint(path)
+        start = time.time()
+        try:
+            response = yield self.client.fetch(request)
+        except HTTPError as e:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return
+        now = time.time()
+        self.latencies.setdefault(name, []).append(now - start)
+        if name == '/v1/sendsms':
+            reference = int(json.loads(response.body)['data']['reference'])
+            if reference > 0:
+                self.accepted_at[reference] = now
+        elif name == '/v1/sendsms/batch':
+            for message in json.loads(response.body)['data']['messages']:
+                if int(message['reference']) > 0:
+                    self.accepted_at[int(message['reference'])] = now
+
+    @gen.coroutine
+    def worker(self, items, start):
+        for item in items:
+            if self.speed:
+                # keep to the timing of a replayed log
+                delay = start + item['t'] / self.speed - time.time()
+                if delay > 0:
+                    yield gen.sleep(delay)
+            yield self.send(item)
+
+    @gen.coroutine
+    def run(self, items, drain):
+        self.follow()
+        yield gen.sleep(0.5)
+        items = iter(items)
+        start = time.time()
+        yield [self.worker(items, start) for i in range(self.concurrency)]
+        self.duration = time.time() - start
+        # wait for the accepted messages to be picked up by a modem
+        deadline = time.time() + drain
+        while len(self.progressed_at) < len(self.accepted_at) and time.time() < deadline:
+            yield gen.sleep(0.1)
+
+def usage():
+    print('\
+        -n --requests <count> : /v1/sendsms requests to make, 2000 by default\n\
+        -c --concurrency <count> : requests in flight at once, 10 by default\n\
+        -m --modems <count> : simulated modems, 0 sends to the loopback number instead, 1 by default\n\
+        -s --status-ratio <fraction> : /v1/smsstatus requests per send, 1 by default\n\
+        -t --interval <secs> : minimum send interval of the modems, 0 by default\n\
+        -d --drain <secs> : how long to wait for accepted messages to be sent, 60 by default\n\
+        -o --output <file> : write the results as JSON to file\n\
+        --report-delay <secs> : delivery report delay of the simulated modems\n\
+        --replay <file> : replay a JSONL request log instead of generating requests\n\
+        --speed <factor> : replay faster or slower than logged, 0 for as fast as possible\n\
+        --record <file> : write the generated requests as a JSONL request log')
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:c:m:s:t:d:o:', ['help', 'requests=', 'concurrency=',
+            'modems=', 'status-ratio=', 'interval=', 'drain=', 'output=', 'report-delay=',
+            'replay=', 'speed=', 'record='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    config = dict(requests=2000, concurrency=10, modems=1, status_ratio=1.0, interval=0, drain=60,
+                  report_delay=1.0, replay=None, speed=0)
+    output = record = None
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-o', '--output'):
+            output = arg
+        elif opt == '--record':
+            record = arg
+        elif opt == '--replay':
+            config['replay'] = arg
+            config['speed'] = config['speed'] or 1
+        else:
+            name = opt.lstrip('-').replace('-', '_')
+            name = dict(n='requests', c='concurrency', m='modems', s='status_ratio', t='interval', d='drain').get(name, name)
+            config[name] = type(config[name])(arg) if config[name] is not None else arg
+
+    random.seed(1)
+    number = '+15550100' if config['modems'] else '0'
+    if config['replay']:
+        items = [json.loads(line) for line in open(config['replay']) if line.strip()]
+        config['speed'] = float(config['speed'])
+    else:
+        items = list(generate(config['requests'], config['status_ratio'], number))
+        config['speed'] = 0
+    if record:
+        with open(record, 'w') as f:
+            for item in items:
+                f.write(json.dumps(item) + '\n')
+
+    tmpdir = tempfile.mkdtemp()
+    simulators = start_modems(tmpdir, config['modems'], config['report_delay'])
+    com = ','.join(simulator.link for simulator in simulators) or 'nonexistent'
+    server = start_server(tmpdir, com, config['interval'])
+    try:
+        start = time.time()
+        writes, upserts = scrape('db_writes_total'), scrape('db_upserts_total')
+        benchmark = Benchmark(config['concurrency'], config['speed'])
+        ioloop.IOLoop.current().run_sync(lambda: benchmark.run(items, config['drain']))
+        writes, upserts = scrape('db_writes_total') - writes, scrape('db_upserts_total') - upserts
+        db_duration = time.time() - start
+    finally:
+        # Ctrl-C the whole process group like a terminal would, so the server
+        # shuts down its modem process and database thread
+        os.killpg(server.pid, signal.SIGINT)
+        server.wait()
+        for simulator in simulators:
+            simulator.stop()
+        shutil.rmtree(tmpdir)
+
+    accepted = len(benchmark.accepted_at)
+    results = dict(
+        version=subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=root).strip(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        config=config,
+        duration=benchmark.duration,
+        accepted=accepted,
+        accepted_per_sec=accepted / benchmark.duration,
+        endpoints=dict((name, dict(percentiles(values), errors=benchmark.errors.get(name, 0)))
+                       for name, values in benchmark.latencies.items()),
+        accept_to_enroute=dict(percentiles([benchmark.progressed_at[r] - t for r, t in benchmark.accepted_at.items()
+                                         if r in benchmark.progressed_at]),
+                            missing=accepted - len(benchmark.progressed_at)),
+        db=dict(writes=writes, upserts=upserts, writes_per_sec=writes / db_duration, upserts_per_sec=upserts / db_duration),
+    )
+    print('{accepted} messages accepted in {duration:.2f}s, {accepted_per_sec:.0f}/s'.format(**results))
+    for name, stats in sorted(results['endpoints'].items()):
+        print('{:<24} {count:>6} requests  p50 {p50:.4f}s  p95 {p95:.4f}s  p99 {p99:.4f}s  {errors} errors'.format(name, **stats))
+    sent = results['accept_to_enroute']
+    if sent['count']:
+        print('accept to enroute       {count:>6} messages  p50 {p50:.4f}s  p95 {p95:.4f}s  p99 {p99:.4f}s  {missing} not sent'.format(**sent))
+    print('database                {writes:.0f} writes as {upserts:.0f} upserts, {writes_per_sec:.0f} writes/s'.format(**results['db']))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
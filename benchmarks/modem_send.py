@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Messages per second one ModemServer submits to a simulated modem, and the
+# time until every one is ENROUTE and DELIVERED.  The modem answers each AT
+# command after --latency secs and each message part after --send-latency
+# more, so the time the gateway itself adds between sends shows as the gap
+# to what the modem alone allows.  With --receive-every the modem also
+# receives messages meanwhile, which are read into an inbox, to see what
+# reading them costs the sends.
+#   python benchmarks/modem_send.py [-n messages] [--latency secs] [--send-latency secs] [--report-delay secs]
+#                                   [--receive-every secs] [--receive-parts count]
+import sys, os, time, tempfile, shutil, getopt, logging, multiprocessing, Queue
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+import sgmodem, sgsimulator, sgdatabase, sginbox
+
+def run(count, long_every, simulator_options, timeout):
+    tmpdir = tempfile.mkdtemp()
+    simulator = sgsimulator.ModemSimulator(os.path.join(tmpdir, 'modem'), **simulator_options)
+    path = simulator.open()
+    simulator.start()
+    inbox = None
+    if simulator_options.get('receive_every'):
+        # the inbox table as the server has it
+        database = sgdatabase.SMSDatabase(url='sqlite:///' + os.path.join(tmpdir, 'database.db'))
+        database.connect()
+        database.db.close()
+        inbox = sginbox.Inbox(database.path)
+    input_queue, output_queue, exit_event = multiprocessing.Queue(), multiprocessing.Queue(), multiprocessing.Event()
+    modem = sgmodem.ModemServer(input_queue, output_queue, exit_event, path, inbox=inbox,
+                                logConfig=dict(filename=os.path.join(tmpdir, 'modem.log')))
+    modem.start()
+    try:
+        while modem.stats.state.value == sgmodem.CONNECTING:
+            time.sleep(0.05)
+        if modem.stats.state.value != sgmodem.CONNECTED:
+            raise Exception('Modem did not connect, see ' + os.path.join(tmpdir, 'modem.log'))
+        messages = []
+        for i in range(1, count + 1):
+            # every long_every-th message takes 3 parts
+            text = 'Benchmark {} '.format(i) * (40 if long_every and i % long_every == 0 else 1)
+            messages.append(sgmodem.make_message('+15550100', text, i, segments=1 + len(text) // 153))
+        start = time.time()
+        input_queue.put(messages)
+        enroute, delivered, failed = {}, {}, 0
+        deadline = start + timeout
+        while len(delivered) + failed < count and time.time() < deadline:
+            try:
+                action, (key, table, data) = output_queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if action != sgdatabase.PUT:
+                continue
+            status = data.get('request_status')
+            if status == sgmodem.ENROUTE:
+                enroute.setdefault(data['id'], time.time() - start)
+            elif status == sgmodem.DELIVERED:
+                delivered.setdefault(data['id'], time.time() - start)
+            elif status in sgmodem.FINAL_STATUSES:
+                failed += 1
+        return dict(messages=count, parts=simulator.stats['parts'], enroute=len(enroute),
+                    delivered=len(delivered), failed=failed,
+                    enroute_secs=max(enroute.values()) if enroute else 0,
+                    delivered_secs=max(delivered.values()) if delivered else 0,
+                    send_time=modem.stats.send_time.sum / (modem.stats.send_time.count or 1),
+                    received=modem.stats.received.value)
+    finally:
+        exit_event.set()
+        input_queue.put(None)
+        modem.join(30)
+        if modem.is_alive():
+            modem.terminate()
+        simulator.stop()
+        shutil.rmtree(tmpdir)
+
+def usage():
+    print('\
+        -n --messages <count> : messages to send, 300 by default\n\
+        -l --long-every <count> : make every count-th message 3 parts long, 10 by default, 0 for none\n\
+        --latency <secs> : delay of the simulated modem before answering each AT command, 0.005 by default\n\
+        --send-latency <secs> : extra delay before it answers each message part, 0.01 by default\n\
+        --report-delay <secs> : time from sending to the delivery report, 0.2 by default\n\
+        --receive-every <secs> : have the modem receive a message this often and read them into an inbox\n\
+        --receive-parts <count> : parts of each message received, 1 by default\n\
+        --timeout <secs> : give up waiting for the delivery reports after this, 120 by default')
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:l:', ['help', 'messages=', 'long-every=', 'latency=',
+                                                          'send-latency=', 'report-delay=', 'receive-every=',
+                                                          'receive-parts=', 'timeout='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    logging.basicConfig(level=logging.WARNING)
+    count, long_every, timeout = 300, 10, 120
+    options = dict(latency=0.005, send_latency=0.01, report_delay=0.2)
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-n', '--messages'):
+            count = int(arg)
+        elif opt in ('-l', '--long-every'):
+            long_every = int(arg)
+        elif opt == '--timeout':
+            timeout = float(arg)
+        elif opt == '--receive-parts':
+            options['receive_parts'] = int(arg)
+        else:
+            options[opt[2:].replace('-', '_')] = float(arg)
+
+    result = run(count, long_every, options, timeout)
+    print('{messages} messages as {parts} parts: all ENROUTE after {enroute_secs:.2f}s '
+          '({0:.1f}/s), DELIVERED after {delivered_secs:.2f}s, {enroute} enroute, {delivered} delivered, '
+          '{failed} failed, {send_time:.4f}s average send, {received} received'.format(
+              result['enroute'] / (result['enroute_secs'] or 1), **result))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# Measures outbox write, claim/ack and startup recovery speed with a large
+# number of queued messages.
+#   python benchmarks/outbox.py [queued messages]
+import sys, os, time, tempfile, shutil
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sgoutbox, sgmodem
+
+def rate(count, secs):
+    return '{:.2f}s {:.0f}/s'.format(secs, count / secs)
+
+if __name__ == '__main__':
+    queued = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    singles = 2000
+    tmpdir = tempfile.mkdtemp()
+    try:
+        outbox = sgoutbox.Outbox(os.path.join(tmpdir, 'outbox.db'))
+
+        # one transaction per message, like /v1/sendsms
+        start = time.time()
+        for i in range(1, singles + 1):
+            outbox.add([sgmodem.make_message('1234', u'Single {}'.format(i), i)])
+        single_time = time.time() - start
+
+        # 1000 messages per transaction, like /v1/sendsms/batch
+        start = time.time()
+        for first in range(singles + 1, queued + 1, 1000):
+            outbox.add([sgmodem.make_message('1234', u'Batch {}'.format(i), i)
+                        for i in range(first, min(first + 1000, queued + 1))])
+        batch_time = time.time() - start
+
+        # a crash left some messages claimed
+        for i in range(1, 101):
+            outbox.claim(i)
+        start = time.time()
+        pending, interrupted = sgoutbox.Outbox(outbox.path).recover()
+        recover_time = time.time() - start
+
+        # what every modem does per message it sends
+        start = time.time()
+        for message in pending[:singles]:
+            outbox.claim(message[2])
+            outbox.ack(message[2])
+        claim_time = time.time() - start
+    finally:
+        shutil.rmtree(tmpdir)
+    print('{} queued messages'.format(queued))
+    print('add, one per transaction:    ' + rate(singles, single_time))
+    print('add, 1000 per transaction:   ' + rate(queued - singles, batch_time))
+    print('recover {} pending, {} interrupted: {:.2f}s'.format(len(pending), len(interrupted), recover_time))
+    print('claim and ack:               ' + rate(singles, claim_time))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Compares accepted messages per second of N single /v1/sendsms posts
+# against the same messages sent through /v1/sendsms/batch.
+#   python benchmarks/sendsms_batch.py [messages] [batch size]
+import sys, os, time, json, tempfile, shutil, subprocess, httplib, socket, signal
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+port = 18888
+
+def start_server(tmpdir):
+    # an unknown com port keeps the modem disconnected so only the web and db tiers are measured
+    server = subprocess.Popen([sys.executable, os.path.join(root, 'sgserver.py'),
+                            '-d', os.path.join(tmpdir, 'database.db'), '-l', tmpdir,
+                            '-p', str(port), '-c', 'nonexistent', '-t', '0'],
+                            cwd=tmpdir, stdout=open(os.devnull, 'w'), preexec_fn=os.setsid)
+    for i in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.kill()
+    raise Exception('Server did not start')
+
+def post(conn, path, body):
+    conn.request('POST', path, json.dumps(body), {'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    return json.loads(response.read())
+
+def single(conn, messages):
+    start = time.time()
+    for i in range(messages):
+        post(conn, '/v1/sendsms', {'key': '', 'number': '1234', 'message': 'Single {}'.format(i)})
+    return time.time() - start
+
+def batch(conn, messages, size):
+    start = time.time()
+    for first in range(0, messages, size):
+        items = [{'number': '1234', 'message': 'Batch {}'.format(i)}
+                 for i in range(first, min(first + size, messages))]
+        post(conn, '/v1/sendsms/batch', {'key': '', 'messages': items})
+    return time.time() - start
+
+if __name__ == '__main__':
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    tmpdir = tempfile.mkdtemp()
+    server = start_server(tmpdir)
+    try:
+        conn = httplib.HTTPConnection('localhost', port)
+        single_time = single(conn, messages)
+        batch_time = batch(conn, messages, size)
+    finally:
+        # Ctrl-C the whole process group like a terminal would, so the server
+        # shuts down its modem process and database thread
+        os.killpg(server.pid, signal.SIGINT)
+        server.wait()
+        shutil.rmtree(tmpdir)
+    print('{} messages'.format(messages))
+    print('single posts:       {:.2f}s {:.0f} msgs/s'.format(single_time, messages / single_time))
+    print('batches of {:<6}   {:.2f}s {:.0f} msgs/s'.format(size, batch_time, messages / batch_time))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# Time to fetch a page of GET /v1/sms at increasing depth, keyset paginated
+# as sgdatabase.list_sms does against the same query with LIMIT/OFFSET.
+#   python benchmarks/sms_listing.py [rows] [page size]
+import sys, os, time, tempfile, shutil, logging
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sgdatabase, sgmodem
+
+REPEAT = 20
+
+def fill(db, rows, start_time):
+    # every seventh message failed, numbers repeat every 5000 messages
+    batch = []
+    for i in range(1, rows + 1):
+        batch.append(('id', 'sms', dict(id=i, request_status=sgmodem.FAILED if i % 7 == 0 else sgmodem.DELIVERED,
+                                        number='+1555{:07d}'.format(i % 5000), message='Benchmark {}'.format(i),
+                                        segments=1, created_at=start_time + i * 0.001), None, True))
+        if len(batch) == 5000:
+            db.write_batch(batch)
+            batch = []
+    db.write_batch(batch)
+
+def keyset(db, depth, limit, statuses):
+    # walk to the page by its cursor, as a client following cursors would arrive there
+    where = ' WHERE request_status IN ({})'.format(','.join(str(s) for s in statuses)) if statuses else ''
+    row = db.execute('SELECT created_at, id FROM sms{} ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?'.format(where),
+                     (depth - 1,)).fetchone() if depth else None
+    after = (row['created_at'], row['id']) if row else None
+    start = time.time()
+    for i in range(REPEAT):
+        sgdatabase.list_sms(db, statuses=statuses, after=after, limit=limit)
+    return (time.time() - start) / REPEAT
+
+def offset(db, depth, limit, statuses):
+    where = ' WHERE request_status IN ({})'.format(','.join(str(s) for s in statuses)) if statuses else ''
+    sql = ('SELECT id, request_status, number, message, segments, created_at FROM sms{} '
+           'ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?').format(where)
+    start = time.time()
+    for i in range(REPEAT):
+        db.execute(sql, (limit, depth)).fetchall()
+    return (time.time() - start) / REPEAT
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else sgdatabase.PAGE_SIZE
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = sgdatabase.SMSDatabase(url='sqlite:///' + os.path.join(tmpdir, 'database.db'))
+        db.connect()
+        fill(db, rows, time.time())
+        print('{} rows, pages of {}'.format(rows, limit))
+        print('{:<12} {:>10} {:>12} {:>12}'.format('filter', 'depth', 'keyset', 'offset'))
+        for name, statuses in (('all', None), ('failed', [sgmodem.FAILED])):
+            total = rows if statuses is None else rows // 7
+            for depth in (0, total // 100, total // 2, total - limit):
+                print('{:<12} {:>10} {:>10.3f}ms {:>10.3f}ms'.format(name, depth,
+                    keyset(db.db, depth, limit, statuses) * 1000, offset(db.db, depth, limit, statuses) * 1000))
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Compares the declared SQLite schema and INSERT ... ON CONFLICT upserts of
+# SMSDatabase against the dataset layer it replaced, on the writes a message
+# goes through and on the lookups made by status, reference, number and
+# creation time.  Both write in transactions of the same batch size.
+#   python benchmarks/sqlite_store.py [rows] [batch size]
+import sys, os, time, tempfile, shutil, logging, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dataset
+import sgdatabase, sgmodem
+
+LOOKUPS = 1000
+
+def phases(rows, start_time):
+    # intake, ENROUTE from the modem, then the status report
+    yield 'insert', True, (dict(id=i, request_status=sgmodem.QUEUED, number='+1555{:07d}'.format(i % 5000),
+                                message='Benchmark {}'.format(i), encoding='gsm0338', segments=1,
+                                idempotency_key='key{}'.format(i), created_at=start_time + i * 0.001)
+                           for i in range(1, rows + 1))
+    yield 'enroute', False, (dict(id=i, request_status=sgmodem.ENROUTE, reference=i % 256)
+                             for i in range(1, rows + 1))
+    yield 'report', False, (dict(id=i, request_status=sgmodem.DELIVERED, status=0, reference=i % 256,
+                                 deliveryStatus=0) for i in range(1, rows + 1))
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def queries(rows, start_time):
+    # (name, search) pairs of the lookups to time
+    random.seed(1)
+    ids = [random.randint(1, rows) for i in range(LOOKUPS)]
+    return [
+        ('id', [dict(id=i) for i in ids]),
+        ('idempotency_key', [dict(idempotency_key='key{}'.format(i)) for i in ids]),
+        ('reference', [dict(reference=i % 256, number='+1555{:07d}'.format(i % 5000)) for i in ids[:100]]),
+        ('number', [dict(number='+1555{:07d}'.format(i % 5000)) for i in ids[:100]]),
+        ('request_status', [dict(request_status=sgmodem.DELIVERED)] * 3),
+    ]
+
+def run_dataset(url, rows, batch_size, start_time):
+    # the SMSDatabase.write_row of the dataset version: an update, then an
+    # insert if no row was updated, or a reflected upsert
+    db = dataset.connect(url)
+    table = db.get_table('sms')
+    str(table)
+    table.create_column('idempotency_key', db.types.string(255))
+    table.create_index(['idempotency_key'])
+    timings = []
+    for name, new, items in phases(rows, start_time):
+        start = time.time()
+        for batch in batches(items, batch_size):
+            db.begin()
+            for data in batch:
+                if new:
+                    kept = dict((k, v) for k, v in data.items() if k != 'request_status')
+                    if not table.update(kept, ['id'], return_count=True):
+                        table.insert(data)
+                else:
+                    table.upsert(data, ['id'])
+            db.commit()
+        timings.append((name, time.time() - start))
+    for name, searches in queries(rows, start_time):
+        start = time.time()
+        for search in searches:
+            list(table.find(**search))
+        timings.append(('find by ' + name, (time.time() - start) / len(searches)))
+    start = time.time()
+    list(table.find(table.table.c.created_at >= start_time + rows * 0.001 - 1))
+    timings.append(('find by created_at', time.time() - start))
+    return timings
+
+def run_sqlite(url, rows, batch_size, start_time):
+    db = sgdatabase.SMSDatabase(url=url)
+    db.connect()
+    timings = []
+    for name, new, items in phases(rows, start_time):
+        start = time.time()
+        for batch in batches(items, batch_size):
+            db.write_batch([('id', 'sms', data, None, new) for data in batch])
+        timings.append((name, time.time() - start))
+    for name, searches in queries(rows, start_time):
+        start = time.time()
+        for search in searches:
+            db.find('sms', search)
+        timings.append(('find by ' + name, (time.time() - start) / len(searches)))
+    start = time.time()
+    db.db.execute('SELECT * FROM sms WHERE created_at >= ?', (start_time + rows * 0.001 - 1,)).fetchall()
+    timings.append(('find by created_at', time.time() - start))
+    return timings
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    start_time = time.time()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        before = run_dataset('sqlite:///' + os.path.join(tmpdir, 'dataset.db'), rows, batch_size, start_time)
+        after = run_sqlite('sqlite:///' + os.path.join(tmpdir, 'sqlite.db'), rows, batch_size, start_time)
+    finally:
+        shutil.rmtree(tmpdir)
+    print('{} rows in transactions of {}'.format(rows, batch_size))
+    print('{:<24} {:>14} {:>14} {:>8}'.format('', 'dataset', 'sqlite', 'speedup'))
+    for (name, old), (_, new) in zip(before, after):
+        if name.startswith('find'):
+            print('{:<24} {:>12.3f}ms {:>12.3f}ms {:>7.1f}x'.format(name, old * 1000, new * 1000, old / new))
+        else:
+            print('{:<24} {:>10.0f} rows/s {:>7.0f} rows/s {:>7.1f}x'.format(name, rows / old, rows / new, old / new))
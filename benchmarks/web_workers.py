@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Accepted /v1/sendsms requests per second for an increasing number of web
+# worker processes (sgserver.py -w).  Load comes from several client
+# processes so the client is not what runs out of CPU first; the gain from
+# more workers is bounded by the cores of the machine.
+#   python benchmarks/web_workers.py [-n requests] [-c concurrency] [-p client processes] [-w 1,2,4]
+import sys, os, time, json, tempfile, shutil, subprocess, socket, signal, getopt, multiprocessing
+from tornado import gen, ioloop
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+port = 18891
+base = 'http://localhost:{}'.format(port)
+
+def start_server(tmpdir, workers):
+    server = subprocess.Popen([sys.executable, os.path.join(root, 'sgserver.py'),
+                            '-d', os.path.join(tmpdir, 'database.db'), '-l', tmpdir,
+                            '-p', str(port), '-c', 'nonexistent', '-w', str(workers)],
+                            cwd=tmpdir, stdout=open(os.devnull, 'w'), preexec_fn=os.setsid)
+    for i in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.kill()
+    raise Exception('Server did not start')
+
+def stop_server(server, timeout=30):
+    # Ctrl-C the process group.  The messages left for the missing modem can
+    # keep the server from exiting, so it is killed if it takes too long.
+    os.killpg(server.pid, signal.SIGINT)
+    deadline = time.time() + timeout
+    while server.poll() is None and time.time() < deadline:
+        time.sleep(0.5)
+    if server.poll() is None:
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
+
+def client(requests, concurrency, results):
+    # one client process, puts (accepted, errors, references) on results
+    accepted, errors, references, last_error = [0], [0], [], [None]
+    http = AsyncHTTPClient(max_clients=concurrency)
+    remaining = iter(range(requests))
+
+    @gen.coroutine
+    def worker():
+        for i in remaining:
+            body = json.dumps({'key': '', 'number': '+15550100', 'message': 'Benchmark {}'.format(i)})
+            try:
+                response = yield http.fetch(HTTPRequest(base + '/v1/sendsms', method='POST', body=body,
+                                                        headers={'Content-Type': 'application/json'}))
+            except Exception as e:
+                errors[0] += 1
+                last_error[0] = e
+                continue
+            accepted[0] += 1
+            references.append(int(json.loads(response.body)['data']['reference']))
+
+    @gen.coroutine
+    def run():
+        yield [worker() for i in range(concurrency)]
+    ioloop.IOLoop.current().run_sync(run)
+    if last_error[0] is not None:
+        print('{} errors, the last {}'.format(errors[0], last_error[0]))
+    results.put((accepted[0], errors[0], references))
+
+def measure(workers, requests, concurrency, processes):
+    tmpdir = tempfile.mkdtemp()
+    server = start_server(tmpdir, workers)
+    try:
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(requests // processes, concurrency, results))
+                   for i in range(processes)]
+        start = time.time()
+        for process in clients:
+            process.start()
+        outcomes = [results.get() for process in clients]
+        duration = time.time() - start
+        for process in clients:
+            process.join()
+    finally:
+        stop_server(server)
+        shutil.rmtree(tmpdir)
+    accepted = sum(outcome[0] for outcome in outcomes)
+    references = [reference for outcome in outcomes for reference in outcome[2]]
+    return dict(workers=workers, accepted=accepted, errors=sum(outcome[1] for outcome in outcomes),
+                duplicates=len(references) - len(set(references)), duration=duration,
+                accepted_per_sec=accepted / duration)
+
+def usage():
+    print('\
+        -n --requests <count> : /v1/sendsms requests per run, 4000 by default\n\
+        -c --concurrency <count> : requests in flight per client process, 20 by default\n\
+        -p --processes <count> : client processes, 4 by default\n\
+        -w --workers <counts> : comma separated web worker counts to compare, 1,2,4 by default')
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:c:p:w:', ['help', 'requests=', 'concurrency=',
+                                                                'processes=', 'workers='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    requests, concurrency, processes, counts = 4000, 20, 4, [1, 2, 4]
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-n', '--requests'):
+            requests = int(arg)
+        elif opt in ('-c', '--concurrency'):
+            concurrency = int(arg)
+        elif opt in ('-p', '--processes'):
+            processes = int(arg)
+        elif opt in ('-w', '--workers'):
+            counts = [int(count) for count in arg.split(',')]
+
+    print('{} requests from {} client processes, {} in flight each, {} cores'.format(
+        requests, processes, concurrency, multiprocessing.cpu_count()))
+    baseline = None
+    for workers in counts:
+        result = measure(workers, requests, concurrency, processes)
+        baseline = baseline or result['accepted_per_sec']
+        print('{workers} workers: {accepted} accepted in {duration:.2f}s, {accepted_per_sec:.0f}/s, '
+              '{errors} errors, {duplicates} duplicate references'.format(**result) +
+              ', {:.2f}x'.format(result['accepted_per_sec'] / baseline))
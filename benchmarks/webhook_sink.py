@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# Stand-in for an application receiving status callbacks.  Prints every
+# request it gets and can be made slow or unreliable to exercise the
+# dispatcher's batching and retries.
+#   python benchmarks/webhook_sink.py [port] [fail fraction] [delay secs]
+# then send with "callback_url": "http://localhost:<port>/"
+import sys, json, random
+from tornado import gen, ioloop, web
+
+class SinkHandler(web.RequestHandler):
+    requests = 0
+    events = 0
+
+    @gen.coroutine
+    def post(self):
+        if delay:
+            yield gen.sleep(delay)
+        if random.random() < fail:
+            print('failing request with {} bytes'.format(len(self.request.body)))
+            raise web.HTTPError(503)
+        events = json.loads(self.request.body)['events']
+        SinkHandler.requests += 1
+        SinkHandler.events += len(events)
+        print('request {}: {} events, {} in total: {}'.format(SinkHandler.requests, len(events),
+            SinkHandler.events, ' '.join('{reference}={status}'.format(**e) for e in events)))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 18889
+    fail = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+    web.Application([(r'/.*', SinkHandler)]).listen(port)
+    print('listening on {}'.format(port))
+    sys.stdout.flush()
+    ioloop.IOLoop.current().start()
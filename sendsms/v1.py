@@ -1,11 +1,23 @@
-import multiprocessing, logging
+import multiprocessing, logging, hashlib, json, datetime, time, base64
+from tornado import gen
+from tornado.web import Finish
+from tornado.iostream import StreamClosedError
 from tornado_json.requesthandlers import APIHandler
+from tornado_json.exceptions import APIError
 from tornado_json import schema
 import sgdatabase
 import sgmodem
+import sgcache
+import sgencoding
+import sgretention
 
 counter = 0
 
+# secs a long poll waits for an update, and between keepalives on an event stream
+LONG_POLL_TIMEOUT = 30
+MAX_LONG_POLL_TIMEOUT = 120
+KEEPALIVE_INTERVAL = 15
+
 class SendSMSHandler(APIHandler):
     @schema.validate(
         input_schema={
@@ -14,12 +26,20 @@ class SendSMSHandler(APIHandler):
                 "key": {"type": "string"},
                 "number": {"type": "string"},
                 "message": {"type": "string"},
+                "priority": {"enum": sorted(sgmodem.PRIORITIES)},
+                "transliterate": {"type": "boolean"},
+                "idempotency_key": {"type": "string", "minLength": 1, "maxLength": 255},
+                "callback_url": {"type": "string", "pattern": "^https?://"},
             }
         },
         input_example={
             "key": "Your secret API key",
             "number": "Phone number to send to",
             "message": "Your SMS message to send",
+            "priority": "Optional high, normal or low, defaults to normal",
+            "transliterate": "Optional, true to replace characters outside GSM-7 with lookalikes",
+            "idempotency_key": "Optional, a retry with the same key returns the original request",
+            "callback_url": "Optional URL to POST status changes of the message to",
         },
         output_schema={
             "type": "object",
@@ -27,36 +47,211 @@ class SendSMSHandler(APIHandler):
                 "reference": {"type": "string"},
                 "status": {"type": "string"},
                 "message": {"type": "string"},
+                "segments": {"type": "string"},
             }
         },
         output_example={
             "reference": "SMS send request reference number",
             "status": "The status of your request",
             "message": "",
+            "segments": "Number of SMS the message is sent as",
         },
     )
+    @gen.coroutine
     def post(self):
         global counter
         counter += 1
-        keyprotection = int(self.application.settings.get("settings").get('keyprotection'))
+        keyprotection = self.application.settings.get("settings").get('keyprotection')
         if keyprotection:
             if self.application.settings.get("settings").get('key') != self.body["key"]:
-                return {
+                raise gen.Return({
                     "reference": "-1",
                     "status": "-1",
                     "message": "Invalid key",
-                }
-        number, message = self.body["number"], self.body["message"]
-        requestID = self.application.settings.get("requestID") + 1
-        self.application.settings['requestID'] = requestID
-        sms = {'id':requestID, 'request_status': sgmodem.QUEUED, 'number': number, 'message': message}
-        self.application.settings.get("db_queue").put((sgdatabase.PUT, ('id', 'sms', sms)))
-        self.application.settings.get("modem_queue").put((number, message, requestID))
-        return {
+                })
+        number = self.body["number"]
+        message, encoding, segments = sgencoding.analyse(self.body["message"], self.body.get("transliterate", False))
+        idempotency_key = self.body.get("idempotency_key")
+        digest = hashlib.sha1(u'{}\0{}'.format(number, message).encode('utf-8')).hexdigest()
+        recent_requests = self.application.settings.get("recent_requests")
+        original = self.recent_original(idempotency_key, digest)
+        if original is None and idempotency_key:
+            # keys older than the recent set are found through the index
+            data = yield self.application.settings.get('db_reader').get_one(
+                dict(idempotency_key=idempotency_key), 'sms')
+            if data is not None:
+                original = (data['id'], data.get('segments') or 1)
+                recent_requests.add(idempotency_key, original)
+        if original is None:
+            # this or another web process may have accepted the same request
+            # since, so it is checked again with the keys locked until its own
+            # are added.  The recent messages share the lock.
+            with recent_requests.lock:
+                original = self.recent_original(idempotency_key, digest)
+                if original is None:
+                    requestID = self.application.settings.get("request_ids").allocate()
+                    if idempotency_key:
+                        recent_requests.add(idempotency_key, (requestID, segments))
+                    self.application.settings.get("recent_messages").add(digest, (requestID, segments))
+        if original is not None:
+            response = yield self.original_response(*original)
+            raise gen.Return(response)
+
+        sms = {'id':requestID, 'request_status': sgmodem.QUEUED, 'number': number, 'message': message,
+                'encoding': encoding, 'segments': segments, 'created_at': time.time()}
+        if idempotency_key:
+            sms['idempotency_key'] = idempotency_key
+        callback_url = self.body.get("callback_url")
+        if callback_url:
+            sms['callback_url'] = callback_url
+            # known before the modem can report on the message
+            self.application.settings.get("webhooks").watch([(requestID, callback_url)])
+        self.application.settings.get("db_queue").put((sgdatabase.INSERT, ('id', 'sms', sms)))
+        priority = sgmodem.PRIORITIES[self.body.get("priority", "normal")]
+        queued = sgmodem.make_message(number, message, requestID, priority, segments)
+        # written to the outbox first so the message survives a crash before it is sent
+        yield self.application.settings.get("outbox").add([queued])
+        self.application.settings.get("modem_queue").put(queued)
+        self.application.settings.get("status_cache").put(requestID, sgmodem.QUEUED, message)
+        raise gen.Return({
             "reference": "{}".format(requestID),
             "status": "{}".format(sgmodem.QUEUED),
-            "message": "{}".format(message)
-        }
+            "message": u"{}".format(message),
+            "segments": "{}".format(segments)
+        })
+
+    def recent_original(self, idempotency_key, digest):
+        # (requestID, segments) of a recent request this one repeats, or None
+        if idempotency_key:
+            original = self.application.settings.get("recent_requests").get(idempotency_key)
+            if original is not None:
+                return original
+        # identical number and message within the dedup window
+        recent_messages = self.application.settings.get("recent_messages")
+        if recent_messages.ttl > 0:
+            return recent_messages.get(digest)
+        return None
+
+    @gen.coroutine
+    def original_response(self, requestID, segments):
+        cached = self.application.settings.get("status_cache").get(requestID)
+        if cached is None:
+            data = yield self.application.settings.get('db_reader').get_one(dict(id=requestID), 'sms')
+            cached = (data['request_status'], data['message']) if data else (sgmodem.QUEUED, '')
+        request_status, message = cached
+        raise gen.Return({
+            "reference": "{}".format(requestID),
+            "status": "{}".format(request_status),
+            "message": u"{}".format(message),
+            "segments": "{}".format(segments)
+        })
+
+class SendSMSBatchHandler(APIHandler):
+    @schema.validate(
+        input_schema={
+            "type": "object",
+            "properties": {
+                "key": {"type": "string"},
+                "messages": {
+                    "type": "array",
+                    "minItems": 1,
+                    "maxItems": 1000,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "number": {"type": "string"},
+                            "message": {"type": "string"},
+                        },
+                        "required": ["number", "message"],
+                    },
+                },
+                "priority": {"enum": sorted(sgmodem.PRIORITIES)},
+                "transliterate": {"type": "boolean"},
+                "callback_url": {"type": "string", "pattern": "^https?://"},
+            },
+            "required": ["messages"],
+        },
+        input_example={
+            "key": "Your secret API key",
+            "messages": [
+                {"number": "Phone number to send to", "message": "Your SMS message to send"},
+            ],
+            "priority": "Optional high, normal or low for all messages, defaults to normal",
+            "transliterate": "Optional, true to replace characters outside GSM-7 with lookalikes",
+            "callback_url": "Optional URL to POST status changes of all messages to",
+        },
+        output_schema={
+            "type": "object",
+            "properties": {
+                "messages": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "reference": {"type": "string"},
+                            "status": {"type": "string"},
+                            "message": {"type": "string"},
+                            "segments": {"type": "string"},
+                        }
+                    },
+                },
+            }
+        },
+        output_example={
+            "messages": [
+                {
+                    "reference": "SMS send request reference number",
+                    "status": "The status of your request",
+                    "message": "",
+                    "segments": "Number of SMS the message is sent as",
+                },
+            ],
+        },
+    )
+    @gen.coroutine
+    def post(self):
+        global counter
+        counter += 1
+        keyprotection = self.application.settings.get("settings").get('keyprotection')
+        if keyprotection:
+            if self.application.settings.get("settings").get('key') != self.body.get("key"):
+                raise gen.Return({
+                    "messages": [{
+                        "reference": "-1",
+                        "status": "-1",
+                        "message": "Invalid key",
+                    }]
+                })
+        items = self.body["messages"]
+        # allocate a contiguous block of reference numbers for the whole batch
+        firstID = self.application.settings.get("request_ids").allocate(len(items))
+        priority = sgmodem.PRIORITIES[self.body.get("priority", "normal")]
+        rows, queued, results = [], [], []
+        cache = self.application.settings.get("status_cache")
+        transliterate = self.body.get("transliterate", False)
+        callback_url = self.body.get("callback_url")
+        created_at = time.time()
+        for requestID, item in enumerate(items, firstID):
+            number = item["number"]
+            message, encoding, segments = sgencoding.analyse(item["message"], transliterate)
+            rows.append({'id':requestID, 'request_status': sgmodem.QUEUED, 'number': number, 'message': message,
+                        'encoding': encoding, 'segments': segments, 'created_at': created_at})
+            if callback_url:
+                rows[-1]['callback_url'] = callback_url
+            queued.append(sgmodem.make_message(number, message, requestID, priority, segments))
+            cache.put(requestID, sgmodem.QUEUED, message)
+            results.append({
+                "reference": "{}".format(requestID),
+                "status": "{}".format(sgmodem.QUEUED),
+                "message": u"{}".format(message),
+                "segments": "{}".format(segments)
+            })
+        if callback_url:
+            self.application.settings.get("webhooks").watch([(row['id'], callback_url) for row in rows])
+        self.application.settings.get("db_queue").put((sgdatabase.INSERT_MANY, ('id', 'sms', rows)))
+        yield self.application.settings.get("outbox").add(queued)
+        self.application.settings.get("modem_queue").put(queued)
+        raise gen.Return({"messages": results})
 
 class GetStatusHandler(APIHandler):
     @schema.validate(
@@ -74,30 +269,313 @@ class GetStatusHandler(APIHandler):
             "message": "The message you sent",
         },
     )
+    @gen.coroutine
     def get(self, requestID):
         global counter
         counter += 1
-        keyprotection = int(self.application.settings.get("settings").get('keyprotection'))
+        keyprotection = self.application.settings.get("settings").get('keyprotection')
         if keyprotection:
             key = self.get_argument('key')
             if self.application.settings.get("settings").get('key') != key:
-                return {
+                raise gen.Return({
                     "reference": "-1",
                     "status": "-1",
                     "message": "Invalid key",
-                }
-        req = dict(id=int(requestID))
-        self.application.settings.get('db_queue').put((sgdatabase.GET, (req,'sms')))
-        data = self.application.settings.get('ipipe').recv()
-        if data is None:
-            return { 
-                "reference": "{}".format(requestID),
-                "status": "-1",
-                "message": "INVALID REFERENCE"
+                })
+        invalid = {
+            "reference": "{}".format(requestID),
+            "status": "-1",
+            "message": "INVALID REFERENCE"
+        }
+        requestID = int(requestID)
+        # references that have never been handed out need no lookup
+        if requestID < 1 or requestID > self.application.settings.get("request_ids").last:
+            raise gen.Return(invalid)
+        cache = self.application.settings.get('status_cache')
+        cached = cache.get(requestID)
+        if cached is None:
+            req = dict(id=requestID)
+            data = yield self.application.settings.get('db_reader').get_one(req, 'sms')
+            if data is None:
+                # moved out of the sms table by retention
+                data = yield self.application.settings.get('db_reader').run(sgretention.find_archived,
+                    self.application.settings.get('archive_dir'), requestID)
+            if data is None:
+                raise gen.Return(invalid)
+            cached = data['request_status'], data['message']
+            cache.put(requestID, *cached)
+        request_status, message = cached
+        if request_status in sgmodem.FINAL_STATUSES:
+            self.set_header('Etag', sgcache.etag(requestID, request_status))
+            if self.check_etag_header():
+                self.set_status(304)
+                raise Finish()
+        raise gen.Return({
+            "reference": "{}".format(requestID),
+            "status": '{}'.format(request_status),
+            "message": u"{}".format(message)
+        })
+
+
+class ListHandler(APIHandler):
+    """Base of the listings, which take the secret key as an argument and
+    page with a cursor of the (time, id) of the last row of a page."""
+
+    def check_key(self):
+        keyprotection = self.application.settings.get("settings").get('keyprotection')
+        if keyprotection:
+            if self.application.settings.get("settings").get('key') != self.get_argument('key', None):
+                raise APIError(403, "Invalid key")
+
+    def page_arguments(self):
+        # since, until, limit and after of the page asked for
+        try:
+            since = self.get_argument('since', None)
+            since = float(since) if since is not None else None
+            until = self.get_argument('until', None)
+            until = float(until) if until is not None else None
+            limit = min(int(self.get_argument('limit', sgdatabase.PAGE_SIZE)), sgdatabase.MAX_PAGE_SIZE)
+            after = self.get_argument('cursor', None)
+            after = tuple(json.loads(base64.urlsafe_b64decode(str(after)))) if after else None
+        except (ValueError, TypeError):
+            raise APIError(400, "since, until and limit must be numbers and cursor one returned before")
+        # any other cursor would reach the query with the wrong parameters
+        if after is not None and (len(after) != 2 or
+                not all(isinstance(v, (int, long, float)) and not isinstance(v, bool) for v in after)):
+            raise APIError(400, "cursor must be one returned before")
+        if limit < 1:
+            raise APIError(400, "limit must be at least 1")
+        return since, until, limit, after
+
+    def page(self, rows, limit, column):
+        # rows are read one more than the page to know whether there is a
+        # next one, returns the page and the cursor of the next, '' if none
+        if len(rows) <= limit:
+            return rows, ''
+        rows = rows[:limit]
+        return rows, base64.urlsafe_b64encode(json.dumps([rows[-1][column], rows[-1]['id']]))
+
+class ListSMSHandler(ListHandler):
+    """Messages newest first, optionally only those with one of a comma
+    separated list of statuses, sent to a number, or accepted between since
+    and until (secs since the epoch).  A page ends with the cursor to pass
+    for the next one, empty on the last page."""
+
+    @schema.validate(
+        output_schema={
+            "type": "object",
+            "properties": {
+                "messages": {"type": "array"},
+                "cursor": {"type": "string"},
             }
+        },
+        output_example={
+            "messages": [{"reference": "1", "status": "1", "number": "Phone number", "message": "The message",
+                          "segments": "1", "created_at": "Secs since the epoch the message was accepted"}],
+            "cursor": "Cursor of the next page, empty on the last page",
+        },
+    )
+    @gen.coroutine
+    def get(self):
+        global counter
+        counter += 1
+        self.check_key()
+        try:
+            statuses = self.get_argument('status', None)
+            statuses = sorted(set(int(i) for i in statuses.split(',') if i.strip())) if statuses else None
+        except ValueError:
+            raise APIError(400, "status must be a comma separated list of numbers")
+        since, until, limit, after = self.page_arguments()
+        rows = yield self.application.settings.get('db_reader').list_sms(statuses,
+            self.get_argument('number', None), since, until, after, limit + 1)
+        rows, cursor = self.page(rows, limit, 'created_at')
+        raise gen.Return({
+            "messages": [{
+                "reference": "{}".format(row['id']),
+                "status": "{}".format(row['request_status']),
+                "number": u"{}".format(row['number'] or ''),
+                "message": u"{}".format(row['message'] or ''),
+                "segments": "{}".format(row['segments'] or 1),
+                "created_at": "{:.3f}".format(row['created_at'] or 0),
+            } for row in rows],
+            "cursor": cursor,
+        })
+
+class ListInboxHandler(ListHandler):
+    """Messages received by the modems newest first, optionally only those
+    from a number or received between since and until (secs since the
+    epoch).  The parts of a long message are joined into one, missing
+    counts parts that never arrived.  Pages like /v1/sms."""
+
+    @schema.validate(
+        output_schema={
+            "type": "object",
+            "properties": {
+                "messages": {"type": "array"},
+                "cursor": {"type": "string"},
+            }
+        },
+        output_example={
+            "messages": [{"id": "1", "number": "Phone number of the sender", "message": "The message",
+                          "parts": "1", "missing": "0", "port": "Port of the modem that received it",
+                          "sent_at": "Secs since the epoch the network stamped the message with",
+                          "received_at": "Secs since the epoch the message was stored"}],
+            "cursor": "Cursor of the next page, empty on the last page",
+        },
+    )
+    @gen.coroutine
+    def get(self):
+        global counter
+        counter += 1
+        self.check_key()
+        since, until, limit, after = self.page_arguments()
+        rows = yield self.application.settings.get('db_reader').list_inbox(
+            self.get_argument('number', None), since, until, after, limit + 1)
+        rows, cursor = self.page(rows, limit, 'received_at')
+        raise gen.Return({
+            "messages": [{
+                "id": "{}".format(row['id']),
+                "number": u"{}".format(row['number'] or ''),
+                "message": u"{}".format(row['message'] or ''),
+                "parts": "{}".format(row['parts'] or 1),
+                "missing": "{}".format(row['missing'] or 0),
+                "port": u"{}".format(row['port'] or ''),
+                "sent_at": "{:.3f}".format(row['sent_at'] or 0),
+                "received_at": "{:.3f}".format(row['received_at'] or 0),
+            } for row in rows],
+            "cursor": cursor,
+        })
+
+class StatusStreamHandler(APIHandler):
+    """Status updates as they happen, either as Server-Sent Events when the
+    client accepts text/event-stream or as a long poll returning JSON.
+
+    ids is a comma separated list of references to follow, all messages when
+    left out.  since is the cursor of the last update seen; an event stream
+    also takes it from the Last-Event-ID header when it reconnects."""
+
+    def initialize(self):
+        super(StatusStreamHandler, self).initialize()
+        self.subscription = None
+        self.closed = False
+
+    @gen.coroutine
+    def get(self):
+        global counter
+        counter += 1
+        keyprotection = self.application.settings.get("settings").get('keyprotection')
+        if keyprotection:
+            if self.application.settings.get("settings").get('key') != self.get_argument('key', None):
+                raise APIError(403, "Invalid key")
+        try:
+            ids = self.get_argument('ids', None)
+            ids = frozenset(int(i) for i in ids.split(',') if i.strip()) if ids else None
+            since = self.request.headers.get('Last-Event-ID') or self.get_argument('since', None)
+            since = int(since) if since is not None else None
+            timeout = min(float(self.get_argument('timeout', LONG_POLL_TIMEOUT)), MAX_LONG_POLL_TIMEOUT)
+        except ValueError:
+            raise APIError(400, "ids, since and timeout must be numbers")
+        stream = self.application.settings.get('status_stream')
+        self.subscription = stream.subscribe(ids, since)
+        try:
+            if 'text/event-stream' in self.request.headers.get('Accept', ''):
+                yield self.event_stream(stream)
+            else:
+                yield self.long_poll(stream, timeout)
+        finally:
+            stream.unsubscribe(self.subscription)
+
+    @gen.coroutine
+    def long_poll(self, stream, timeout):
+        try:
+            yield self.subscription.event.wait(datetime.timedelta(seconds=timeout))
+        except gen.TimeoutError:
+            pass
+        if self.closed:
+            return
+        events = [self.event(*event) for event in stream.read(self.subscription)]
+        self.success({"cursor": "{}".format(self.subscription.cursor), "events": events})
+
+    @gen.coroutine
+    def event_stream(self, stream):
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        # tells nginx and similar proxies not to hold the events back
+        self.set_header('X-Accel-Buffering', 'no')
+        # ask the browser to wait a few secs before reconnecting
+        self.write('retry: 3000\n\n')
+        try:
+            yield self.flush()
+            while not self.closed:
+                try:
+                    yield self.subscription.event.wait(datetime.timedelta(seconds=KEEPALIVE_INTERVAL))
+                except gen.TimeoutError:
+                    self.write(': keepalive\n\n')
+                for event in stream.read(self.subscription):
+                    self.write('id: {}\nevent: status\ndata: {}\n\n'.format(event[0], json.dumps(self.event(*event))))
+                yield self.flush()
+        except StreamClosedError:
+            pass
+
+    def event(self, seq, requestID, request_status):
         return {
+            "cursor": "{}".format(seq),
             "reference": "{}".format(requestID),
-            "status": '{}'.format(data['request_status']),
-            "message": "{}".format(data['message'])
+            "status": "{}".format(request_status),
         }
 
+    def on_connection_close(self):
+        self.closed = True
+        if self.subscription is not None:
+            # wake the request so it stops waiting and unsubscribes
+            self.subscription.event.set()
+
+class SettingsHandler(APIHandler):
+    """Changes settings of the running server.  The secret key is always
+    required here, and is itself only changed from the command line or the
+    tray menu."""
+
+    @schema.validate(
+        input_schema={
+            "type": "object",
+            "properties": {
+                "key": {"type": "string"},
+                "settings": {"type": "object", "additionalProperties": {"type": "string"}},
+            },
+            "required": ["key", "settings"],
+        },
+        input_example={
+            "key": "Your secret API key",
+            "settings": {"min_send_interval": "5"},
+        },
+        output_schema={
+            "type": "object",
+            "properties": {
+                "settings": {"type": "object", "additionalProperties": {"type": "string"}},
+            }
+        },
+        output_example={
+            "settings": {"min_send_interval": "5", "com_port": "COM3"},
+        },
+    )
+    def post(self):
+        global counter
+        counter += 1
+        settings = self.application.settings.get("settings")
+        if settings.get('key') != self.body["key"]:
+            raise APIError(403, "Invalid key")
+        changes = self.body["settings"]
+        unknown = [name for name in changes if name == 'key' or name not in settings.defaults]
+        if unknown:
+            raise APIError(400, "Unknown settings {}".format(', '.join(sorted(unknown))))
+        # all are checked before any is saved
+        for name, value in changes.items():
+            try:
+                settings.parse(name, value)
+            except ValueError:
+                raise APIError(400, "Invalid value {} for {}".format(value, name))
+        for name, value in sorted(changes.items()):
+            settings.save(name, value)
+        return {
+            "settings": dict((name, u"{}".format(settings.raw(name))) for name in settings.defaults if name != 'key'),
+        }
@@ -0,0 +1,420 @@
+import logging, threading, time, re
+from collections import deque
+import serial
+from serial import SerialException
+from gsmmodem.pdu import encodeSmsSubmitPdu, decodeSmsPdu
+from gsmmodem.exceptions import CommandError, CmeError, CmsError, TimeoutException, PinRequiredError, EncodingError
+
+CTRLZ = '\x1a'
+ESC = '\x1b'
+
+# AT commands timed on their own, the others are timed together as 'other'
+TIMED_COMMANDS = ('CMGS', 'CMGR', 'CMGL', 'CMGD')
+
+# secs to wait for the final result of a command, and of a message part
+COMMAND_TIMEOUT = 10
+SEND_TIMEOUT = 35
+
+FINAL_RESULT = re.compile(r'^(OK|ERROR|\+CMS ERROR: ?(\d+)|\+CME ERROR: ?(\d+))$')
+STORED_NOTIFICATION = re.compile(r'^\+(CDSI|CMTI): ?"([^"]+)", ?(\d+)$')
+
+class Cancelled(Exception):
+    '''A message taken off the queue of the driver before it was written.'''
+
+class StatusReport(object):
+    '''A delivery report, with the fields gsmmodem.modem.StatusReport has.'''
+    __slots__ = ('status', 'reference', 'number', 'timeSent', 'timeFinalized', 'deliveryStatus')
+
+    def __init__(self, status, reference, number, timeSent, timeFinalized, deliveryStatus):
+        self.status = status
+        self.reference = reference
+        self.number = number
+        self.timeSent = timeSent
+        self.timeFinalized = timeFinalized
+        self.deliveryStatus = deliveryStatus
+
+def command_name(text):
+    # AT+CMGS=23 -> CMGS
+    return re.split(r'[=?]', text[3:] if text.upper().startswith('AT+') else text, 1)[0].upper()
+
+class Command(object):
+    '''An AT command waiting to be written or for its final result.  data
+    is written once the modem prompts for it with "> ".  done(command,
+    error) runs on the reader thread with the lines the modem answered.'''
+    __slots__ = ('text', 'data', 'timeout', 'done', 'owner', 'lines', 'written_at', 'prompted')
+
+    def __init__(self, text, data=None, timeout=COMMAND_TIMEOUT, done=None, owner=None):
+        self.text = text
+        self.data = data
+        self.timeout = timeout
+        self.done = done
+        self.owner = owner # the Submission a message part belongs to
+        self.lines = []
+        self.written_at = None
+        self.prompted = False
+
+class Submission(object):
+    '''The AT+CMGS commands of the parts of one message.'''
+    __slots__ = ('parts', 'done', 'started', 'reference', 'finished')
+
+    def __init__(self, parts, done):
+        self.parts = parts
+        self.done = done
+        self.started = None
+        self.reference = None
+        self.finished = False
+
+class ATModem(object):
+    '''GSM modem driver on pyserial which does not wait for the modem.
+
+    Commands are queued and written one at a time, the next as soon as the
+    modem gives the final result of the one before.  A reader thread is
+    the event loop of the driver: it splits what the modem sends into
+    lines, writes the PDU of a message part when the modem prompts for it,
+    times out commands, and handles the delivery reports (+CDS, or +CDSI
+    when the modem stores them) and new message notifications (+CMTI) that
+    arrive in between.  So the caller can take in and encode the next
+    messages while one is being submitted.
+
+    Callbacks run on the reader thread.  timings maps the names in
+    TIMED_COMMANDS and 'other' to sgmetrics.Histogram.'''
+
+    log = logging.getLogger('sgatmodem.ATModem')
+
+    def __init__(self, port, baudrate=115200, on_report=None, on_message=None, on_lost=None, timings=None):
+        self.port = port
+        self.baudrate = baudrate
+        self.on_report = on_report # on_report(StatusReport)
+        self.on_message = on_message # on_message(memory, index) of a message received
+        self.on_lost = on_lost # on_lost(error) once the port fails
+        self.timings = timings or {}
+        self.serial = None
+        self.thread = None
+        self.alive = False
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = deque() # commands not yet written
+        self.current = None # command written and waiting for its final result
+        self.submissions = 0 # messages queued and not yet done
+        self.buffer = ''
+        self.report_length = None # set when the next line is the PDU of a +CDS
+        self.reference = 0
+        self.failed = None # the error the port failed with
+
+    def connect(self):
+        self.serial = serial.Serial(self.port, self.baudrate, timeout=0.1)
+        self.alive = True
+        self.thread = threading.Thread(target=self.read_loop, name='ATModemReader')
+        self.thread.daemon = True
+        self.thread.start()
+        self.command('ATZ')
+        self.command('ATE0') # echo off
+        self.command('AT+CMEE=1') # numeric error codes
+        pin = [line for line in self.command('AT+CPIN?') if line.startswith('+CPIN:')]
+        if pin and pin[0][6:].strip() != 'READY':
+            raise PinRequiredError('AT+CPIN?')
+        self.command('AT+CMGF=0') # PDU mode
+        try:
+            # delivery reports straight to us as +CDS, which saves reading and deleting them
+            self.command('AT+CNMI=2,1,0,1,0')
+        except CommandError:
+            self.command('AT+CNMI=2,1,0,2,0')
+
+    def close(self, timeout=5):
+        '''Waits up to timeout secs for the commands queued, then cancels
+        the rest and closes the port.'''
+        self.wait_idle(timeout)
+        self.cancel()
+        self.alive = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(1)
+        if self.serial is not None:
+            self.serial.close()
+
+    def command(self, text, timeout=COMMAND_TIMEOUT):
+        '''Writes a command and waits for its result, returns the lines of
+        the response.  Not for the reader thread.'''
+        return self.commands(text, timeout=timeout)[0]
+
+    def commands(self, *texts, **kwargs):
+        '''Writes commands one after the other with nothing in between, like
+        selecting a memory and then reading it, and waits for their results.
+        Returns the lines of each response or raises the error of the first
+        that failed.  timeout applies to each command.  Not for the reader
+        thread.'''
+        timeout = kwargs.get('timeout', COMMAND_TIMEOUT)
+        finished = threading.Event()
+        results = [None] * len(texts)
+        def done(command, error, i):
+            results[i] = (error, command.lines)
+            if None not in results:
+                finished.set()
+        self.submit(*[Command(text, timeout=timeout, done=lambda command, error, i=i: done(command, error, i))
+                      for i, text in enumerate(texts)])
+        if not finished.wait(timeout * len(texts) + 1):
+            raise TimeoutException()
+        for error, lines in results:
+            if error is not None:
+                raise error
+        return [lines for error, lines in results]
+
+    def submit(self, *commands):
+        # queues the commands together, nothing else comes in between
+        error = None
+        with self.lock:
+            self.pending.extend(commands)
+            if self.failed is not None:
+                error = self.failed
+            elif self.current is None:
+                try:
+                    self.write_next(time.time())
+                except (SerialException, OSError) as e:
+                    error = e
+        if error is not None:
+            self.lost(error)
+
+    def send(self, pdus, done):
+        '''Queues the AT+CMGS of each part of a message.  done(reference,
+        error, secs) is called once the last part is sent or a part fails,
+        with the reference of the last part and the secs since the first
+        was written.  The parts after one that failed are not sent.'''
+        submission = Submission(len(pdus), done)
+        commands = [Command('AT+CMGS={}'.format(pdu.tpduLength), data=str(pdu) + CTRLZ, timeout=SEND_TIMEOUT,
+                            done=self.part_done, owner=submission) for pdu in pdus]
+        with self.lock:
+            self.submissions += 1
+        self.submit(*commands)
+
+    def encode(self, number, text):
+        # the SMS-SUBMIT PDUs of a message asking for a delivery report, the
+        # reference also tells apart the parts of one long message from the next
+        pdus = encodeSmsSubmitPdu(number, text, reference=self.reference, requestStatusReport=True)
+        self.reference = (self.reference + 1) % 256
+        return pdus
+
+    def outstanding(self):
+        # messages queued and not yet sent
+        with self.lock:
+            return self.submissions
+
+    def wait_below(self, count, timeout):
+        # True once fewer than count messages are outstanding
+        deadline = time.time() + timeout
+        with self.lock:
+            while self.submissions >= count and self.alive:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+            return True
+
+    def wait_idle(self, timeout):
+        return self.wait_below(1, timeout)
+
+    def cancel(self):
+        # takes the messages not yet written off the queue, done() gets Cancelled
+        with self.lock:
+            cancelled = [c for c in self.pending if c.owner is not None]
+            self.pending = deque(c for c in self.pending if c.owner is None)
+        for command in cancelled:
+            self.finish_submission(command.owner, Cancelled())
+        return len(set(c.owner for c in cancelled))
+
+    def write_next(self, now):
+        # with the lock held, writes the next command if there is one
+        self.current = None
+        while self.pending:
+            command = self.pending.popleft()
+            if command.owner is not None and command.owner.finished:
+                continue # an earlier part failed
+            self.current = command
+            command.written_at = now
+            if command.owner is not None and command.owner.started is None:
+                command.owner.started = now
+            self.log.debug('Write %s', command.text)
+            # a write that fails leaves it current, for lost() to fail it
+            self.serial.write(command.text + '\r')
+            return
+
+    def read_loop(self):
+        while self.alive:
+            try:
+                data = self.serial.read(self.serial.in_waiting or 1)
+            except Exception as e:
+                if self.alive:
+                    self.lost(e)
+                break
+            try:
+                now = time.time()
+                if data:
+                    self.feed(data, now)
+                self.expire(now)
+            except (SerialException, OSError) as e:
+                self.lost(e)
+                break
+            except Exception as e:
+                self.log.error('Error handling %r %s', data, e.args, exc_info=True)
+
+    def feed(self, data, now):
+        self.buffer += data
+        while True:
+            match = re.search(r'[\r\n]', self.buffer)
+            if match is None:
+                break
+            line, self.buffer = self.buffer[:match.start()].strip(), self.buffer[match.end():]
+            if line:
+                self.handle_line(line, now)
+        # the prompt for the PDU of AT+CMGS ends without a new line
+        if self.buffer.startswith('>'):
+            self.buffer = ''
+            self.prompted(now)
+
+    def prompted(self, now):
+        with self.lock:
+            command = self.current
+            if command is None or command.data is None or command.prompted:
+                self.log.warn('Unexpected prompt')
+                return
+            command.prompted = True
+            self.serial.write(command.data)
+
+    def handle_line(self, line, now):
+        self.log.debug('Read %s', line)
+        if self.report_length is not None:
+            self.report_length = None
+            self.report(line, None)
+            return
+        if line.startswith('+CDS:'):
+            self.report_length = int(line[5:].strip() or 0)
+            return
+        stored = STORED_NOTIFICATION.match(line)
+        if stored:
+            self.stored(stored.group(1), stored.group(2), int(stored.group(3)))
+            return
+        command = self.current
+        if command is None:
+            self.log.debug('Ignoring %s', line)
+            return
+        if line == command.text:
+            return # echo
+        result = FINAL_RESULT.match(line)
+        if result is None:
+            command.lines.append(line)
+            return
+        if result.group(2) is not None:
+            error = CmsError(command.text, int(result.group(2)))
+        elif result.group(3) is not None:
+            error = CmeError(command.text, int(result.group(3)))
+        elif line == 'ERROR':
+            error = CommandError(command.text)
+        else:
+            error = None
+        self.finish(command, error, now)
+
+    def finish(self, command, error, now):
+        secs = now - command.written_at
+        name = command_name(command.text)
+        histogram = self.timings.get(name if name in TIMED_COMMANDS else 'other')
+        if histogram is not None:
+            histogram.observe(secs)
+        if error is not None:
+            self.log.debug('%s failed after %.3fs: %s', command.text, secs, error)
+        # the next command goes out before the result of this one is handled
+        with self.lock:
+            if self.current is command:
+                self.write_next(now)
+        if command.done is not None:
+            command.done(command, error)
+
+    def expire(self, now):
+        command = self.current
+        if command is None or now - command.written_at < command.timeout:
+            return
+        self.log.warn('%s timed out after %ss', command.text, command.timeout)
+        if command.data is not None:
+            self.serial.write(ESC) # leave the prompt if the modem is still at it
+        self.finish(command, TimeoutException(command.lines), now)
+
+    def part_done(self, command, error):
+        submission = command.owner
+        if error is None:
+            cmgs = [line for line in command.lines if line.startswith('+CMGS:')]
+            if not cmgs:
+                error = CommandError('Modem did not respond with +CMGS response')
+            else:
+                submission.reference = int(cmgs[0][6:].strip())
+                submission.parts -= 1
+        if error is not None or not submission.parts:
+            self.finish_submission(submission, error)
+
+    def finish_submission(self, submission, error):
+        with self.lock:
+            if submission.finished:
+                return
+            submission.finished = True
+            self.submissions -= 1
+            self.idle.notify_all()
+        secs = time.time() - submission.started if submission.started else 0.0
+        try:
+            submission.done(submission.reference if error is None else None, error, secs)
+        except Exception as e:
+            self.log.error('Error in send callback %s', e.args, exc_info=True)
+
+    def stored(self, kind, memory, index):
+        if kind == 'CMTI':
+            if self.on_message is not None:
+                self.on_message(memory, index)
+            else:
+                self.log.info('Message received in %s at %d', memory, index)
+            return
+        # a stored delivery report is read and deleted, after what is queued already
+        def read(command, error):
+            if error is not None:
+                self.log.warn('Unable to read delivery report %s at %d %s', memory, index, error)
+                return
+            lines = command.lines
+            header = [i for i, line in enumerate(lines) if line.startswith('+CMGR:')]
+            if not header or header[0] + 1 >= len(lines):
+                self.log.warn('Unexpected delivery report %s', lines)
+                return
+            stat = lines[header[0]][6:].split(',')[0].strip()
+            self.report(lines[header[0] + 1], int(stat) if stat.isdigit() else 0)
+        self.submit(Command('AT+CPMS="{}"'.format(memory)), Command('AT+CMGR={}'.format(index), done=read),
+                    Command('AT+CMGD={}'.format(index)))
+
+    def report(self, pdu, stat):
+        try:
+            sms = decodeSmsPdu(pdu)
+        except EncodingError as e:
+            self.log.warn('Unable to decode delivery report %s %s', pdu, e.args)
+            return
+        if sms.get('type') != 'SMS-STATUS-REPORT':
+            self.log.warn('Expected a delivery report, got %s', sms.get('type'))
+            return
+        report = StatusReport(int(sms['status']) if stat is None else stat, sms['reference'], sms['number'],
+                              sms['time'], sms['discharge'], sms['status'])
+        if self.on_report is not None:
+            try:
+                self.on_report(report)
+            except Exception as e:
+                self.log.error('Error in delivery report callback %s', e.args, exc_info=True)
+
+    def lost(self, error):
+        # the port failed, every queued command fails with it
+        with self.lock:
+            first = self.failed is None
+            self.failed = self.failed or error
+            self.alive = False
+            commands = ([self.current] if self.current is not None else []) + list(self.pending)
+            self.current = None
+            self.pending.clear()
+            self.idle.notify_all()
+        for command in commands:
+            if command.owner is not None:
+                self.finish_submission(command.owner, error)
+            elif command.done is not None:
+                command.done(command, error)
+        if first:
+            self.log.error('Lost the modem on %s %s', self.port, error)
+            if self.on_lost is not None:
+                self.on_lost(error)
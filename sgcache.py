@@ -0,0 +1,77 @@
+import logging, time
+from collections import OrderedDict
+from threading import Lock
+import sgmodem
+
+log = logging.getLogger('sgcache.StatusCache')
+
+# rough per entry cost on top of the message text, used for the memory cap
+ENTRY_OVERHEAD = 400
+
+class StatusCache(object):
+    '''LRU cache of sms status for the web tier.
+
+    Filled when a message is queued and kept current by the sms updates the
+    database thread commits.  Messages in a final status never go stale, the
+    others expire after ttl secs in case an update was missed.'''
+
+    def __init__(self, max_bytes=16*1024*1024, ttl=60, logLevel=logging.WARNING):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        log.setLevel(logLevel)
+
+    def get(self, requestID):
+        with self.lock:
+            entry = self.entries.get(requestID)
+            if entry is not None and entry[2] is not None and entry[2] < time.time():
+                self._remove(requestID)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # move to the most recently used end
+            del self.entries[requestID]
+            self.entries[requestID] = entry
+            return entry[0], entry[1]
+
+    def put(self, requestID, request_status, message):
+        expires = None if request_status in sgmodem.FINAL_STATUSES else time.time() + self.ttl
+        with self.lock:
+            self._remove(requestID)
+            self.entries[requestID] = (request_status, message, expires)
+            self.size += ENTRY_OVERHEAD + len(message or '')
+            while self.size > self.max_bytes and self.entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def update(self, table, data):
+        # listener for rows committed by SMSDatabase
+        if table != 'sms' or 'request_status' not in data:
+            return
+        requestID = data['id']
+        with self.lock:
+            entry = self.entries.get(requestID)
+        if entry is not None:
+            self.put(requestID, data['request_status'], data.get('message', entry[1]))
+        elif 'message' in data:
+            self.put(requestID, data['request_status'], data['message'])
+
+    def _remove(self, requestID):
+        entry = self.entries.pop(requestID, None)
+        if entry is not None:
+            self.size -= ENTRY_OVERHEAD + len(entry[1] or '')
+
+    def stats(self):
+        with self.lock:
+            return dict(entries=len(self.entries), size=self.size, hits=self.hits,
+                        misses=self.misses, evictions=self.evictions)
+
+def etag(requestID, request_status):
+    return '"{}-{}"'.format(requestID, request_status)
@@ -1,113 +1,659 @@
-import sys, os, multiprocessing, logging
-from threading import Thread, Event, Lock
-import dataset
+import sys, os, multiprocessing, logging, time, Queue, itertools, sqlite3
+from collections import OrderedDict
+from threading import Thread, Event, Lock, Condition, local
+from tornado.concurrent import Future
+import sgmetrics
 
 log = logging.getLogger('sgdatabase.SMSDatabase')
 
 # commands that the SMS Database server can receive to process
-GET=0
 PUT=1
 EXIT=2
-UPDATE_INDEX=3
-GET_VALUE=4
-GET_ALL=5
+PUT_MANY=6
+# new rows from the web tier. A modem can report on a message before its row
+# arrives, so a request_status already written is kept.
+INSERT=7
+INSERT_MANY=8
+
+PUT_ACTIONS = (PUT, PUT_MANY, INSERT, INSERT_MANY)
+
+# declared tables, (column, type) pairs in order.  Columns missing from a
+# database made by an older version are added on connect.
+SCHEMA = OrderedDict([
+    ('sms', [
+        ('id', 'INTEGER PRIMARY KEY'),
+        ('request_status', 'INTEGER'),
+        ('number', 'TEXT'),
+        ('message', 'TEXT'),
+        ('encoding', 'TEXT'),
+        ('segments', 'INTEGER'),
+        ('idempotency_key', 'TEXT'),
+        ('callback_url', 'TEXT'),
+        ('created_at', 'REAL'), # secs since the epoch the message was accepted
+        # from the modem and its status report
+        ('reference', 'INTEGER'),
+        ('status', 'INTEGER'),
+        ('deliveryStatus', 'INTEGER'),
+        ('timeSent', 'TIMESTAMP'),
+        ('timeFinalized', 'TIMESTAMP'),
+    ]),
+    ('settings', [
+        ('id', 'INTEGER PRIMARY KEY'),
+        ('setting', 'TEXT NOT NULL'),
+        ('value', 'TEXT'),
+    ]),
+    # messages moved to an archive file by sgretention, by the month of the file
+    ('archived', [
+        ('id', 'INTEGER PRIMARY KEY'),
+        ('month', 'INTEGER NOT NULL'),
+    ]),
+    # messages received, written by the modem processes through sginbox
+    ('inbox', [
+        ('id', 'INTEGER PRIMARY KEY'),
+        ('uid', 'TEXT NOT NULL'), # hash of sender, time sent and text, stored once
+        ('port', 'TEXT'),
+        ('number', 'TEXT'),
+        ('message', 'TEXT'),
+        ('parts', 'INTEGER'),
+        ('missing', 'INTEGER'), # parts of a long message that never arrived
+        ('sent_at', 'REAL'), # secs since the epoch, as the network stamped it
+        ('received_at', 'REAL'),
+    ]),
+])
+
+# (name, table, columns, unique).  A key that rows are upserted on needs a
+# unique index.  Other indexes named ix_ are dropped, they are from dataset
+# or an earlier version.  Listings are filtered on status or number and paged
+# newest first, so those end in created_at (and the implied id).
+INDEXES = [
+    ('ix_sms_request_status_created_at', 'sms', ('request_status', 'created_at'), False),
+    ('ix_sms_reference', 'sms', ('reference',), False),
+    ('ix_sms_number_created_at', 'sms', ('number', 'created_at'), False),
+    ('ix_sms_created_at', 'sms', ('created_at',), False),
+    ('ix_sms_idempotency_key', 'sms', ('idempotency_key',), False),
+    ('ix_settings_setting', 'settings', ('setting',), True),
+    ('ix_inbox_uid', 'inbox', ('uid',), True),
+    ('ix_inbox_received_at', 'inbox', ('received_at',), False),
+    ('ix_inbox_number_received_at', 'inbox', ('number', 'received_at'), False),
+]
+
+PRAGMAS = [
+    'journal_mode=WAL',
+    'synchronous=NORMAL', # a commit is lost only on power failure, never corrupted
+    'cache_size=-32000', # KiB
+    'temp_store=MEMORY',
+    'mmap_size=268435456',
+]
+
+# bound parameters per statement, below SQLITE_MAX_VARIABLE_NUMBER
+MAX_VARIABLES = 500
+
+# INSERT ... ON CONFLICT came with SQLite 3.24.  The sqlite3 DLL bundled with
+# some Python 2.7 builds is older, there a row is inserted if it is missing
+# and then updated.
+UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# messages per page of a listing
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# read-only connections kept open for queries
+READERS = 4
+
+def row_dict(cursor, row):
+    return dict(zip([c[0] for c in cursor.description], row))
+
+def sqlite_path(url):
+    if not url.startswith('sqlite://'):
+        raise ValueError('Only sqlite URLs are supported, not {}'.format(url))
+    return url[len('sqlite:///'):] or ':memory:'
+
+def find(db, table, search=None, limit=None, columns=None):
+    # rows as dicts whose columns equal the values in search
+    sql = 'SELECT * FROM {}'.format(table)
+    params = []
+    if search:
+        unknown = set(search) - (columns or set(column for column, kind in SCHEMA[table]))
+        if unknown:
+            raise ValueError('Unknown columns {} in table {}'.format(', '.join(sorted(unknown)), table))
+        names = sorted(search)
+        sql += ' WHERE ' + ' AND '.join('{}=?'.format(c) for c in names)
+        params = [search[c] for c in names]
+    if limit is not None:
+        sql += ' LIMIT {:d}'.format(limit)
+    return db.execute(sql, params).fetchall()
+
+def find_one(db, table, search, columns=None):
+    rows = find(db, table, search, 1, columns)
+    return rows[0] if rows else None
+
+def list_sms(db, statuses=None, number=None, since=None, until=None, after=None, limit=PAGE_SIZE):
+    '''A page of messages, newest first.  since and until bound created_at,
+    after is the (created_at, id) of the last message of the previous page.
+
+    Pages are keyset paginated on (created_at, id), which the indexes hold in
+    order, so a page deep into the table costs the same as the first.  Each
+    status is read on its own index and the results merged.  The row value
+    (created_at, id) < (?, ?) would need SQLite 3.15, so the comparison is
+    spelled out, with created_at <= ? first for the index to seek on.'''
+    where, params = [], []
+    if number is not None:
+        where.append('number=?')
+        params.append(number)
+    if since is not None:
+        where.append('created_at >= ?')
+        params.append(since)
+    if until is not None:
+        where.append('created_at < ?')
+        params.append(until)
+    if after is not None:
+        where.append('created_at <= ? AND (created_at < ? OR id < ?)')
+        params.extend((after[0], after[0], after[1]))
+    rows = []
+    for status in (statuses or [None]):
+        clauses, values = list(where), list(params)
+        if status is not None:
+            clauses.insert(0, 'request_status=?')
+            values.insert(0, status)
+        sql = 'SELECT id, request_status, number, message, segments, created_at FROM sms'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+        rows.extend(db.execute(sql, values + [limit]).fetchall())
+    if len(statuses or ()) > 1:
+        rows.sort(key=lambda row: (row['created_at'], row['id']), reverse=True)
+    return rows[:limit]
+
+def list_inbox(db, number=None, since=None, until=None, after=None, limit=PAGE_SIZE):
+    '''A page of received messages, newest first, paginated like list_sms
+    on (received_at, id).'''
+    where, params = [], []
+    if number is not None:
+        where.append('number=?')
+        params.append(number)
+    if since is not None:
+        where.append('received_at >= ?')
+        params.append(since)
+    if until is not None:
+        where.append('received_at < ?')
+        params.append(until)
+    if after is not None:
+        where.append('received_at <= ? AND (received_at < ? OR id < ?)')
+        params.extend((after[0], after[0], after[1]))
+    sql = 'SELECT id, port, number, message, parts, missing, sent_at, received_at FROM inbox'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY received_at DESC, id DESC LIMIT ?'
+    return db.execute(sql, params + [limit]).fetchall()
+
+class SQLiteStore(object):
+    '''Base of a store kept in a SQLite file and used from several
+    processes and threads, like the outbox.  Each process and thread gets
+    its own connection, which setup() prepares.  Pickled as the keyword
+    arguments of __init__ that settings() returns, so only those go to a
+    modem process.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.local = local()
+
+    def settings(self):
+        return dict(path=self.path)
+
+    def __getstate__(self):
+        return self.settings()
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def setup(self, conn):
+        pass
+
+    @property
+    def conn(self):
+        # a connection inherited through fork belongs to the parent, so it is not reused
+        pid, conn = getattr(self.local, 'conn', (None, None))
+        if pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self.setup(conn)
+            self.local.conn = (os.getpid(), conn)
+        return conn
+
+class ReaderPool(object):
+    '''Up to size read-only connections to the database, each used by one
+    caller at a time.  WAL mode gives every query a consistent snapshot
+    while SMSDatabase carries on writing, so reads neither wait for the
+    writer thread nor for each other.'''
+
+    def __init__(self, path, size=READERS):
+        self.path = path
+        self.size = size
+        self.idle = Queue.LifoQueue() # the most recently used has a warm cache
+        self.opened = 0
+        self.lock = Lock()
+        self.closed = False
+
+    def connect(self):
+        # handed between threads, but only ever used by one at a time
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        db.row_factory = row_dict
+        db.execute('PRAGMA query_only=ON')
+        db.execute('PRAGMA mmap_size=268435456')
+        return db
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            opening = self.opened < self.size
+            if opening:
+                self.opened += 1
+        if not opening:
+            return self.idle.get()
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def release(self, db):
+        if self.closed:
+            db.close()
+        else:
+            self.idle.put(db)
+
+    def run(self, fn, *args):
+        # fn(db, *args) on a connection of the pool, returns its result
+        db = self.acquire()
+        try:
+            return fn(db, *args)
+        finally:
+            self.release(db)
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+class SMSReader(object):
+    '''Runs queries of the web tier on a ReaderPool from threads of its own
+    and answers them with Futures, so the IOLoop never waits on the
+    database and the queries run alongside the writes of SMSDatabase.'''
+
+    def __init__(self, path, ioloop, size=READERS, logLevel=logging.WARNING):
+        self.pool = ReaderPool(path, size)
+        self.ioloop = ioloop
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.stopped = False
+        self.log = logging.getLogger('sgdatabase.SMSReader')
+        self.log.setLevel(logLevel)
+
+    def run(self, fn, *args):
+        # fn(db, *args) on the reader thread, resolves the returned Future
+        future = Future()
+        if self.stopped:
+            self.ioloop.add_callback(future.set_exception, Exception('Database reader stopped'))
+        else:
+            self.queue.put((future, fn, args))
+        return future
+
+    def get_one(self, search, tablename):
+        return self.run(find_one, tablename, search)
+
+    def list_sms(self, *args, **kwargs):
+        return self.run(lambda db: list_sms(db, *args, **kwargs))
+
+    def list_inbox(self, *args, **kwargs):
+        return self.run(lambda db: list_inbox(db, *args, **kwargs))
+
+    def read_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            future, fn, args = item
+            try:
+                result = self.pool.run(fn, *args)
+            except Exception as e:
+                self.log.error('Query failed %s', e.args, exc_info=True)
+                self.ioloop.add_callback(future.set_exception, e)
+            else:
+                self.ioloop.add_callback(future.set_result, result)
+
+    def start(self):
+        self.threads = [Thread(target=self.read_loop, name='SMSReaderThread-{}'.format(i))
+                        for i in range(self.pool.size)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, timeout=5):
+        # the queries not started yet fail, so no handler waits on them for good
+        self.stopped = True
+        dropped = 0
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not None:
+                self.ioloop.add_callback(item[0].set_exception, Exception('Database reader stopped'))
+                dropped += 1
+        if dropped:
+            self.log.warn('Stopped with %d queries waiting, failing them', dropped)
+        for thread in self.threads:
+            self.queue.put(None)
+        # the queries under way finish before their connections are closed
+        for thread in self.threads:
+            thread.join(timeout)
+        self.pool.close()
 
 class SMSDatabase(multiprocessing.Process):
     def __init__(self, 
                 url = 'sqlite:///' + ((os.path.dirname(sys.executable) + '/') if getattr(sys, 'frozen', False) else '')+"database.db",
-                tablenames=['sms','settings'],
-                logLevel=logging.WARNING):
+                tablenames=['sms','settings','archived','inbox'],
+                logLevel=logging.WARNING,
+                batch_size=500,
+                batch_wait=0.02):
         self.url = url
+        self.path = sqlite_path(url)
         self.tablenames = tablenames
         self.db = None
-        self.tables = {}
+        self.columns = {} # table -> names of its columns
+        self.statements = {} # SQL of the upserts already built
         self.queue = None
-        self.pipe = None
         self.thread = None
-        self.index = 0
-        self.index_updated = Event()
-        self.val = None
-        self.val_lock = Lock()
-        self.val_updated = Event()
+        self.connected = Event() # the tables exist and can be read
+        self.readers = ReaderPool(self.path) # for get and get_one
+        # group commit: at most batch_size writes or batch_wait secs per transaction
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.ack_ids = itertools.count(1)
+        self.acked = set()
+        self.ack_cond = Condition()
+        self.stats = sgmetrics.Counters('batches', 'writes', 'upserts') # shared with the web workers
+        self.write_time = sgmetrics.Histogram() # per committed batch
+        self.listeners = []
         log.setLevel(logLevel)
 
     def connect(self, url=None, tablenames=None):
-        url = url or self.url
+        path = sqlite_path(url) if url else self.path
         tablenames = tablenames or self.tablenames
-        self.db = dataset.connect(url)
+        # statements are prepared once and kept in the connection's cache
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, cached_statements=256)
+        self.db.row_factory = row_dict
+        self.set_auto_vacuum()
+        for pragma in PRAGMAS:
+            self.db.execute('PRAGMA ' + pragma)
         for name in tablenames:
-            self.tables[name] = self.db.get_table(name)
-            print self.tables[name] # need this extra print to initialize the database file with the table if empty initially
+            self.create_table(name)
+        self.create_indexes(tablenames)
+        if 'sms' in tablenames:
+            # listings page on created_at, messages accepted before it was
+            # recorded are listed as created at 0
+            self.db.execute('UPDATE sms SET created_at=0 WHERE created_at IS NULL')
+
+    def set_auto_vacuum(self):
+        # lets sgretention give the pages of archived messages back a few at
+        # a time.  A new file takes it as is, an older one keeps its mode
+        # until rebuild() is run on it.
+        self.db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+
+    def incremental_vacuum(self):
+        return self.db.execute('PRAGMA auto_vacuum').fetchone()['auto_vacuum'] == 2
+
+    def rebuild(self):
+        '''Rebuilds the database file with VACUUM, which switches one made
+        before incremental vacuum over to it.  Takes about as long as
+        copying the file and needs as much free space again, so it is only
+        run on request, with the server stopped (sgserver.py --vacuum).'''
+        if self.incremental_vacuum():
+            log.warn('%s uses incremental vacuum already', self.path)
+            return
+        log.warn('Rebuilding %s for incremental vacuum, this takes a while for a large file', self.path)
+        start = time.time()
+        self.db.execute('VACUUM')
+        log.warn('Rebuilt %s in %.1fs', self.path, time.time() - start)
+
+    def create_table(self, name):
+        self.db.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(name,
+            ', '.join('{} {}'.format(column, kind) for column, kind in SCHEMA[name])))
+        existing = [row['name'] for row in self.db.execute('PRAGMA table_info({})'.format(name))]
+        for column, kind in SCHEMA[name]:
+            if column not in existing:
+                log.info('Adding column %s to table %s', column, name)
+                self.db.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(name, column, kind))
+                existing.append(column)
+        self.columns[name] = set(existing)
+
+    def create_indexes(self, tablenames):
+        declared = set(index[0] for index in INDEXES)
+        for name in tablenames:
+            for row in self.db.execute('PRAGMA index_list({})'.format(name)).fetchall():
+                if row['name'].startswith('ix_') and row['name'] not in declared:
+                    self.db.execute('DROP INDEX {}'.format(row['name']))
+        for name, table, columns, unique in INDEXES:
+            if table in tablenames:
+                self.db.execute('CREATE {}INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                    'UNIQUE ' if unique else '', name, table, ', '.join(columns)))
+        self.db.execute('PRAGMA optimize')
 
     def get_one(self, search, tablename):
-        self.val_lock.acquire()
-        self.val_updated.clear()
-        self.queue.put((GET_VALUE,(search, tablename)))
-        self.val_updated.wait()
-        val = self.val
-        self.val_lock.release()
-        return val
+        # read on a connection of its own, not behind the writes queued
+        self.connected.wait()
+        return self.readers.run(find_one, tablename, search, self.columns[tablename])
 
     def get(self, search, tablename):
-        val = []
-        self.val_lock.acquire()
-        self.val_updated.clear()
-        self.queue.put((GET_ALL,(search, tablename)))
-        self.val_updated.wait()
-        for i in self.val:
-            val.append(i)
-        self.val_lock.release()
-        return val
+        self.connected.wait()
+        return self.readers.run(find, tablename, search, None, self.columns[tablename])
+
+    def last_id(self):
+        # the highest reference handed out, archived messages included
+        self.connected.wait()
+        row = self.readers.run(lambda db: db.execute('SELECT MAX(id) AS id FROM '
+            '(SELECT MAX(id) AS id FROM sms UNION ALL SELECT MAX(id) FROM archived)').fetchone())
+        return row['id'] or 0
    
-    def update_loop(self, queue, pipe):
+    def put(self, key, tablename, data, wait=False):
+        if not wait:
+            self.queue.put((PUT, (key, tablename, data)))
+            return
+        # wait until the batch holding this write has been committed
+        ack_id = next(self.ack_ids)
+        self.queue.put((PUT, (key, tablename, data, ack_id)))
+        with self.ack_cond:
+            while ack_id not in self.acked:
+                self.ack_cond.wait()
+            self.acked.discard(ack_id)
+
+    def add_listener(self, listener):
+        # listener(table, data) is called from the database thread for every
+        # row written, after its batch has been committed
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def collect_batch(self, batch):
+        # drain waiting PUTs into one batch.  Any other action ends the batch
+        # and is handed back so it runs after the batch has been committed.
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    action, payload = self.queue.get(timeout=remaining)
+                else:
+                    action, payload = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if action in PUT_ACTIONS:
+                batch.extend(self.expand(action, payload))
+            else:
+                return batch, (action, payload)
+        return batch, None
+
+    def expand(self, action, payload):
+        # batch items are (key, table, data, ack_id, new)
+        if action in (PUT, INSERT):
+            key, table, data = payload[:3]
+            ack_id = payload[3] if len(payload) > 3 else None
+            return [(key, table, data, ack_id, action == INSERT)]
+        key, table, rows = payload
+        return [(key, table, data, None, action == INSERT_MANY) for data in rows]
+
+    def upsert_sql(self, table, key, columns, new):
+        # (sql, columns bound) of the statements upserting one set of columns,
+        # kept so each is built once.  A new row does not overwrite a
+        # request_status written already.
+        statements = self.statements.get((table, key, columns, new))
+        if statements is None:
+            unknown = set(columns) - self.columns[table]
+            if unknown:
+                raise ValueError('Unknown columns {} in table {}'.format(', '.join(sorted(unknown)), table))
+            updated = [c for c in columns if c != key and not (new and c == 'request_status')]
+            if UPSERT:
+                sql = 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT({}) DO '.format(
+                    table, ', '.join(columns), ', '.join('?' * len(columns)), key)
+                if updated:
+                    sql += 'UPDATE SET ' + ', '.join('{0}=excluded.{0}'.format(c) for c in updated)
+                else:
+                    sql += 'NOTHING'
+                statements = [(sql, columns)]
+            else:
+                statements = [('INSERT OR IGNORE INTO {} ({}) VALUES ({})'.format(
+                    table, ', '.join(columns), ', '.join('?' * len(columns))), columns)]
+                if updated:
+                    statements.append(('UPDATE {} SET {} WHERE {}=?'.format(
+                        table, ', '.join('{}=?'.format(c) for c in updated), key), tuple(updated) + (key,)))
+            self.statements[(table, key, columns, new)] = statements
+        return statements
+
+    def existing(self, table, key, values):
+        # the values of key that are in table already
+        found = set()
+        values = list(values)
+        for i in range(0, len(values), MAX_VARIABLES):
+            chunk = values[i:i+MAX_VARIABLES]
+            sql = 'SELECT {0} FROM {1} WHERE {0} IN ({2})'.format(key, table, ', '.join('?' * len(chunk)))
+            found.update(row[key] for row in self.db.execute(sql, chunk))
+        return found
+
+    def write_rows(self, rows):
+        # rows are ((table, key, value), (data, new)).  Returns the (table, data)
+        # written, without the status of a new row that had one already.
+        groups = OrderedDict()
+        for (table, key, _), (data, new) in rows:
+            columns = tuple(sorted(data))
+            groups.setdefault((table, key, columns, new), []).append(data)
+        written = []
+        for (table, key, columns, new), group in groups.items():
+            kept = set()
+            if new and 'request_status' in columns:
+                kept = self.existing(table, key, [data[key] for data in group])
+            for sql, bound in self.upsert_sql(table, key, columns, new):
+                self.db.executemany(sql, [[data[c] for c in bound] for data in group])
+            for data in group:
+                if data[key] in kept:
+                    data = dict((k, v) for k, v in data.items() if k != 'request_status')
+                written.append((table, data))
+        return written
+
+    def write_batch(self, batch):
+        if not batch:
+            return
+        # coalesce multiple updates to the same row into a single upsert
+        rows = OrderedDict()
+        ack_ids = []
+        for key, table, data, ack_id, new in batch:
+            if ack_id is not None:
+                ack_ids.append(ack_id)
+            row_id = (table, key, data[key])
+            if row_id not in rows:
+                rows[row_id] = [dict(data), new]
+            elif new:
+                # the row arrived after an update to it, the update wins
+                merged = dict(data)
+                merged.update(rows[row_id][0])
+                rows[row_id] = [merged, new and rows[row_id][1]]
+            else:
+                rows[row_id][0].update(data)
+                rows[row_id][1] = False
+        start = time.time()
+        self.db.execute('BEGIN')
+        try:
+            written = self.write_rows(rows.items())
+            self.db.execute('COMMIT')
+        except Exception as e:
+            self.db.execute('ROLLBACK')
+            log.warn('Batch of %d writes failed, retrying one by one %s', len(batch), e.args)
+            written = []
+            for row in rows.items():
+                try:
+                    written.extend(self.write_rows([row]))
+                except Exception as e:
+                    (table, key, _), (data, new) = row
+                    log.error('Put request failed for %s=%s %s', key, data.get(key), e.args, exc_info=True)
+        self.write_time.observe(time.time() - start)
+        self.stats['batches'] += 1
+        self.stats['writes'] += len(batch)
+        self.stats['upserts'] += len(rows)
+        for listener in list(self.listeners):
+            for table, data in written:
+                try:
+                    listener(table, data)
+                except Exception as e:
+                    log.error('Listener failed %s', e.args, exc_info=True)
+        if ack_ids:
+            with self.ack_cond:
+                self.acked.update(ack_ids)
+                self.ack_cond.notify_all()
+        log.debug("Put batch of %d writes as %d upserts", len(batch), len(rows))
+
+    def find(self, table, search=None, limit=None):
+        return find(self.db, table, search, limit, self.columns[table])
+
+    def find_one(self, table, search):
+        return find_one(self.db, table, search, self.columns[table])
+
+    def update_loop(self, queue):
         self.connect()
+        self.connected.set()
 
+        pending = None
         while True:
-            action, payload = self.queue.get()
+            if pending is None:
+                action, payload = self.queue.get()
+            else:
+                action, payload = pending
+                pending = None
 
             # Exit requested
             if action == EXIT:
                 log.debug("Exiting")
+                self.readers.close()
                 break
             # Put requested
-            elif action == PUT:
+            elif action in PUT_ACTIONS:
                 log.debug("Received put request")
-                key, table, data = payload
-                self.tables[table].upsert(data, [key])
+                batch, pending = self.collect_batch(self.expand(action, payload))
+                self.write_batch(batch)
                 log.debug("Put request successful")
-            # Update the index number used for getting the reference numbers
-            elif action == UPDATE_INDEX:
-                table = payload
-                if self.tables[table].count():
-                    self.index = self.tables[table].find_one(order_by='-id')['id']
-                else:
-                    self.index = 0
-                self.index_updated.set()
-            elif action == GET_VALUE:
-                search, table = payload
-                self.val = self.tables[table].find_one(**search)
-                self.val_updated.set()
-            elif action == GET_ALL:
-                search, table = payload
-                if search:
-                    results = self.tables[table].find(**search)
-                else: # is None
-                    results = self.tables[table].find()
-                self.val = []
-                for i in results:
-                    self.val.append(i)
-                self.val_updated.set()
-            else: # Get request
-                log.debug("Received get request")
-                search, table = payload
-                results = self.tables[table].find_one(**search)
-                log.debug("Get request successful for %s",search)
-                self.pipe.send(results)
-                log.debug("Results sent for %s",search)
-
-
-    def start_thread(self, queue=None, pipe=None):
-        # make sure to start the thread with a valid queue and response pipe
+            else:
+                log.warn('Unknown action %s', action)
+
+
+    def start_thread(self, queue=None):
+        # make sure to start the thread with a valid queue
         if queue is None:
             if self.queue is None:
                 log.error('No queue received to start')
@@ -115,16 +661,9 @@ class SMSDatabase(multiprocessing.Process):
             queue = self.queue
         else:
             self.queue = queue
-        if pipe is None:
-            if self.pipe is None:
-                log.error('No pipe received to start')
-                raise Exception
-            pipe = self.pipe
-        else:
-            self.pipe = pipe
 
         log.debug('Server starting')
-        self.thread = Thread(target=self.update_loop, args=(queue, pipe), name='SMSDatabaseThread')
+        self.thread = Thread(target=self.update_loop, args=(queue,), name='SMSDatabaseThread')
         self.thread.start()
         log.debug('Server started')
 
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import unicodedata
+
+GSM7 = 'gsm7'
+UCS2 = 'ucs2'
+
+# GSM 03.38 default alphabet, and the extension table whose characters take two septets
+GSM7_BASIC = set(u'@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+                 u'¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà')
+GSM7_EXTENDED = set(u'^{}\\[~]|€\f')
+
+# characters per single message and per part of a concatenated message
+GSM7_SINGLE, GSM7_PART = 160, 153
+UCS2_SINGLE, UCS2_PART = 70, 67
+
+# common characters typed by phones and word processors that have a GSM-7 lookalike
+TRANSLITERATIONS = {
+    u'‘': u"'", u'’': u"'", u'‚': u"'", u'‛': u"'", u'′': u"'",
+    u'“': u'"', u'”': u'"', u'„': u'"', u'‟': u'"', u'″': u'"',
+    u'–': u'-', u'—': u'-', u'―': u'-', u'‐': u'-', u'−': u'-',
+    u'…': u'...', u'•': u'*', u'\u00a0': u' ', u'\t': u' ',
+    u'«': u'"', u'»': u'"', u'‹': u"'", u'›': u"'",
+}
+
+def is_gsm7(char):
+    return char in GSM7_BASIC or char in GSM7_EXTENDED
+
+def transliterate(text):
+    '''Replace characters outside GSM-7 with a GSM-7 lookalike where there is one,
+    so the message is not sent as UCS-2.'''
+    result = []
+    for char in text:
+        if is_gsm7(char):
+            result.append(char)
+        elif char in TRANSLITERATIONS:
+            result.append(TRANSLITERATIONS[char])
+        else:
+            # drop accents the GSM-7 alphabet does not have, i.e. â becomes a
+            base = u''.join(c for c in unicodedata.normalize('NFKD', char) if not unicodedata.combining(c))
+            result.append(base if base and all(is_gsm7(c) for c in base) else char)
+    return u''.join(result)
+
+def segments(length, single, part):
+    if length <= single:
+        return 1
+    return (length + part - 1) // part
+
+def analyse(text, transliterate_text=False):
+    '''Returns (text, encoding, segments) for the message as it will be sent.'''
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    if transliterate_text:
+        text = transliterate(text)
+    if all(is_gsm7(char) for char in text):
+        septets = sum(2 if char in GSM7_EXTENDED else 1 for char in text)
+        return text, GSM7, segments(septets, GSM7_SINGLE, GSM7_PART)
+    # characters outside the basic multilingual plane take two UTF-16 code units
+    units = sum(2 if ord(char) > 0xFFFF else 1 for char in text)
+    return text, UCS2, segments(units, UCS2_SINGLE, UCS2_PART)
@@ -0,0 +1,38 @@
+import logging, time
+import sgdatabase
+
+log = logging.getLogger('sginbox.Inbox')
+
+class Inbox(sgdatabase.SQLiteStore):
+    '''Messages the modems received, in the inbox table of the SMS database
+    which SMSDatabase creates.
+
+    A modem process writes what it read from the modem here itself, in one
+    transaction per read, and only deletes the messages from the modem
+    once they are committed.  So a crash in between stores a message twice
+    at worst, which the unique uid of each message turns into once.'''
+
+    def setup(self, conn):
+        conn.execute('PRAGMA synchronous=FULL')
+
+    def add(self, rows):
+        '''rows of (uid, port, number, message, parts, missing, sent_at,
+        received_at) written in one transaction.  Returns how many were new,
+        a uid stored before is skipped.'''
+        conn = self.conn
+        start = time.time()
+        before = conn.total_changes
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT OR IGNORE INTO inbox (uid, port, number, message, parts, missing, sent_at, '
+                             'received_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        added = conn.total_changes - before
+        log.debug('Stored %d of %d messages received in %.3fs', added, len(rows), time.time() - start)
+        return added
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM inbox').fetchone()[0]
@@ -0,0 +1,148 @@
+import multiprocessing, bisect, threading
+
+# upper bounds in secs of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram(object):
+    '''Latency histogram kept in shared memory.
+
+    Made before the modem processes start, it can be observed in a modem and
+    read by the web server without any message passing.  Only one process
+    may observe a histogram, so it needs no lock.'''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # a count per bucket, one for values above the last bucket, then the sum
+        self.values = multiprocessing.RawArray('d', len(buckets) + 2)
+
+    def observe(self, value):
+        self.values[bisect.bisect_left(self.buckets, value)] += 1
+        self.values[-1] += value
+
+    def cumulative(self):
+        # (upper bound, count of values up to it) per bucket, ending with +Inf
+        counts = self.values[:-1]
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    @property
+    def count(self):
+        return sum(self.values[:-1])
+
+    @property
+    def sum(self):
+        return self.values[-1]
+
+class Counters(object):
+    '''Named counters in shared memory, used like a dict of numbers.  Like
+    Histogram, each is written by one process only.'''
+
+    def __init__(self, *names):
+        self.names = names
+        self.values = multiprocessing.RawArray('d', len(names))
+
+    def keys(self):
+        return list(self.names)
+
+    def __getitem__(self, name):
+        return self.values[self.names.index(name)]
+
+    def __setitem__(self, name, value):
+        self.values[self.names.index(name)] = value
+
+class RequestStats(object):
+    '''Latency histogram and response code counts per handler of one web
+    process.  Made for every web worker before they are forked, so any of
+    them can report on all.  Handlers not named up front are only seen by
+    the worker that served them.'''
+
+    def __init__(self, names):
+        self.times = dict((name, Histogram()) for name in names)
+        # a count per status code from 100 to 599
+        self.codes = dict((name, multiprocessing.RawArray('d', 500)) for name in names)
+
+    def observe(self, name, seconds, code):
+        if name not in self.times:
+            self.times[name] = Histogram()
+            self.codes[name] = multiprocessing.RawArray('d', 500)
+        self.times[name].observe(seconds)
+        if 100 <= code < 600:
+            self.codes[name][code - 100] += 1
+
+    def code_counts(self):
+        # ((name, code), count) of the codes given at least once
+        return [((name, i + 100), count) for name, counts in sorted(self.codes.items())
+                for i, count in enumerate(counts) if count]
+
+class ValueCounts(object):
+    '''Database listener counting the values written to one column of a
+    table, i.e. every request_status an sms goes through.'''
+
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def update(self, table, data):
+        if table != self.table or self.column not in data:
+            return
+        with self.lock:
+            value = data[self.column]
+            self.counts[value] = self.counts.get(value, 0) + 1
+
+    def items(self):
+        with self.lock:
+            return sorted(self.counts.items())
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in sorted(labels.items()))
+    return '{' + ','.join(escaped) + '}'
+
+class Exposition(object):
+    '''Builds the Prometheus text format, one metric family at a time.'''
+
+    def __init__(self, prefix='smsgateway_'):
+        self.prefix = prefix
+        self.lines = []
+
+    def family(self, name, kind, help, samples):
+        # samples are (labels, value) pairs
+        name = self.prefix + name
+        self.lines.append('# HELP {} {}'.format(name, help))
+        self.lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in samples:
+            self.lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+
+    def counter(self, name, help, samples):
+        self.family(name, 'counter', help, samples)
+
+    def gauge(self, name, help, samples):
+        self.family(name, 'gauge', help, samples)
+
+    def histogram(self, name, help, samples):
+        # samples are (labels, Histogram) pairs
+        name = self.prefix + name
+        self.lines.append('# HELP {} {}'.format(name, help))
+        self.lines.append('# TYPE {} histogram'.format(name))
+        for labels, histogram in samples:
+            for bound, count in histogram.cumulative():
+                self.lines.append('{}_bucket{} {}'.format(name, format_labels(dict(labels, le=format_value(bound))),
+                                                          format_value(count)))
+            self.lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(histogram.sum)))
+            self.lines.append('{}_count{} {}'.format(name, format_labels(labels), format_value(histogram.count)))
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
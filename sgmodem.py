@@ -1,9 +1,13 @@
-import multiprocessing, Queue, types, logging, time, threading, weakref, sys, os
+import multiprocessing, Queue, logging, time, threading, sys, os, heapq, signal, re, calendar, hashlib
+from collections import deque
 from gsmmodem.util import parseTextModeTimeStr
+from gsmmodem.pdu import decodeSmsPdu, Concatenation
 import gsmmodem
 from serial import SerialException
-from gsmmodem.exceptions import CommandError, InvalidStateException, CmeError, CmsError, InterruptedException, TimeoutException, PinRequiredError, IncorrectPinError, SmscNumberUnknownError
+from gsmmodem.exceptions import CommandError, CmeError, CmsError, TimeoutException, EncodingError
 import sgdatabase
+import sgmetrics
+import sgatmodem
 
 UNKNOWNERROR= -99 # Unknown error
 CMS_ERROR = -4 # Modem reported CMS Error
@@ -14,14 +18,372 @@ ENROUTE = gsmmodem.modem.SentSms.ENROUTE # Status indicating message is still en
 DELIVERED = gsmmodem.modem.SentSms.DELIVERED # Status indicating message has been received by destination handset
 FAILED = gsmmodem.modem.SentSms.FAILED # Status indicating message delivery has failed
 
-# bug fix to support T35i modem
-def _deleteStoredSms(self, index, memory=None):
-    self._setSmsMemory(readDelete=memory)
-    self.write('AT+CMGD={0}'.format(index))
-    
+STATUS_NAMES = {UNKNOWNERROR: 'UNKNOWNERROR', CMS_ERROR: 'CMS_ERROR', CME_ERROR: 'CME_ERROR',
+    MODEMDISCONNECTED: 'MODEMDISCONNECTED', QUEUED: 'QUEUED', ENROUTE: 'ENROUTE',
+    DELIVERED: 'DELIVERED', FAILED: 'FAILED'}
+
+# Statuses after which a message will not change any more
+FINAL_STATUSES = (DELIVERED, FAILED, CMS_ERROR, CME_ERROR, MODEMDISCONNECTED, UNKNOWNERROR)
+
+# priority lanes of the send queue, lower values are sent first
+HIGH = 0
+NORMAL = 1
+LOW = 2
+PRIORITIES = {'high': HIGH, 'normal': NORMAL, 'low': LOW}
+
+# messages handed to the modem driver at once: the one being submitted and
+# the next, already encoded to go out as soon as the modem is done
+PIPELINE = 2
+
+def make_message(number, text, requestID, priority=NORMAL, segments=1):
+    # queued_at lets the modem report how long each lane waited,
+    # segments is what the message costs against the send rate
+    return (number, text, requestID, priority, time.time(), segments)
+
+class TokenBucket(object):
+    """Allows rate sends per sec on average with bursts of up to burst sends.
+    A rate of 0 means no limit."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now, cost=1):
+        # secs until cost sends are allowed
+        if not self.rate:
+            return 0.0
+        self.refill(now)
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+    def consume(self, now, cost=1):
+        if self.rate:
+            self.refill(now)
+            self.tokens -= cost
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+    def configure(self, now, rate, burst):
+        # tokens gathered at the old rate are kept, up to the new burst
+        self.refill(now)
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.tokens = min(self.tokens, self.burst)
+
+def rate(interval):
+    interval = float(interval or 0)
+    return 1.0 / interval if interval > 0 else 0
+
+# most destination buckets kept before idle ones are dropped
+MAX_NUMBER_BUCKETS = 10000
+
+# TP-Status values of delivery reports below this mean delivered, up to
+# REPORT_TEMPORARY_END the network is still trying, above it delivery failed
+REPORT_COMPLETED_END = 0x20
+REPORT_TEMPORARY_END = 0x40
+
+class SentRecord(object):
+    """A message the modem has submitted, kept until its delivery report."""
+    __slots__ = ('reference', 'number', 'requestID', 'sent_at', 'done')
+
+    def __init__(self, reference, number, requestID, sent_at):
+        self.reference = reference
+        self.number = number
+        self.requestID = requestID
+        self.sent_at = sent_at
+        self.done = False
+
+def number_key(number):
+    # the same number may be written with a country code or a trunk prefix, so
+    # only the last digits are compared
+    return ''.join(c for c in (number or '') if c.isdigit())[-9:]
+
+class InflightTracker(object):
+    """Messages waiting for a delivery report, indexed by the TP-MR reference
+    the modem gave them.  The reference wraps at 256, so several messages may
+    share one; a report is matched to the oldest one sent to the same number
+    within max_age secs.  At most max_entries records are kept, the oldest are
+    dropped first."""
+
+    def __init__(self, max_entries=10000, max_age=3*24*3600):
+        self.max_entries = int(max_entries)
+        self.max_age = float(max_age)
+        self.by_reference = dict() # reference -> deque of records, oldest first
+        self.by_age = deque() # all records, oldest first, done ones removed lazily
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def add(self, reference, number, requestID):
+        record = SentRecord(reference, number_key(number), requestID, time.time())
+        with self.lock:
+            self.by_reference.setdefault(reference, deque()).append(record)
+            self.by_age.append(record)
+            self.size += 1
+            self.evict(record.sent_at)
+
+    def evict(self, now):
+        while self.by_age:
+            oldest = self.by_age[0]
+            if not oldest.done and self.size <= self.max_entries and oldest.sent_at + self.max_age > now:
+                break
+            self.by_age.popleft()
+            if not oldest.done:
+                self.remove(oldest)
+        # matched records behind an old one still waiting are only skipped
+        # lazily, so they are dropped in one go before they pile up
+        if len(self.by_age) > 2 * max(self.size, self.max_entries):
+            self.by_age = deque(record for record in self.by_age if not record.done)
+
+    def remove(self, record):
+        record.done = True
+        self.size -= 1
+        records = self.by_reference[record.reference]
+        records.remove(record)
+        if not records:
+            del self.by_reference[record.reference]
+
+    def match(self, reference, number, final=True):
+        """Returns the requestID a delivery report belongs to, or None.  Only
+        a final report stops the message from being tracked."""
+        key = number_key(number)
+        with self.lock:
+            self.evict(time.time())
+            for record in self.by_reference.get(reference, ()):
+                if record.number == key:
+                    if final:
+                        self.remove(record)
+                    return record.requestID
+        return None
+
+    def __len__(self):
+        return self.size
+
+# secs between reads of the messages stored on the modem when no +CMTI
+# announces one, and after a +CMTI before reading so the parts of a long
+# message that arrive together are read together
+INBOUND_POLL = 60
+INBOUND_SETTLE = 0.5
+# most secs a read waits for the messages being sent to go out first
+INBOUND_MAX_WAIT = 30
+# secs the parts of a long message stay on the modem waiting for the rest,
+# after that what arrived is stored with the number of parts missing
+PARTS_TIMEOUT = 24*3600
+
+def epoch(timestamp):
+    # secs since the epoch of a timestamp decoded from a PDU, which carries its zone
+    return calendar.timegm(timestamp.utctimetuple()) if timestamp is not None else None
+
+class InboundReader(object):
+    """Moves the messages a modem received to the inbox, on a thread of its
+    own in the modem process.
+
+    Instead of reading each message as its +CMTI arrives, everything in a
+    memory is listed with one AT+CMGL, the parts of long messages are put
+    back together, the messages are written to the inbox in one transaction
+    and then deleted from the modem with one AT+CMGD=1,1, which deletes
+    the messages read and leaves any that arrived meanwhile.  Reads wait for
+    the messages being sent to go out and then queue behind them, so sending
+    does not wait on reading."""
+
+    def __init__(self, modem, inbox, port, received, log, poll=INBOUND_POLL):
+        self.modem = modem # sgatmodem.ATModem
+        self.inbox = inbox # sginbox.Inbox
+        self.port = port
+        self.received = received # counter of the messages stored
+        self.log = log
+        self.poll = poll
+        self.memories = set() # memories messages are received in
+        self.first_seen = {} # (number, reference, parts) -> time the first part was read
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.read_loop, name='InboundReaderThread')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=sgatmodem.COMMAND_TIMEOUT):
+        self.stopped.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def notify(self, memory, index):
+        # a +CMTI, called on the reader thread of the driver
+        self.memories.add(memory)
+        self.wake.set()
+
+    def read_loop(self):
+        try:
+            # +CPMS: "SM",3,100,... where new messages are stored
+            cpms = [line for line in self.modem.command('AT+CPMS?') if line.startswith('+CPMS:')]
+            self.memories.update(re.findall(r'"([^"]+)"', cpms[0])[-1:] if cpms else ['SM'])
+        except (CommandError, TimeoutException) as e:
+            self.log.warn('Unable to query the message memories, reading SM %s', e)
+            self.memories.add('SM')
+        # messages received while the gateway was down are read straight away
+        while not self.stopped.is_set():
+            for memory in sorted(self.memories):
+                if self.stopped.is_set():
+                    break
+                try:
+                    self.read(memory)
+                except (CommandError, TimeoutException, SerialException, OSError) as e:
+                    self.log.warn('Unable to read the messages received in %s %s', memory, e)
+                except Exception as e:
+                    self.log.error('Error reading the messages received in %s %s', memory, e.args, exc_info=True)
+            self.wake.wait(self.poll)
+            self.stopped.wait(INBOUND_SETTLE)
+            self.wake.clear()
+            self.modem.wait_idle(INBOUND_MAX_WAIT)
+
+    def read(self, memory):
+        start = time.time()
+        listed = self.modem.commands('AT+CPMS="{}"'.format(memory), 'AT+CMGL=4',
+                                     timeout=sgatmodem.SEND_TIMEOUT)[1]
+        # +CMGL: <index>,<stat>,[<alpha>],<length> followed by the PDU
+        entries = []
+        for i, line in enumerate(listed[:-1]):
+            if line.startswith('+CMGL:'):
+                entries.append((int(line[6:].split(',')[0]), listed[i + 1]))
+        if not entries:
+            return
+        now = time.time()
+        rows, handled, parts = [], [], {}
+        for index, pdu in entries:
+            try:
+                sms = decodeSmsPdu(pdu)
+            except EncodingError as e:
+                self.log.warn('Unable to decode message %s at %d %s', memory, index, e.args)
+                continue
+            if sms.get('type') != 'SMS-DELIVER':
+                continue # a status report is read on its +CDSI
+            concat = [ie for ie in sms.get('udh', ()) if isinstance(ie, Concatenation)]
+            if concat:
+                key = (sms['number'], concat[0].reference, concat[0].parts)
+                parts.setdefault(key, []).append((concat[0].number, index, sms))
+                continue
+            rows.append(self.row(sms['number'], sms['text'], 1, 0, sms['time'], None, now))
+            handled.append(index)
+        for key, found in parts.items():
+            number, reference, count = key
+            first_seen = self.first_seen.setdefault(key, now)
+            texts = dict((seq, sms) for seq, index, sms in found)
+            missing = count - len(texts)
+            if missing and now - first_seen < PARTS_TIMEOUT:
+                continue # left on the modem for the rest to arrive
+            if missing:
+                self.log.warn('%d of %d parts of a message from %s never arrived', missing, count, number)
+            text = u''.join(texts[seq]['text'] for seq in sorted(texts))
+            sent = texts[min(texts)]['time']
+            rows.append(self.row(number, text, count, missing, sent, reference, now))
+            handled.extend(index for seq, index, sms in found)
+            del self.first_seen[key]
+        if rows:
+            added = self.inbox.add(rows)
+            self.received.value += added
+            self.log.info('Stored %d messages received in %s, %d new, in %.3fs',
+                          len(rows), memory, added, time.time() - start)
+        if not handled:
+            return
+        # what was listed is marked read, so the read ones go all at once
+        # unless some are to stay
+        if len(handled) == len(entries):
+            try:
+                self.modem.commands('AT+CPMS="{}"'.format(memory), 'AT+CMGD=1,1')
+                return
+            except CommandError as e:
+                self.log.info('Unable to delete the messages read at once, deleting them one by one %s', e)
+        self.modem.commands('AT+CPMS="{}"'.format(memory),
+                            *['AT+CMGD={}'.format(index) for index in sorted(handled)])
+
+    def row(self, number, text, parts, missing, sent, reference, now):
+        sent_at = epoch(sent)
+        uid = hashlib.sha1(u'{}|{}|{}|{}'.format(number, sent_at, reference, text).encode('utf-8')).hexdigest()
+        return (uid, self.port, number, text, parts, missing, sent_at, now)
+
+# states of a modem as seen by the dispatcher
+CONNECTING = 0
+CONNECTED = 1
+DISCONNECTED = 2
+
+class ModemStats(object):
+    """Counters of a ModemServer kept in shared memory so the dispatcher in
+    the parent process can read them without asking the modem process."""
+
+    def __init__(self):
+        self.state = multiprocessing.Value('i', CONNECTING)
+        self.queued = multiprocessing.Value('i', 0) # dispatched but not yet processed
+        self.sent = multiprocessing.Value('i', 0)
+        self.failed = multiprocessing.Value('i', 0)
+        self.last_sent = multiprocessing.Value('d', 0.0)
+        self.inflight = multiprocessing.Value('i', 0) # sent and waiting for a delivery report
+        # queue wait per priority lane
+        self.wait_count = multiprocessing.Array('i', len(PRIORITIES))
+        self.wait_total = multiprocessing.Array('d', len(PRIORITIES))
+        self.wait_max = multiprocessing.Array('d', len(PRIORITIES))
+        # only written by the modem process, so these need no lock
+        self.send_time = sgmetrics.Histogram() # AT+CMGS round trips of a message, all parts
+        self.at_time = dict((name, sgmetrics.Histogram()) for name in sgatmodem.TIMED_COMMANDS + ('other',))
+        self.throttle_time = multiprocessing.RawValue('d', 0.0) # secs slept for the send rate limit
+        self.throttle_count = multiprocessing.RawValue('i', 0)
+        self.connect_time = multiprocessing.RawValue('d', 0.0) # secs the last connect took
+        self.received = multiprocessing.RawValue('i', 0) # messages received stored in the inbox
+
+    def dispatched(self, count=1):
+        with self.queued.get_lock():
+            self.queued.value += count
+
+    def dropped(self):
+        # dispatched but not sent by this modem
+        with self.queued.get_lock():
+            self.queued.value -= 1
+
+    def done(self, ok):
+        with self.queued.get_lock():
+            self.queued.value -= 1
+        counter = self.sent if ok else self.failed
+        with counter.get_lock():
+            counter.value += 1
+        self.last_sent.value = time.time()
+
+    def waited(self, priority, secs):
+        with self.wait_count.get_lock():
+            self.wait_count[priority] += 1
+            self.wait_total[priority] += secs
+            self.wait_max[priority] = max(self.wait_max[priority], secs)
+
+    def throttled(self, secs):
+        self.throttle_time.value += secs
+        self.throttle_count.value += 1
+
+    def lanes(self):
+        lanes = {}
+        for name, priority in PRIORITIES.items():
+            count = self.wait_count[priority]
+            lanes[name] = dict(count=count, max_wait=self.wait_max[priority],
+                            avg_wait=(self.wait_total[priority] / count) if count else 0.0)
+        return lanes
+
+    def as_dict(self):
+        return dict(state=self.state.value, queued=self.queued.value, sent=self.sent.value,
+                    failed=self.failed.value, last_sent=self.last_sent.value, inflight=self.inflight.value,
+                    lanes=self.lanes())
+
 class ModemServer(multiprocessing.Process):
 
-    def __init__(self, input_queue, output_queue, exitEvent, commPort, min_send_interval=None, logLevel=logging.WARNING, logConfig={}):
+    def __init__(self, input_queue, output_queue, exitEvent, commPort, min_send_interval=None, logLevel=logging.WARNING, logConfig={},
+                max_skip=10, send_burst=1, number_send_interval=0, number_burst=1, outbox=None,
+                inflight_max=10000, inflight_max_age=3*24*3600, drain_timeout=30, inbox=None):
         multiprocessing.Process.__init__(self)
         self.input_queue = input_queue
         self.output_queue = output_queue
@@ -31,46 +393,264 @@ class ModemServer(multiprocessing.Process):
         self.log = None
         self.logLevel = logLevel
         self.logConfig = logConfig
-        self.sentSms = dict()
+        self.sentSms = InflightTracker(inflight_max, inflight_max_age)
+        # messages received but not yet sent, one lane per priority
+        self.lanes = [deque() for priority in PRIORITIES]
+        # a lane passed over max_skip times for a higher one is served next
+        self.max_skip = int(max_skip)
+        self.skipped = [0] * len(PRIORITIES)
         self.min_send_interval = min_send_interval or 0
+        # sends are paced by a token bucket for the modem and optionally one per number
+        self.bucket = TokenBucket(rate(self.min_send_interval), send_burst)
+        self.number_rate = rate(number_send_interval)
+        self.number_burst = number_burst
+        self.number_buckets = dict()
+        self.deferred = [] # heap of (time allowed, message) held back for their number
         self.connected = False
+        self.stats = ModemStats()
+        self.outbox = outbox # sgoutbox.Outbox keeping queued messages across restarts
+        # secs to keep sending after the exit event, what is left stays in the outbox
+        self.drain_timeout = float(drain_timeout)
+        self.drain_until = None
+        self.inbox = inbox # sginbox.Inbox the messages received go to, None leaves them on the modem
+        self.inbound = None
 
     def connect(self, port, baudrate=115200):
+        start = time.time()
         try:
             self.log.debug('Connecting modem')
-            self.modem = gsmmodem.GsmModem(port, baudrate, smsStatusReportCallback=self.msgSentCallback, requestDelivery=False)
-            self.modem.smsTextMode = False
+            self.modem = sgatmodem.ATModem(port, baudrate, on_report=self.msgSentCallback,
+                                           on_message=self.msgReceived, on_lost=self.modemLost,
+                                           timings=self.stats.at_time)
             self.reset_logger(self.modem.log, logConfig=self.logConfig)
-            self.modem.deleteStoredSms = types.MethodType(_deleteStoredSms, self.modem) # bug fix to support T35i modem
             self.modem.connect()
             self.connected = True
-            self.log.debug('Connected modem')
+            self.log.info('Connected modem on %s in %.2fs', port, time.time() - start)
+            if self.inbox is not None:
+                self.inbound = InboundReader(self.modem, self.inbox, port, self.stats.received, self.log)
+                self.inbound.start()
         except SerialException as e:
             self.log.warn("Unable to connect to COM port=%s.  Please check your settings.  Only loopback SMS will work. msg=%s", self.commPort, e.message)
+            self.modem.close(0)
+        except (CommandError, TimeoutException) as e:
+            self.log.warn("Modem on COM port=%s did not answer as expected.  Only loopback SMS will work. msg=%s", self.commPort, e)
+            self.modem.close(0)
+        self.stats.connect_time.value = time.time() - start
 
     def close(self):
-        if self.connected:
+        if self.inbound is not None:
+            self.inbound.stop()
+            self.inbound = None
+        if self.modem is not None:
             self.modem.close()
+            self.modem = None
+        if self.connected:
             self.connected = False
+            self.stats.state.value = DISCONNECTED
+
+    def modemLost(self, error):
+        # the port failed, the messages after this are reported MODEMDISCONNECTED
+        self.connected = False
+        self.stats.state.value = DISCONNECTED
+
+    def msgReceived(self, memory, index):
+        if self.inbound is not None:
+            self.inbound.notify(memory, index)
 
     def sendMsg(self, number, text, requestID):
+        # encodes the message and queues it behind the one the modem is
+        # submitting, sent() gets the outcome
         try:
-            sms = self.modem.sendSms(number, text)
-            self.log.debug('Message sent with status=%d', sms.status)
-        except CmsError as e:
-            self.log.warn('CMS error occured: %s %s', e.message, e.args, exc_info=True)
-            sms = None
-            self.output_queue.put((sgdatabase.PUT, ('id', 'sms', dict(id=requestID, request_status=CMS_ERROR))))
-        except CmeError as e:
-            self.log.warn('CME error occured: %s %s', e.message, e.args, exc_info=True)
-            sms = None
-            self.output_queue.put((sgdatabase.PUT, ('id', 'sms', dict(id=requestID, request_status=CME_ERROR))))
+            pdus = self.modem.encode(number, text)
         except Exception as e:
-            self.log.error('Unknown error occured: %s %s', e.message, e.args, exc_info=True)
-            sms = None
-            self.output_queue.put((sgdatabase.PUT, ('id', 'sms', dict(id=requestID, request_status=UNKNOWNERROR))))                                
-        return sms
-        
+            self.sent(number, requestID, None, e, 0.0)
+            return
+        self.modem.send(pdus, lambda reference, error, secs: self.sent(number, requestID, reference, error, secs))
+
+    def sent(self, number, requestID, reference, error, secs):
+        # outcome of sendMsg, called on the reader thread of the modem
+        if isinstance(error, sgatmodem.Cancelled):
+            # never written, it is sent from the outbox on the next start
+            self.release(requestID)
+            self.stats.dropped()
+            return
+        self.stats.send_time.observe(secs)
+        if error is None:
+            self.log.debug('Message sent with reference=%d', reference)
+            self.sentSms.add(reference, number, requestID)
+            self.stats.inflight.value = len(self.sentSms)
+            data = dict(id=requestID, request_status=ENROUTE, reference=reference)
+        elif isinstance(error, CmsError):
+            self.log.warn('CMS error occured: %s %s', error.message, error.args)
+            data = dict(id=requestID, request_status=CMS_ERROR)
+        elif isinstance(error, CmeError):
+            self.log.warn('CME error occured: %s %s', error.message, error.args)
+            data = dict(id=requestID, request_status=CME_ERROR)
+        else:
+            self.log.error('Unknown error occured: %s %s', error.message, error.args)
+            data = dict(id=requestID, request_status=UNKNOWNERROR)
+        self.output_queue.put((sgdatabase.PUT, ('id', 'sms', data)))
+        if error is not None:
+            self.log.warn('sendMsg failed.  Message is ignored')
+        self.stats.done(error is None)
+        self.acknowledge(requestID)
+
+    def receive(self, item):
+        # None only wakes the send loop to see the exit event
+        if item is None:
+            return
+        # changed settings arrive as a dict
+        if isinstance(item, dict):
+            self.configure(**item)
+            return
+        # a batch of messages arrives as one list on the input queue
+        for message in (item if isinstance(item, list) else [item]):
+            self.lanes[message[3]].append(message)
+
+    def configure(self, commPort=None, min_send_interval=None, send_burst=None, number_send_interval=None,
+                  number_burst=None, max_skip=None, drain_timeout=None):
+        # settings changed while running, None leaves one as it is
+        now = time.time()
+        if drain_timeout is not None:
+            self.drain_timeout = float(drain_timeout)
+        if min_send_interval is not None or send_burst is not None:
+            if min_send_interval is not None:
+                self.min_send_interval = min_send_interval
+            self.bucket.configure(now, rate(self.min_send_interval),
+                send_burst if send_burst is not None else self.bucket.burst)
+        if number_send_interval is not None or number_burst is not None:
+            if number_send_interval is not None:
+                self.number_rate = rate(number_send_interval)
+            if number_burst is not None:
+                self.number_burst = number_burst
+            for bucket in self.number_buckets.values():
+                bucket.configure(now, self.number_rate, self.number_burst)
+            if not self.number_rate:
+                self.number_buckets.clear()
+        if max_skip is not None:
+            self.max_skip = int(max_skip)
+        self.log.info('Sending every %ss in bursts of %s, %s per sec to a number in bursts of %s',
+            self.min_send_interval, self.bucket.burst, self.number_rate, self.number_burst)
+        if commPort is not None and commPort != self.commPort:
+            self.log.warn('Reconnecting from %s to %s', self.commPort, commPort)
+            # the messages queued for the modem go out first
+            if self.modem is not None:
+                self.modem.wait_idle(PIPELINE * sgatmodem.SEND_TIMEOUT)
+            self.close()
+            self.commPort = commPort
+            self.stats.state.value = CONNECTING
+            self.connect(self.commPort)
+            self.stats.state.value = CONNECTED if self.connected else DISCONNECTED
+
+    def number_bucket(self, number):
+        if not self.number_rate:
+            return None
+        bucket = self.number_buckets.get(number)
+        if bucket is None:
+            if len(self.number_buckets) >= MAX_NUMBER_BUCKETS:
+                now = time.time()
+                for idle in [n for n, b in self.number_buckets.items() if b.full(now)]:
+                    del self.number_buckets[idle]
+            bucket = self.number_buckets[number] = TokenBucket(self.number_rate, self.number_burst)
+        return bucket
+
+    def next_message(self, timeout=None):
+        now = time.time()
+        # messages held back for their number go back to the front of their lane once allowed
+        while self.deferred and self.deferred[0][0] <= now:
+            message = heapq.heappop(self.deferred)[1]
+            self.lanes[message[3]].appendleft(message)
+        if not any(self.lanes):
+            if self.deferred:
+                ready = self.deferred[0][0] - now
+                timeout = ready if timeout is None else min(timeout, ready)
+            self.receive(self.input_queue.get(timeout=timeout))
+        # pick up everything else waiting so later high priority messages are seen
+        try:
+            while True:
+                self.receive(self.input_queue.get_nowait())
+        except Queue.Empty:
+            pass
+
+        while True:
+            waiting = [priority for priority, lane in enumerate(self.lanes) if lane]
+            if not waiting:
+                raise Queue.Empty
+            chosen = waiting[0]
+            for priority in waiting[1:]:
+                if self.skipped[priority] >= self.max_skip:
+                    chosen = priority
+                    break
+            for priority in waiting:
+                self.skipped[priority] = 0 if priority == chosen else self.skipped[priority] + 1
+            message = self.lanes[chosen].popleft()
+            # a message of more segments than the burst waits for a full bucket and
+            # leaves it in debt, which delays the sends after it
+            segments = message[5]
+            bucket = self.number_bucket(message[0])
+            delay = bucket.delay(now, min(segments, bucket.burst)) if bucket else 0
+            if delay > 0:
+                heapq.heappush(self.deferred, (now + delay, message))
+                continue
+            # another modem or an earlier run may have sent it already
+            if self.outbox is not None and not self.outbox.claim(message[2]):
+                self.log.info('Message %d is no longer in the outbox, skipping it', message[2])
+                self.stats.dropped()
+                continue
+            if bucket:
+                bucket.consume(now, segments)
+            self.bucket.consume(now, segments)
+            return message
+
+    def throttle(self, secs):
+        # sleeps for the send rate limit, taking in what arrives meanwhile so
+        # a changed rate shortens or lengthens the sleep.  Returns the secs slept.
+        start = now = time.time()
+        deadline = start + secs
+        while now < deadline and not self.drained(now):
+            try:
+                self.receive(self.input_queue.get(timeout=deadline - now))
+            except Queue.Empty:
+                pass
+            now = time.time()
+            deadline = now + self.bucket.delay(now)
+            if self.draining():
+                deadline = min(deadline, self.drain_until)
+        return now - start
+
+    def draining(self):
+        # True once the exit event is set, which starts the drain deadline
+        if self.drain_until is None and self.exit.is_set():
+            self.drain_until = time.time() + self.drain_timeout
+            self.log.info('Exit requested, sending for up to %ss more', self.drain_timeout)
+        return self.drain_until is not None
+
+    def drained(self, now=None):
+        # nothing left to send, or no time left to send it in
+        if not self.draining():
+            return False
+        if (now or time.time()) >= self.drain_until:
+            return True
+        return self.input_queue.empty() and not any(self.lanes) and not self.deferred
+
+    def unsent(self):
+        # takes in what is still queued and returns how many messages were not sent
+        try:
+            while True:
+                self.receive(self.input_queue.get_nowait())
+        except (Queue.Empty, IOError, EOFError):
+            pass
+        return sum(len(lane) for lane in self.lanes) + len(self.deferred)
+
+    def acknowledge(self, requestID):
+        # the message has reached its ENROUTE or a final status, it no longer needs the outbox
+        if self.outbox is not None:
+            self.outbox.ack(requestID)
+
+    def release(self, requestID):
+        # the message was claimed but not submitted, it goes back to the outbox
+        if self.outbox is not None:
+            self.outbox.release(requestID)
 
     def msgSentCallback(self, status):
         self.log.debug('status=%d reference=%d number=%s timeSent=%s timeFinalized=%s deliveryStatus=%d',
@@ -81,13 +661,19 @@ class ModemServer(multiprocessing.Process):
                         str(status.timeFinalized),
                         status.deliveryStatus)
 
-        requestID = self.sentSms[status.reference][0]
-        request_status = self.sentSms[status.reference][1].status
+        if status.deliveryStatus < REPORT_COMPLETED_END:
+            request_status = DELIVERED
+        elif status.deliveryStatus < REPORT_TEMPORARY_END:
+            request_status = ENROUTE # the network keeps trying, a final report follows
+        else:
+            request_status = FAILED
 
-        # Basic sanity check to make sure the status report is for the message sent originally
-        if not (self.sentSms[status.reference][1].number == status.number):
-            self.log.warn('Sent SMS phone number does not match delivery report %s != %s', 
-                        self.sentSms[status.reference][1].number,status.number)
+        requestID = self.sentSms.match(status.reference, status.number, final=(request_status != ENROUTE))
+        self.stats.inflight.value = len(self.sentSms)
+        if requestID is None:
+            self.log.warn('Ignoring status report for unknown message reference=%d number=%s',
+                        status.reference, status.number)
+            return
 
         # Update the SMS database with the details from the status report
         data = {"id":requestID, "request_status": request_status, 
@@ -97,12 +683,11 @@ class ModemServer(multiprocessing.Process):
 
         self.output_queue.put((sgdatabase.PUT, ('id', 'sms', data)))
 
-    def _msgSentCallbackTest(self):
-        status=gsmmodem.modem.StatusReport(self.modem, status=0, number='0', reference=256, 
-                                            timeSent=parseTextModeTimeStr('00/01/01,00:00:00+00'), 
-                                            timeFinalized=parseTextModeTimeStr('00/01/01,00:00:00+00'), 
-                                            deliveryStatus=0)
-        self.sentSms[status.reference][1].report = status
+    def _msgSentCallbackTest(self, number):
+        status=sgatmodem.StatusReport(status=0, number=number, reference=256, 
+                                      timeSent=parseTextModeTimeStr('00/01/01,00:00:00+00'), 
+                                      timeFinalized=parseTextModeTimeStr('00/01/01,00:00:00+00'), 
+                                      deliveryStatus=0)
         self.msgSentCallback(status)
     
     def reset_logger(self, log, logLevel=None, logConfig={}):
@@ -143,45 +728,59 @@ class ModemServer(multiprocessing.Process):
         self.log = logging.getLogger('sgmodem.server.ModemServer')
         self.reset_logger(self.log, logLevel=self.logLevel, logConfig=self.logConfig)
         self.log.debug('logConfig is {}'.format(self.logConfig))
+        # Ctrl-C reaches every process, the parent sets the exit event and the modem drains
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
         try:
             # connect to the modem
             self.connect(self.commPort)
+            self.stats.state.value = CONNECTED if self.connected else DISCONNECTED
 
             # loop the input queue messages to send
             try:
-                last_sent_time = time.time()
-                while not self.exit.is_set() or not self.input_queue.empty():
+                while not self.drained():
                     try:
-                        number, text, requestID = self.input_queue.get(timeout=5)
-                        remaining_time = int(self.min_send_interval) + last_sent_time - time.time()
+                        # wait for the rate limit before picking the next message,
+                        # so one arriving meanwhile with a higher priority goes first
+                        remaining_time = self.bucket.delay(time.time())
                         if (remaining_time > 0):
-                            self.log.debug("Minimum send interval of %ss not yet elapsed, sleeping %ds",
+                            self.log.debug("Send rate limit of one per %ss reached, sleeping %.3fs",
                                 self.min_send_interval, remaining_time)
-                            time.sleep(remaining_time)
-                        self.log.debug('Sending to number=%s, message=%s', number, text)
+                            self.stats.throttled(self.throttle(remaining_time))
+                            if self.drained():
+                                break
+                        timeout = 5
+                        if self.draining():
+                            timeout = max(0, min(timeout, self.drain_until - time.time()))
+                        # the next message is taken and encoded while the modem submits the one before
+                        if self.connected and not self.modem.wait_below(PIPELINE, timeout):
+                            continue
+                        number, text, requestID, priority, queued_at, segments = self.next_message(timeout=timeout)
+                        self.stats.waited(priority, time.time() - queued_at)
+                        self.log.debug('Sending to number=%s, message=%s, segments=%d', number, text, segments)
                         if number == '0': # test sending
-                            self.sentSms[256] = (requestID, gsmmodem.modem.SentSms(number, text, 256))
-                            threading.Thread(target=self._msgSentCallbackTest).start()
+                            self.sentSms.add(256, number, requestID)
+                            threading.Thread(target=self._msgSentCallbackTest, args=(number,)).start()
+                            self.stats.done(True)
+                            self.acknowledge(requestID)
+                        elif not self.connected:
+                            self.output_queue.put((sgdatabase.PUT, ('id', 'sms', dict(id=requestID, request_status=MODEMDISCONNECTED))))
+                            self.log.warn('Modem is not connected.  Message is ignored')
+                            self.stats.done(False)
+                            self.acknowledge(requestID)
                         else:
-                            if not self.connected:
-                                self.output_queue.put((sgdatabase.PUT, ('id', 'sms', dict(id=requestID, request_status=MODEMDISCONNECTED))))
-                                self.log.warn('Modem is not connected.  Message is ignored')
-                                continue
-                            sms = self.sendMsg(number, text, requestID)
-                            if sms is None:
-                                self.log.warn('sendMsg failed.  Message is ignored')
-                                pass
-                            else:
-                                self.sentSms[sms.reference] = (requestID, sms)
-                                self.output_queue.put((sgdatabase.PUT, ('id', 'sms', dict(id=requestID, request_status=ENROUTE))))
-                        last_sent_time = time.time()
+                            self.sendMsg(number, text, requestID)
                     except Queue.Empty:
                         pass
-                    except KeyboardInterrupt:
-                        if not self.exit.is_set():
-                            self.exit.set()
-                        self.log.info('Ctrl-C received, exiting')
-                        break
+                unsent = self.unsent()
+                if self.connected:
+                    # what the modem has queued may go until the deadline, then
+                    # only the message being written is waited for
+                    self.modem.wait_idle(max(0, self.drain_until - time.time()))
+                    unsent += self.modem.cancel()
+                    self.modem.wait_idle(sgatmodem.SEND_TIMEOUT)
+                if unsent:
+                    # never claimed or given back, so they are sent again from the outbox on the next start
+                    self.log.warn('Drain deadline reached, %d messages stay in the outbox', unsent)
             except Exception as e:
                 self.log.error("An error inside the send loop %s %s", e.message, e.args, exc_info=True)
                 raise e
@@ -0,0 +1,149 @@
+import os, logging, threading, time, Queue
+from contextlib import contextmanager
+from tornado.concurrent import Future
+import sgdatabase
+
+log = logging.getLogger('sgoutbox.Outbox')
+
+# states of a message in the outbox
+PENDING = 0 # waiting to be sent
+INFLIGHT = 1 # claimed by a modem which is submitting it
+
+class Outbox(sgdatabase.SQLiteStore):
+    '''Durable record of messages that have been accepted but not yet handed
+    to the network, so they survive a crash or restart.
+
+    Each process and thread gets its own SQLite connection.  A modem claims a
+    message for lease secs before submitting it and acknowledges it once the
+    modem has taken it, which removes it from the outbox.'''
+
+    def __init__(self, path, lease=300):
+        sgdatabase.SQLiteStore.__init__(self, path)
+        self.lease = lease
+
+    def settings(self):
+        return dict(path=self.path, lease=self.lease)
+
+    def setup(self, conn):
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=FULL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            number TEXT NOT NULL,
+            message TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            segments INTEGER NOT NULL,
+            queued_at REAL NOT NULL,
+            state INTEGER NOT NULL DEFAULT 0,
+            owner INTEGER,
+            lease_until REAL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_outbox_state ON outbox (state, priority, id)')
+
+    @contextmanager
+    def transaction(self, begin='BEGIN'):
+        conn = self.conn
+        conn.execute(begin)
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def add(self, messages):
+        # messages as made by sgmodem.make_message, written in one transaction
+        with self.transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO outbox (number, message, id, priority, queued_at, segments) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', messages)
+
+    def claim(self, requestID):
+        # mark a message in flight before it is submitted; False if it is gone or claimed already
+        cursor = self.conn.execute('UPDATE outbox SET state=?, owner=?, lease_until=? WHERE id=? AND state=?',
+                                   (INFLIGHT, os.getpid(), time.time() + self.lease, requestID, PENDING))
+        return cursor.rowcount == 1
+
+    def ack(self, requestID):
+        self.conn.execute('DELETE FROM outbox WHERE id=?', (requestID,))
+
+    def release(self, requestID):
+        # a claimed message that was not submitted after all is pending again
+        self.conn.execute('UPDATE outbox SET state=?, owner=NULL, lease_until=NULL WHERE id=?', (PENDING, requestID))
+
+    def recover(self, live_owners=()):
+        '''Returns (pending, interrupted).  pending are the messages never
+        claimed, to be dispatched again.  interrupted are the requestIDs
+        claimed by a modem that is gone or whose lease ran out.  It may have
+        sent them already, so they are removed rather than risk sending them
+        twice.  Claims of live_owners, the pids of running modems, are left.'''
+        start = time.time()
+        live_owners = list(live_owners)
+        stale = 'state=? AND (lease_until < ? OR owner NOT IN ({}))'.format(','.join('?' * len(live_owners)))
+        args = [INFLIGHT, start] + live_owners
+        with self.transaction('BEGIN IMMEDIATE') as conn:
+            interrupted = [row[0] for row in conn.execute('SELECT id FROM outbox WHERE ' + stale, args)]
+            conn.execute('DELETE FROM outbox WHERE ' + stale, args)
+        pending = [tuple(row) for row in self.conn.execute(
+            'SELECT number, message, id, priority, queued_at, segments FROM outbox WHERE state=? ORDER BY priority, id',
+            (PENDING,))]
+        log.info('Recovered %d pending and %d interrupted messages in %.3fs',
+                 len(pending), len(interrupted), time.time() - start)
+        return pending, interrupted
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+class OutboxWriter(object):
+    '''Writes the messages accepted by the web tier to the outbox from a
+    thread of its own and answers with Futures, so the IOLoop never waits
+    on the fsync of a commit.  The messages of all requests that arrive
+    while one commit is under way go in the next, one fsync for all.'''
+
+    def __init__(self, outbox, ioloop, logLevel=logging.WARNING):
+        self.outbox = outbox
+        self.ioloop = ioloop
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.log = logging.getLogger('sgoutbox.OutboxWriter')
+        self.log.setLevel(logLevel)
+
+    def add(self, messages):
+        # resolves once the messages are committed
+        future = Future()
+        self.queue.put((future, messages))
+        return future
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            try:
+                while True:
+                    item = self.queue.get_nowait()
+                    if item is None:
+                        self.queue.put(None) # exits after this batch
+                        break
+                    batch.append(item)
+            except Queue.Empty:
+                pass
+            try:
+                self.outbox.add([message for future, messages in batch for message in messages])
+            except Exception as e:
+                self.log.error('Writing %d requests to the outbox failed %s', len(batch), e.args, exc_info=True)
+                for future, messages in batch:
+                    self.ioloop.add_callback(future.set_exception, e)
+            else:
+                for future, messages in batch:
+                    self.ioloop.add_callback(future.set_result, None)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.write_loop, name='OutboxWriterThread')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        # what is queued is still written
+        self.queue.put(None)
+        if self.thread is not None:
+            self.thread.join()
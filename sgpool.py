@@ -0,0 +1,138 @@
+import multiprocessing, logging, time, Queue
+from threading import Thread
+import sgmodem
+
+log = logging.getLogger('sgpool.ModemPool')
+
+def parse_ports(com_port, min_send_interval):
+    '''Turn the com_port setting into (port, min_send_interval) pairs.
+
+    Ports are separated by commas and may carry their own interval after an @,
+    i.e. "COM3,COM4@5" sends from COM3 at the default interval and from COM4
+    every 5 secs.'''
+    ports = []
+    for spec in com_port.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        port, _, interval = spec.partition('@')
+        interval = interval.strip()
+        ports.append((port.strip(), float(interval) if interval else min_send_interval))
+    return ports
+
+class ModemPool(object):
+    '''Runs one ModemServer process per port and routes messages from the
+    modem queue to the modem expected to get through its backlog first.'''
+
+    def __init__(self, input_queue, output_queue, exitEvent, com_port, min_send_interval=None,
+                logLevel=logging.WARNING, logConfig={}, **modem_options):
+        self.input_queue = input_queue
+        self.exit = exitEvent
+        self.com_port = com_port
+        self.min_send_interval = min_send_interval
+        self.modems = []
+        for port, interval in parse_ports(com_port, min_send_interval):
+            modem = sgmodem.ModemServer(multiprocessing.Queue(), output_queue, exitEvent, port,
+                interval, logLevel, logConfig, **modem_options)
+            modem.daemon = True
+            modem.name = 'ModemServer-{}'.format(port)
+            self.modems.append(modem)
+        self.thread = None
+        log.setLevel(logLevel)
+
+    def start(self):
+        for modem in self.modems:
+            modem.start()
+        self.thread = Thread(target=self.dispatch_loop, name='ModemDispatchThread')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def backlog(self, modem, now):
+        # secs until the modem would get to a newly dispatched message
+        interval = float(modem.min_send_interval or 0)
+        wait = max(0.0, modem.stats.last_sent.value + interval - now)
+        return wait + modem.stats.queued.value * interval, modem.stats.queued.value
+
+    def choose(self):
+        now = time.time()
+        healthy = [m for m in self.modems if m.stats.state.value != sgmodem.DISCONNECTED]
+        # with every modem down, let one of them report the message as undeliverable
+        return min(healthy or self.modems, key=lambda m: self.backlog(m, now))
+
+    def dispatch(self, item):
+        if item is None:
+            return # only wakes the dispatch loop to see the exit event
+        # a batch is split so its messages are spread over the modems
+        messages = item if isinstance(item, list) else [item]
+        routed = {}
+        for message in messages:
+            modem = self.choose()
+            modem.stats.dispatched()
+            routed.setdefault(modem, []).append(message)
+        for modem, batch in routed.items():
+            modem.input_queue.put(batch if len(batch) > 1 else batch[0])
+
+    def dispatch_loop(self):
+        while not self.exit.is_set() or not self.input_queue.empty():
+            try:
+                self.dispatch(self.input_queue.get(timeout=1))
+            except Queue.Empty:
+                pass
+            except Exception as e:
+                log.error('Unable to dispatch message %s', e.args, exc_info=True)
+        log.debug('Dispatcher exiting')
+
+    def configure(self, com_port=None, min_send_interval=None, **modem_options):
+        '''Hands changed settings to the running modems, which apply them
+        between two sends.  A modem whose port is no longer configured
+        reconnects to one of the new ports.  Adding or removing modems needs
+        a restart.'''
+        if com_port is not None:
+            self.com_port = com_port
+        if min_send_interval is not None:
+            self.min_send_interval = min_send_interval
+        ports = parse_ports(self.com_port, self.min_send_interval)
+        intervals = dict(ports)
+        current = [m.commPort for m in self.modems]
+        moved = [m for m in self.modems if m.commPort not in intervals]
+        added = [port for port, interval in ports if port not in current]
+        if len(moved) != len(added):
+            log.warn('%d ports configured for %d modems, restart the server to add or remove modems',
+                len(ports), len(self.modems))
+        for modem, port in zip(moved, added):
+            log.info('Modem on %s moves to %s', modem.commPort, port)
+            modem.commPort = port
+            modem.name = 'ModemServer-{}'.format(port)
+        for modem in self.modems:
+            options = dict(modem_options)
+            if modem.commPort in intervals:
+                # the copy of the parent is what backlog() estimates with
+                modem.min_send_interval = options['min_send_interval'] = intervals[modem.commPort]
+                options['commPort'] = modem.commPort
+            # read by the modem process from its input queue, after the messages before it
+            modem.input_queue.put(options)
+
+    def stop(self, timeout):
+        '''Waits up to timeout secs for the modems to drain and exit after
+        the exit event, then terminates those still running.  Messages still
+        queued for them are in the outbox, so they are not flushed.'''
+        deadline = time.time() + timeout
+        self.input_queue.put(None)
+        if self.thread is not None:
+            self.thread.join(max(0, deadline - time.time()))
+        for modem in self.modems:
+            modem.input_queue.put(None) # wakes a modem waiting for messages
+        for modem in self.modems:
+            modem.join(max(0, deadline - time.time()))
+            if modem.is_alive():
+                log.warn('Modem %s did not stop in time, terminating it', modem.commPort)
+                modem.terminate()
+                modem.join()
+            modem.input_queue.cancel_join_thread()
+        self.input_queue.cancel_join_thread()
+
+    def live_pids(self):
+        return [m.pid for m in self.modems if m.is_alive()]
+
+    def stats(self):
+        return [dict(port=m.commPort, **m.stats.as_dict()) for m in self.modems]
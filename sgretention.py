@@ -0,0 +1,157 @@
+import os, logging, sqlite3, time
+from threading import Thread, Event
+import sgdatabase, sgmodem
+
+log = logging.getLogger('sgretention.Retention')
+
+def archive_name(month):
+    # month is i.e. 202610 for October 2026
+    return 'sms-{:04d}-{:02d}.db'.format(month // 100, month % 100)
+
+def month_of(created_at):
+    t = time.gmtime(created_at or 0)
+    return t.tm_year * 100 + t.tm_mon
+
+def open_archive(archive_dir, month):
+    db = sqlite3.connect(os.path.join(archive_dir, archive_name(month)), timeout=30, isolation_level=None)
+    db.row_factory = sgdatabase.row_dict
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS sms ({})'.format(
+        ', '.join('{} {}'.format(column, kind) for column, kind in sgdatabase.SCHEMA['sms'])))
+    return db
+
+def find_archived(db, archive_dir, requestID):
+    '''The archived row of a message, or None.  db is a connection to the
+    live database, which keeps the month each message was archived in.'''
+    row = db.execute('SELECT month FROM archived WHERE id=?', (requestID,)).fetchone()
+    if row is None:
+        return None
+    path = os.path.join(archive_dir, archive_name(row['month']))
+    if not os.path.exists(path):
+        log.warn('Archive %s of message %d is missing', path, requestID)
+        return None
+    archive = sqlite3.connect(path, timeout=30)
+    archive.row_factory = sgdatabase.row_dict
+    try:
+        return archive.execute('SELECT * FROM sms WHERE id=?', (requestID,)).fetchone()
+    finally:
+        archive.close()
+
+class Retention(object):
+    '''Moves messages in a final status accepted more than max_age secs ago
+    out of the sms table, into one SQLite file per month in archive_dir.
+
+    Each batch is committed to its archive before it is deleted, so a crash
+    in between archives it twice rather than losing it.  Batches are small
+    and paced, so SMSDatabase never waits long for the write lock, and the
+    pages they free are given back to the file system a few at a time with
+    incremental vacuum.  The archived table of the live database records
+    the month of every archived message for lookups by reference.'''
+
+    def __init__(self, path, archive_dir, max_age, batch_size=500, pause=0.2, interval=3600,
+                 vacuum_pages=500, logLevel=logging.WARNING):
+        self.path = path
+        self.archive_dir = archive_dir
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.vacuum_pages = vacuum_pages
+        self.stopped = Event()
+        self.thread = None
+        self.stats = dict(archived=0, runs=0)
+        log.setLevel(logLevel)
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sgdatabase.row_dict
+        return db
+
+    def archive_batch(self, db, cutoff):
+        # archives up to batch_size messages, returns how many
+        rows = []
+        for status in sgmodem.FINAL_STATUSES:
+            rows.extend(db.execute('SELECT * FROM sms WHERE request_status=? AND created_at < ? LIMIT ?',
+                                   (status, cutoff, self.batch_size - len(rows))).fetchall())
+            if len(rows) >= self.batch_size:
+                break
+        if not rows:
+            return 0
+        months = {}
+        for row in rows:
+            months.setdefault(month_of(row['created_at']), []).append(row)
+        for month, group in sorted(months.items()):
+            archive = open_archive(self.archive_dir, month)
+            try:
+                columns = sorted(group[0])
+                archive.execute('BEGIN')
+                archive.executemany('INSERT OR REPLACE INTO sms ({}) VALUES ({})'.format(
+                    ', '.join(columns), ', '.join('?' * len(columns))), [[row[c] for c in columns] for row in group])
+                archive.execute('COMMIT')
+            finally:
+                archive.close()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # a message archived before keeps its month
+            db.executemany('INSERT OR IGNORE INTO archived (id, month) VALUES (?, ?)',
+                           [(row['id'], month) for month, group in months.items() for row in group])
+            db.executemany('DELETE FROM sms WHERE id=?', [(row['id'],) for row in rows])
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return len(rows)
+
+    def vacuum(self, db):
+        # hand the free pages back a few at a time
+        if db.execute('PRAGMA auto_vacuum').fetchone()['auto_vacuum'] != 2:
+            if not self.stats['runs']:
+                log.warn('%s was made without incremental vacuum, archived pages are reused but the file '
+                         'does not shrink.  Stop the server and run sgserver.py --vacuum once to rebuild it',
+                         self.path)
+            return
+        while not self.stopped.is_set():
+            free = db.execute('PRAGMA freelist_count').fetchone()['freelist_count']
+            if not free:
+                break
+            db.execute('PRAGMA incremental_vacuum({:d})'.format(min(free, self.vacuum_pages))).fetchall()
+            self.stopped.wait(self.pause)
+
+    def run_once(self):
+        if not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        db = self.connect()
+        try:
+            cutoff = time.time() - self.max_age
+            archived = 0
+            while not self.stopped.is_set():
+                count = self.archive_batch(db, cutoff)
+                if not count:
+                    break
+                archived += count
+                self.stats['archived'] += count
+                self.stopped.wait(self.pause)
+            if archived:
+                log.info('Archived %d messages accepted before %s', archived, time.ctime(cutoff))
+            self.vacuum(db)
+        finally:
+            db.close()
+        self.stats['runs'] += 1
+        return archived
+
+    def run_loop(self):
+        while not self.stopped.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                log.error('Archiving failed %s', e.args, exc_info=True)
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = Thread(target=self.run_loop, name='RetentionThread')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
@@ -1,33 +1,111 @@
 #!/usr/bin/env python
 import multiprocessing, logging, time, os, sys, getopt, signal
-from threading import Thread
+from threading import Thread, Event
+from collections import OrderedDict
+from contextlib import contextmanager
 import tornado.ioloop
 import tornado.web
+import tornado.netutil
 from tornado_json.application import Application
 from tornado_json.routes import get_routes
 import sgmodem
 from sendsms import v1 as sendsms
 import sgdatabase
+import sgcache
+import sgpool
+import sgoutbox
+import sginbox
+import sgretention
+import sgstream
+import sgwebhook
+import sgmetrics
+import sgworkers
 
 counter = 0
 web_server = None
+web_app = None
 web_server_thread = None
+shutdown_thread = None
+db_reader = None
+status_stream = None
+webhooks = None
+retention = None
+status_cache = sgcache.StatusCache()
+status_counts = sgmetrics.ValueCounts('sms', 'request_status')
+request_stats = [] # sgmetrics.RequestStats of each web process
+worker = 0 # index in request_stats of this web process
+web_workers = None # sgworkers.WorkerPool when serving from several processes
+request_ids = None # sgworkers.RequestIDs
+recent_requests = None # sgworkers.SharedRecentKeys of the idempotency keys
+recent_messages = None # and of the messages in the dedup window
+sms_database = None
 modem_queue = multiprocessing.Queue()
 db_queue = multiprocessing.Queue()
 exit_event = multiprocessing.Event()
-ipipe, opipe = multiprocessing.Pipe()
-modemServer = None
+modemPool = None
+outbox = None
+outbox_writer = None # sgoutbox.OutboxWriter of this web process
 stop_db_server = False
+startup_times = OrderedDict() # secs each phase of the last start took
 log = logging.getLogger('sgserver.server')
-requestID = 0
 default_settings = {
     'com_port':'COM3',
     'web_port':'8888',
     'keyprotection':'0',
     'key': os.urandom(40).encode('hex'),
     'autostart': '0',
-    'min_send_interval':'10'
+    'min_send_interval':'10',
+    'priority_max_skip':'10',
+    'send_burst':'1',
+    'number_send_interval':'0',
+    'number_burst':'1',
+    'idempotency_ttl':'86400',
+    'dedup_window':'0',
+    'inflight_max':'10000',
+    'inflight_max_age':'259200',
+    'retention_days':'0',
+    'web_workers':'1',
+    'drain_timeout':'30'
     }
+def parse_com_port(value):
+    # read as ModemPool will, so a port list it cannot start with is never saved
+    value = str(value)
+    for port, interval in sgpool.parse_ports(value, None):
+        if not port:
+            raise ValueError('no port before @ in ' + value)
+    return value
+
+# settings that are not strings, parsed once when loaded or saved
+setting_types = {
+    'com_port':parse_com_port,
+    'web_port':int,
+    'keyprotection':int,
+    'autostart':int,
+    'min_send_interval':float,
+    'priority_max_skip':int,
+    'send_burst':float,
+    'number_send_interval':float,
+    'number_burst':float,
+    'idempotency_ttl':float,
+    'dedup_window':float,
+    'inflight_max':int,
+    'inflight_max_age':float,
+    'retention_days':float,
+    'web_workers':int,
+    'drain_timeout':float,
+    }
+# settings applied to the running modems when changed, by their ModemPool.configure argument
+modem_settings = {
+    'com_port':'com_port',
+    'min_send_interval':'min_send_interval',
+    'priority_max_skip':'max_skip',
+    'send_burst':'send_burst',
+    'number_send_interval':'number_send_interval',
+    'number_burst':'number_burst',
+    'drain_timeout':'drain_timeout',
+    }
+# settings that only take effect when the server is started again
+restart_settings = ('web_port', 'web_workers', 'inflight_max', 'inflight_max_age')
 
 exe_path = ((os.path.dirname(sys.executable) + '/') if getattr(sys, 'frozen', False) else '')
 log_format = '%(asctime)s - PID:%(process)d - %(levelname)s:%(name)s:%(funcName)s: %(message)s'
@@ -46,17 +124,55 @@ class Settings(object):
         self.log.setLevel(logLevel)
         self.database = database
         self.defaults = {}
-        self.settings = {}
-    
+        self.settings = {} # as saved in the database
+        # parsed values, replaced as a whole on a change so readers on other
+        # threads never see it half updated
+        self.values = {}
+        self.listeners = []
+
+    def parse(self, key, value):
+        return setting_types.get(key, str)(value)
+
     def save(self, key, value):
-        self.settings[key] = value
+        value = str(value)
+        self.apply(key, value, self.parse(key, value))
         data = {'setting':key, 'value':value}
         self.log.debug('Saving {}={} to database'.format(key,value))
-        self.database.queue.put((sgdatabase.PUT, ('setting', 'settings', data)))
+        self.database.put('setting', 'settings', data)
+
+    def apply(self, key, value, parsed):
+        changed = key in self.values and self.values[key] != parsed
+        self.settings[key] = value
+        values = dict(self.values)
+        values[key] = parsed
+        self.values = values
+        if changed:
+            for listener in list(self.listeners):
+                try:
+                    listener(key, parsed)
+                except Exception as e:
+                    self.log.error('Applying %s=%s failed %s', key, value, e.args, exc_info=True)
 
     def get(self, key):
+        return self.values[key]
+
+    def raw(self, key):
+        # the setting as it was entered
         return self.settings[key]
 
+    def add_listener(self, listener):
+        # listener(key, value) is called with the parsed value of every setting changed
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def update(self, table, data):
+        # listener for the settings rows saved by another process
+        if table == 'settings' and data.get('value') != self.settings.get(data['setting']):
+            try:
+                self.apply(data['setting'], data['value'], self.parse(data['setting'], data['value']))
+            except ValueError as e:
+                self.log.warn('Ignoring setting %s=%s %s', data['setting'], data['value'], e.args)
+
     # get settings from database and update with defaults
     def set_defaults(self, defaults=None):
         global default_settings
@@ -66,15 +182,18 @@ class Settings(object):
         self.log.debug('Getting existing settings from the database')
         for setting in self.database.get(None,'settings'):
             self.log.debug('Found {}={}'.format(setting['setting'],setting['value']))
-            self.settings[setting['setting']] = setting['value']
+            if setting['value'] is None:
+                continue
+            try:
+                self.apply(setting['setting'], setting['value'], self.parse(setting['setting'], setting['value']))
+            except (ValueError, TypeError) as e:
+                self.log.warn('Replacing setting %s=%s with its default %s', setting['setting'], setting['value'], e.args)
 
         # update the settings with any missing default settings
         for default in self.defaults:
-            if self.settings.get(default) is None:
+            if self.values.get(default) is None:
                 self.log.debug('Saving missing defaults {}={}'.format(default,self.defaults[default]))
-                # save the missing setting with the default one
-                self.settings[default] = self.defaults[default]
-                # save the missing setting into the database as well
+                # save the missing setting with the default one, into the database as well
                 self.save(default, self.defaults[default])
    
 class MainHandler(tornado.web.RequestHandler):
@@ -82,88 +201,413 @@ class MainHandler(tornado.web.RequestHandler):
         global counter
         self.write("SMS Gateway<p>This server has been accessed {} times, with {} times coming from the API".
             format(counter+sendsms.counter,sendsms.counter))
+        self.write("<p>Status cache has {entries} entries, {hits} hits and {misses} misses".
+            format(**status_cache.stats()))
+        if status_stream is not None:
+            self.write("<p>Status stream has {subscribers} subscribers".format(**status_stream.stats()))
+        if webhooks is not None:
+            self.write("<p>Webhooks: {watched} messages watched, {sent} callbacks sent, {failed} failed, "
+                "{retries} waiting to retry, {dropped} given up".format(**webhooks.status()))
+        if modemPool is not None:
+            for stats in modemPool.stats():
+                self.write("<p>Modem {port}: {sent} sent, {failed} failed, {queued} queued, {inflight} awaiting delivery reports".format(**stats))
+                for lane, wait in sorted(stats['lanes'].items()):
+                    self.write("<br>{} priority: {count} sent, {avg_wait:.1f}s average wait, {max_wait:.1f}s longest wait".
+                        format(lane, **wait))
         counter = counter + 1
 
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        metrics = sgmetrics.Exposition()
+        metrics.gauge('queue_depth', 'Items waiting in the inter-process queues',
+            [({'queue': name}, queue_size(queue)) for name, queue in (('modem', modem_queue), ('db', db_queue))])
+        def labels(i, **labels):
+            # the web worker is only told apart when there are several
+            if len(request_stats) > 1:
+                labels['worker'] = i
+            return labels
+        metrics.histogram('http_request_duration_seconds', 'Time to answer an HTTP request',
+            [(labels(i, handler=name), histogram) for i, stats in enumerate(request_stats)
+             for name, histogram in sorted(stats.times.items())])
+        metrics.counter('http_responses_total', 'HTTP responses by status code',
+            [(labels(i, handler=name, code=code), count) for i, stats in enumerate(request_stats)
+             for (name, code), count in stats.code_counts()])
+        metrics.counter('sms_status_total', 'SMS statuses written to the database, several updates of a message in one batch count once',
+            [({'status': sgmodem.STATUS_NAMES.get(status, status)}, count) for status, count in status_counts.items()])
+        if sms_database is not None:
+            metrics.histogram('db_batch_write_seconds', 'Time to write and commit a batch of database writes',
+                [({}, sms_database.write_time)])
+            metrics.counter('db_writes_total', 'Database writes received',
+                [({}, sms_database.stats['writes'])])
+            metrics.counter('db_upserts_total', 'Rows written after coalescing the writes of a batch',
+                [({}, sms_database.stats['upserts'])])
+        metrics.gauge('startup_seconds', 'Time each phase of the last start took',
+            [({'phase': name}, secs) for name, secs in startup_times.items()])
+        if retention is not None:
+            metrics.counter('sms_archived_total', 'Messages moved to the archive',
+                [({}, retention.stats['archived'])])
+        if modemPool is not None:
+            modems = [(modem.commPort, modem.stats) for modem in modemPool.modems]
+            metrics.gauge('modem_state', 'Modem state, 0 connecting, 1 connected, 2 disconnected',
+                [({'port': port}, stats.state.value) for port, stats in modems])
+            metrics.gauge('modem_queued', 'Messages dispatched to a modem and not yet sent',
+                [({'port': port}, stats.queued.value) for port, stats in modems])
+            metrics.gauge('modem_inflight', 'Messages sent and waiting for a delivery report',
+                [({'port': port}, stats.inflight.value) for port, stats in modems])
+            metrics.counter('modem_sent_total', 'Messages handed to the network',
+                [({'port': port}, stats.sent.value) for port, stats in modems])
+            metrics.counter('modem_failed_total', 'Messages the modem could not send',
+                [({'port': port}, stats.failed.value) for port, stats in modems])
+            metrics.counter('modem_received_total', 'Messages received and stored in the inbox',
+                [({'port': port}, stats.received.value) for port, stats in modems])
+            metrics.gauge('modem_connect_seconds', 'Time the last connect to the modem took',
+                [({'port': port}, stats.connect_time.value) for port, stats in modems])
+            metrics.histogram('modem_send_seconds', 'Round trip of the AT commands sending a message',
+                [({'port': port}, stats.send_time) for port, stats in modems])
+            metrics.histogram('modem_at_seconds', 'Time from writing an AT command to its final result',
+                [({'port': port, 'command': name}, histogram) for port, stats in modems
+                 for name, histogram in sorted(stats.at_time.items())])
+            metrics.counter('modem_throttle_seconds_total', 'Time spent sleeping for the send rate limit',
+                [({'port': port}, stats.throttle_time.value) for port, stats in modems])
+            metrics.counter('modem_throttle_total', 'Sleeps for the send rate limit',
+                [({'port': port}, stats.throttle_count.value) for port, stats in modems])
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.text())
+
+def queue_size(queue):
+    try:
+        return queue.qsize()
+    except NotImplementedError: # not available on Mac OS X
+        return float('nan')
+
+class MetricsApplication(Application):
+    def log_request(self, handler):
+        request_stats[worker].observe(type(handler).__name__, handler.request.request_time(), handler.get_status())
+        super(MetricsApplication, self).log_request(handler)
+
+routes = [
+    (r"/",MainHandler),
+    (r"/metrics",MetricsHandler),
+    (r"/v1/sendsms",sendsms.SendSMSHandler),
+    (r"/v1/sendsms/batch",sendsms.SendSMSBatchHandler),
+    (r"/v1/smsstatus/([0-9]+)",sendsms.GetStatusHandler),
+    (r"/v1/smsstatus/stream",sendsms.StatusStreamHandler),
+    (r"/v1/sms",sendsms.ListSMSHandler),
+    (r"/v1/inbox",sendsms.ListInboxHandler),
+    (r"/v1/settings",sendsms.SettingsHandler),
+    ]
+
 def make_app(sg_settings):
 #    routes = get_routes(sendsms)
-    return Application(routes=[
-        (r"/",MainHandler),
-        (r"/v1/sendsms",sendsms.SendSMSHandler),
-        (r"/v1/smsstatus/([0-9]+)",sendsms.GetStatusHandler),
-        ], settings={"requestID":requestID,
+    return MetricsApplication(routes=routes, settings={"request_ids":request_ids,
                     "db_queue":db_queue, 
                     "modem_queue":modem_queue,
-                    "ipipe":ipipe,
+                    "db_reader":db_reader,
+                    "status_cache":status_cache,
+                    "status_stream":status_stream,
+                    "webhooks":webhooks,
+                    "outbox":outbox_writer,
+                    "archive_dir":data_path(sms_database, 'archive'),
+                    "recent_requests":recent_requests,
+                    "recent_messages":recent_messages,
                     "settings":sg_settings})
 
 def start_server(sg_settings, db_server, level=None, mlogConfig=None):
     def start():
-        def stop_check():
-#            log.debug('Stop check is called')
-            if exit_event.is_set():
-                stop_server()
-                # We only stop the db_server as well if True.
-                # This allows for a GUI to continue running and have 
-                # access to the settings database
-                if stop_db_server:
-                    db_server.stop_thread()
-
-        global web_server, requestID
+        global web_server, web_app, db_reader, status_stream, webhooks, request_ids, web_workers, outbox_writer
+        global recent_requests, recent_messages
         log.debug('Thread starting')
         try:
-            # update to the correct index aka requestID
-            db_queue.put((sgdatabase.UPDATE_INDEX, 'sms'))
-            db_server.index_updated.wait()
-            requestID = db_server.index
-
-            web_server = tornado.httpserver.HTTPServer(make_app(sg_settings))
-            web_server.listen(int(sg_settings.get('web_port')))
-            tornado.ioloop.PeriodicCallback(stop_check,5000).start()
+            with phase('index'):
+                # references carry on from the last one, also when started again
+                # before the writes of the last run are all in the database
+                request_ids = sgworkers.RequestIDs(max(db_server.last_id(), request_ids.last if request_ids else 0))
+            if recent_requests is None:
+                # a retry answered by another web worker finds the original too
+                lock = multiprocessing.RLock()
+                recent_requests = sgworkers.SharedRecentKeys(0, lock=lock)
+                recent_messages = sgworkers.SharedRecentKeys(0, lock=lock)
+            recent_requests.ttl = sg_settings.get('idempotency_ttl')
+            recent_messages.ttl = sg_settings.get('dedup_window')
+
+            listen_start = time.time()
+            workers = sg_settings.get('web_workers')
+            if workers > 1 and not hasattr(os, 'fork'):
+                log.warn('Serving from one process, web_workers needs fork')
+                workers = 1
+            names = [handler.__name__ for pattern, handler in routes] + ['ErrorHandler']
+            request_stats[:] = [sgmetrics.RequestStats(names) for i in range(workers)]
+            if workers > 1:
+                # forked before this process starts its IOLoop
+                sockets = tornado.netutil.bind_sockets(sg_settings.get('web_port'))
+                web_workers = sgworkers.WorkerPool(workers, logLevel=log.level)
+                web_workers.start(serve_worker, (sockets, sg_settings))
+                for sock in sockets:
+                    sock.close()
+                db_server.add_listener(web_workers.update)
+                # settings saved by a worker are applied here too
+                db_server.add_listener(sg_settings.update)
+
+            # lookups and listings are read on connections of their own, alongside the writes
+            db_reader = sgdatabase.SMSReader(db_server.path, tornado.ioloop.IOLoop.instance(), logLevel=log.level)
+            db_reader.start()
+            # accepted messages are committed to the outbox off the IOLoop
+            outbox_writer = sgoutbox.OutboxWriter(outbox, tornado.ioloop.IOLoop.instance(), logLevel=log.level)
+            outbox_writer.start()
+            if web_workers is None:
+                # keep the status cache current with every sms update written
+                db_server.add_listener(status_cache.update)
+                db_server.add_listener(status_counts.update)
+                # and push every status change to the clients of the status stream
+                if status_stream is None:
+                    status_stream = sgstream.StatusStream(tornado.ioloop.IOLoop.instance(), logLevel=log.level)
+                    db_server.add_listener(status_stream.update)
+            # and post them to the callback_url of the message
+            if webhooks is None:
+                webhooks = sgwebhook.WebhookDispatcher(tornado.ioloop.IOLoop.instance(),
+                    sgwebhook.WebhookStore(data_path(db_server, 'webhooks.db')), logLevel=log.level)
+                webhooks.start()
+                db_server.add_listener(webhooks.update)
+
+            if web_workers is None:
+                web_app = make_app(sg_settings)
+                web_server = tornado.httpserver.HTTPServer(web_app)
+                web_server.listen(sg_settings.get('web_port'))
+            else:
+                ioloop = tornado.ioloop.IOLoop.instance()
+                web_workers.start_watching(lambda pairs: ioloop.add_callback(webhooks.watch, pairs))
+            startup_times['listen'] = time.time() - listen_start
+            log.info('Started in %.2fs, %s', sum(startup_times.values()),
+                ', '.join('{} {:.3f}s'.format(name, secs) for name, secs in startup_times.items()))
             tornado.ioloop.IOLoop.instance().start()
         except Exception as e:
             log.error('Exception ocurred %s:%s', e.message, e.args, exc_info=True)
             raise e
         log.debug('Thread exiting')
 
-    global web_server_thread, modemServer
+    global web_server_thread, shutdown_thread, modemPool, outbox, sms_database, retention
     
     level = level or logLevel
     log.setLevel(level)
-    log.debug('Modem connecting')
+    sms_database = db_server
     mlogConfig = mlogConfig or modem_logConfig
 
-    # Startup Modem Server
+    # Messages left in the outbox by an earlier run go out again
+    with phase('outbox'):
+        outbox = sgoutbox.Outbox(data_path(db_server, 'outbox.db'))
+        recover_outbox(outbox, modemPool.live_pids() if modemPool is not None else [])
+
+    # Startup Modem Servers, one for each configured port.  They connect
+    # in their own processes while the web server starts listening.
+    log.debug('Modem connecting')
     exit_event.clear()
-    modemServer = sgmodem.ModemServer(modem_queue, db_queue, exit_event, sg_settings.get('com_port'),
-        sg_settings.get('min_send_interval'),
-        level, mlogConfig)
-    modemServer.daemon = True
-    modemServer.name = 'ModemServer'
-    modemServer.start()
-    log.debug('Modem connected and ready')
+    with phase('modems'):
+        modemPool = sgpool.ModemPool(modem_queue, db_queue, exit_event, sg_settings.get('com_port'),
+            sg_settings.get('min_send_interval'),
+            level, mlogConfig,
+            max_skip=sg_settings.get('priority_max_skip'),
+            send_burst=sg_settings.get('send_burst'),
+            number_send_interval=sg_settings.get('number_send_interval'),
+            number_burst=sg_settings.get('number_burst'),
+            outbox=outbox,
+            inflight_max=sg_settings.get('inflight_max'),
+            inflight_max_age=sg_settings.get('inflight_max_age'),
+            drain_timeout=sg_settings.get('drain_timeout'),
+            inbox=sginbox.Inbox(db_server.path))
+        modemPool.start()
+    log.debug('Modem processes started')
+
+    # Messages in a final status older than retention_days go to the archive
+    retention = None
+    retention_days = sg_settings.get('retention_days')
+    if retention_days > 0:
+        retention = sgretention.Retention(db_server.path, data_path(db_server, 'archive'),
+            retention_days * 86400, logLevel=level)
+        retention.start()
+
+    # changes to the settings from now on are applied while running
+    sg_settings.add_listener(apply_setting)
 
     # Startup Tornado Web Server
     log.debug('Server starting')
     web_server_thread = Thread(target=start,name='TornadoWebThread')
     web_server_thread.start()
+    # and stop everything once the exit event is set
+    shutdown_thread = Thread(target=shutdown, args=(db_server, sg_settings), name='ShutdownThread')
+    shutdown_thread.start()
     log.debug('Server started')
 
+def serve_worker(index, updates, watches, sockets, sg_settings):
+    # a forked web worker, serving on the sockets of the main process
+    global worker, web_server, web_app, db_reader, status_stream, webhooks, outbox_writer
+    worker = index
+    # the IOLoop and connections of the main process are not used here
+    tornado.ioloop.IOLoop.clear_instance()
+    ioloop = tornado.ioloop.IOLoop.instance()
+    db_reader = sgdatabase.SMSReader(sms_database.path, ioloop, logLevel=log.level)
+    db_reader.start()
+    outbox_writer = sgoutbox.OutboxWriter(outbox, ioloop, logLevel=log.level)
+    outbox_writer.start()
+    # numbered as the main process numbers the updates it feeds the workers
+    status_stream = sgstream.StatusStream(ioloop, seq=web_workers.seq, logLevel=log.level)
+    webhooks = sgworkers.WatchForwarder(watches)
+    stopped = Event()
+    # the settings saved in the main process come with the rows
+    sg_settings.listeners = [apply_web_setting]
+    follower = Thread(target=sgworkers.follow, args=(updates,
+        [status_cache.update, status_counts.update, status_stream.update, sg_settings.update], stopped),
+        name='WorkerFollowThread')
+    follower.daemon = True
+    follower.start()
+    web_app = make_app(sg_settings)
+    web_server = tornado.httpserver.HTTPServer(web_app)
+    web_server.add_sockets(sockets)
+
+    def stop():
+        web_server.stop()
+        stopped.set()
+        db_reader.stop()
+        outbox_writer.stop()
+        # after the handlers of the failed queries answered
+        ioloop.add_callback(ioloop.stop)
+
+    def wait_exit():
+        exit_event.wait()
+        ioloop.add_callback(stop)
+    waiter = Thread(target=wait_exit, name='WorkerExitThread')
+    waiter.daemon = True
+    waiter.start()
+    ioloop.start()
+
+def apply_setting(key, value):
+    # listener of Settings, applies a changed setting to the running server
+    global retention
+    if exit_event.is_set():
+        return # stopped, the settings are read when it starts again
+    if key in modem_settings:
+        if modemPool is not None:
+            modemPool.configure(**{modem_settings[key]: value})
+    elif key == 'retention_days':
+        if retention is not None and value > 0:
+            retention.max_age = value * 86400
+        elif retention is not None:
+            retention.stop()
+            retention = None
+        elif value > 0:
+            retention = sgretention.Retention(sms_database.path, data_path(sms_database, 'archive'),
+                value * 86400, logLevel=log.level)
+            retention.start()
+    elif key in restart_settings:
+        log.warn('%s=%s takes effect when the server is started again', key, value)
+    else:
+        apply_web_setting(key, value)
+
+def apply_web_setting(key, value):
+    # the settings a web worker applies itself, the others are read as requests come
+    if web_app is None:
+        return
+    if key == 'idempotency_ttl':
+        web_app.settings['recent_requests'].ttl = value
+    elif key == 'dedup_window':
+        web_app.settings['recent_messages'].ttl = value
+
+def data_path(db_server, filename):
+    # the outbox and webhook files are kept next to the database file
+    if db_server.url.startswith('sqlite:///'):
+        return os.path.join(os.path.dirname(db_server.url[len('sqlite:///'):]), filename)
+    return exe_path + filename
+
+def recover_outbox(outbox, live_pids):
+    pending, interrupted = outbox.recover(live_pids)
+    if interrupted:
+        log.warn('%d messages were being sent when the server stopped, marking them failed', len(interrupted))
+        db_queue.put((sgdatabase.PUT_MANY, ('id', 'sms',
+            [dict(id=requestID, request_status=sgmodem.UNKNOWNERROR) for requestID in interrupted])))
+    for i in range(0, len(pending), 1000):
+        modem_queue.put(pending[i:i+1000])
+    if pending:
+        log.info('Queued %d messages again from the outbox', len(pending))
+
 def stop_server(*args):
-    global web_server, web_server_thread, modemServer, exit_event
+    # the shutdown thread takes it from here
+    exit_event.set()
 
-    log.debug('Server stopping')
-    web_server.stop()
+def shutdown(db_server, sg_settings):
+    '''Waits for the exit event, then stops the server in order: no new
+    requests, the web workers, the modems once they have sent what they can
+    in drain_timeout secs, and the database after the last status written.
+    The IOLoop keeps running until the end, so callbacks of the statuses
+    written meanwhile still go out.'''
+    global web_workers, retention
+    exit_event.wait()
+    start = time.time()
+    times = OrderedDict()
+    drain_timeout = sg_settings.get('drain_timeout')
     ioloop = tornado.ioloop.IOLoop.instance()
-    ioloop.add_callback(ioloop.stop)
-#    web_server_thread.join()
-    log.debug('Server stopped')
 
+    def stopped(name, since):
+        times[name] = time.time() - since
+        return time.time()
+
+    log.debug('Server stopping')
+    since = start
+    accepting = Event()
+    def stop_accepting():
+        if web_server is not None:
+            web_server.stop()
+        accepting.set()
+    ioloop.add_callback(stop_accepting)
+    accepting.wait(5)
+    if web_workers is not None:
+        web_workers.stop()
+        web_workers = None
+    if outbox_writer is not None:
+        # the messages of the last requests are in the outbox before the modems finish
+        outbox_writer.stop()
+    since = stopped('web', since)
+    if retention is not None:
+        retention.stop()
+        retention.thread.join()
+    since = stopped('retention', since)
     log.debug('Modem stopping')
-    exit_event.set()
-    log.debug('Modem stopped')
+    # the modems drain on their own once the exit event is set, a few secs
+    # are added for the send in progress at the deadline
+    modemPool.stop(drain_timeout + 10)
+    since = stopped('modems', since)
+    if outbox is not None:
+        left = outbox.count()
+        if left:
+            log.warn('%d messages stay in the outbox for the next start', left)
+    db_reader.stop()
+    # We only stop the db_server as well if True.
+    # This allows for a GUI to continue running and have 
+    # access to the settings database
+    if stop_db_server:
+        db_server.stop_thread()
+        db_server.thread.join()
+        since = stopped('database', since)
+    if webhooks is not None:
+        ioloop.add_callback(webhooks.stop)
+    ioloop.add_callback(ioloop.stop)
+    log.info('Stopped in %.2fs, %s', time.time() - start,
+        ', '.join('{} {:.3f}s'.format(name, secs) for name, secs in times.items()))
+
+def wait_stopped():
+    # Python 2 only runs signal handlers between bytecodes, so the main
+    # thread joins in steps for Ctrl-C to reach signal_exit
+    for thread in (shutdown_thread, web_server_thread):
+        while thread is not None and thread.is_alive():
+            thread.join(0.5)
+
+@contextmanager
+def phase(name):
+    # times a phase of the start
+    start = time.time()
+    yield
+    startup_times[name] = time.time() - start
 
 def init(argv):
-    port, com, interval, keyprotection, key, dbfile = get_args(argv)
+    port, com, interval, keyprotection, key, dbfile, workers, vacuum = get_args(argv)
 
     logging.basicConfig(**rootLogConfig)
 
@@ -172,29 +616,39 @@ def init(argv):
         db_server = sgdatabase.SMSDatabase(logLevel=logLevel)
     else:
         db_server = sgdatabase.SMSDatabase(url='sqlite:///'+dbfile,logLevel=logLevel)
-    db_server.start_thread(db_queue, opipe)
-    sg_settings = Settings(db_server, logLevel=logLevel)
-    sg_settings.set_defaults()
-
-    save_arg_settings(sg_settings, port, com, interval, keyprotection, key)
+    if vacuum:
+        # maintenance only, the server is not started
+        db_server.connect()
+        db_server.rebuild()
+        sys.exit()
+    startup_times.clear()
+    with phase('database'):
+        db_server.start_thread(db_queue)
+        db_server.connected.wait()
+    with phase('settings'):
+        sg_settings = Settings(db_server, logLevel=logLevel)
+        sg_settings.set_defaults()
+        save_arg_settings(sg_settings, port, com, interval, keyprotection, key, workers)
 
     return db_server, sg_settings
 
 def usage():
     print('\
         -p --port <web port> : web server port\n\
-        -c --com <com port> : serial or comm port\n\
-        -t --interval <time> : time between each SMS in sec\n\
+        -c --com <com ports> : serial or comm port, separate several ports with commas and append @<time> for a port specific interval\n\
+        -t --interval <time> : time between each SMS in sec, fractions allowed\n\
         -a --keyprotection <1:0>: enable/disable secret key only access. If not specified, existing database setting or default setting of 0 will be used\n\
         -d --dbfile <file> : location of database file. If not specified, a file database.db will be created in current directory\n\
         -k --keyfile <file> : location of a file containing the secret key.  If not specified but keyprotection is enabled, a random one will be generated and saved in the database\n\
         -l --logdir <dir> : location where the log files will be written to.  If not specified, the current directory will be used\n\
+        -w --workers <count> : web server processes sharing the port, 1 by default.  Not available on Windows\n\
+        --vacuum : rebuild the database file once so retention_days can shrink it, then exit.  Takes a while for a large file\n\
         -v : enable debugging output')
 
 def get_args(argv):
     try:
         opts, args = getopt.getopt(argv, 
-                                "hp:c:t:a:d:k:l:v", [
+                                "hp:c:t:a:d:k:l:w:v", [
                                 'help',
                                 'port=',
                                 'com=',
@@ -203,6 +657,8 @@ def get_args(argv):
                                 'dbfile=',
                                 'keyfile=',
                                 'logdir=',
+                                'workers=',
+                                'vacuum',
                                 'debug'
                                 ])
     except getopt.GetoptError:
@@ -210,7 +666,8 @@ def get_args(argv):
         usage()
         sys.exit(2)
     
-    port = com = interval = keyprotection = dbfile = key = None
+    port = com = interval = keyprotection = dbfile = key = workers = None
+    vacuum = False
 
     for opt, arg in opts:
         if opt in ("-h", "--help"):
@@ -233,13 +690,25 @@ def get_args(argv):
             exe_path = arg
             rootLogConfig['filename']=exe_path+'/main.log'
             modem_logConfig['filename']=exe_path+'/modem.log'
+        elif opt in ("-w", "--workers"):
+            workers = arg
+        elif opt == "--vacuum":
+            vacuum = True
         elif opt in ("-v", "--debug"):
             global logLevel
             logLevel = logging.DEBUG
+
+    if com is not None:
+        try:
+            parse_com_port(com)
+        except ValueError:
+            print('Incorrect com port {}'.format(com))
+            usage()
+            sys.exit(2)
     
-    return port, com, interval, keyprotection, key, dbfile
+    return port, com, interval, keyprotection, key, dbfile, workers, vacuum
 
-def save_arg_settings(sg_settings, port, com, interval, keyprotection, key):
+def save_arg_settings(sg_settings, port, com, interval, keyprotection, key, workers=None):
     if port is not None:
         sg_settings.save('web_port', str(port))
     if com is not None:
@@ -250,6 +719,8 @@ def save_arg_settings(sg_settings, port, com, interval, keyprotection, key):
         sg_settings.save('keyprotection',str(keyprotection))
     if key is not None:
         sg_settings.save('key', str(key))
+    if workers is not None:
+        sg_settings.save('web_workers', str(workers))
 
 def signal_exit(*args):
     exit_event.set()
@@ -262,8 +733,5 @@ if __name__ == "__main__":
     db_server, sg_settings = init(sys.argv[1::])
 
     start_server(sg_settings, db_server)
-    web_server_thread.join()
-
-    log.debug('Waiting 10 secs for everything to shutdown')
-    time.sleep(10) # wait 10 secs
+    wait_stopped()
     print 'Bye Now'
\ No newline at end of file
@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+'''GSM modem simulator answering on a pseudo-terminal the AT commands
+sgatmodem.ATModem and gsmmodem.GsmModem send, so ModemServer can be run
+through its serial and AT code without hardware.
+
+    python sgsimulator.py -n 2 -L /tmp/sgsim --report-delay 2
+    python sgserver.py -c /tmp/sgsim0,/tmp/sgsim1
+
+Messages are taken in PDU mode and answered with a +CMGS reference.  When a
+status report was requested it is stored in "SR" memory and announced with
++CDSI, or sent straight away as +CDS depending on AT+CNMI.  Messages can be
+received every so often, stored in "SM" memory and announced with +CMTI,
+and some can be in memory from the start.  Latency, errors, report outcome
+and stalls or disconnects of the modem can be configured.'''
+import os, sys, select, getopt, logging, time, random, heapq, re, threading, datetime, binascii, tty
+from gsmmodem.pdu import decodeSmsPdu, encodeSmsSubmitPdu, Concatenation, _encodeAddressField, _encodeTimestamp
+from gsmmodem.util import SimpleOffsetTzInfo
+
+log = logging.getLogger('sgsimulator.ModemSimulator')
+
+CTRLZ = '\x1a'
+ESC = '\x1b'
+
+# secs without a command before an unsolicited report is sent, one sent while
+# the client waits for a response would be taken as part of it.  Reports are
+# sent one at a time, gsmmodem only handles the first of several arriving together.
+QUIET_TIME = 0.1
+
+# TP-Status values of a status report
+REPORT_DELIVERED = 0x00
+REPORT_FAILED = 0x41 # permanent error, incompatible destination
+
+# <stat> of a stored message in PDU mode
+REC_UNREAD = 0
+REC_READ = 1
+
+# number received messages come from
+SENDER = '+15550199'
+
+class ModemSimulator(object):
+    '''One simulated modem.  Each error and report rate is a fraction of
+    messages between 0 and 1.'''
+
+    def __init__(self, link=None, latency=0, send_latency=0, report_delay=1, report_jitter=0,
+                report_failure=0, report_all_parts=False, cms_error=0, cms_code=500, cme_error=0, cme_code=100,
+                stall_after=0, stall_for=30, disconnect_after=0, receive_every=0, receive_parts=1,
+                stored=0, capacity=100, seed=None):
+        self.link = link
+        self.latency = latency
+        self.send_latency = send_latency
+        self.report_delay = report_delay
+        self.report_jitter = report_jitter
+        self.report_failure = report_failure
+        self.report_all_parts = report_all_parts
+        self.cms_error = cms_error
+        self.cms_code = cms_code
+        self.cme_error = cme_error
+        self.cme_code = cme_code
+        self.stall_after = stall_after
+        self.stall_for = stall_for
+        self.disconnect_after = disconnect_after
+        self.random = random.Random(seed)
+        self.master = self.slave = None
+        self.path = None
+        self.alive = False
+        self.stopped = threading.Event()
+        self.thread = None
+        self.echo = True
+        self.buffer = ''
+        self.pdu_length = None # set while the PDU of an AT+CMGS is being read
+        self.reference = 0
+        self.reports_to = 'SR' # +CDSI to stored reports, or 'TE' for +CDS
+        # memory -> index -> [stat, PDU], status reports in "SR", received messages in "SM"
+        self.storage = {'SR': {}, 'SM': {}}
+        self.capacity = capacity # messages each memory holds
+        self.memory = 'SM' # read and delete memory, set with AT+CPMS
+        self.scheduled = [] # heap of (due, kind, PDUs), kind is 'report' or 'message'
+        self.receive_every = receive_every
+        self.receive_parts = receive_parts
+        self.next_receive = time.time() + receive_every if receive_every else None
+        self.stalled_until = 0
+        self.last_command = 0
+        self.stats = dict(commands=0, messages=0, parts=0, reports=0, cms_errors=0, cme_errors=0,
+                          received=0, dropped=0)
+        for i in range(stored):
+            for pdu in self.incoming():
+                self.store('SM', pdu)
+
+    def open(self):
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.path = os.ttyname(slave)
+        # the slave stays open so the pty survives the client closing and reopening it
+        self.slave = slave
+        if self.link:
+            if os.path.lexists(self.link):
+                os.remove(self.link)
+            os.symlink(self.path, self.link)
+        self.alive = True
+        log.info('Simulated modem on %s%s', self.path, ' as ' + self.link if self.link else '')
+        return self.link or self.path
+
+    def start(self, name=None):
+        # serve_forever on a daemon thread until stop()
+        self.thread = threading.Thread(target=self.serve_forever, name=name or 'ModemSimulator')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        '''Ends serve_forever and waits for its thread, so it is not left
+        running into interpreter shutdown.'''
+        self.stopped.set()
+        if self.thread:
+            self.thread.join(timeout)
+        self.close()
+
+    def close(self):
+        self.alive = False
+        # stop() and serve_forever both close, a descriptor closed twice
+        # could already belong to another file
+        for fd in (self.master, self.slave):
+            if fd is None:
+                continue
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.master = self.slave = None
+        if self.link and os.path.islink(self.link):
+            os.remove(self.link)
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def respond(self, *lines):
+        # each line framed as the modem would, ending in a result code
+        self.write(''.join('\r\n{}\r\n'.format(line) for line in lines))
+
+    def serve_forever(self):
+        while self.alive and not self.stopped.is_set():
+            due = [t for t in (self.scheduled[0][0] if self.scheduled else None, self.next_receive) if t]
+            # woken at least once a second to notice stop()
+            timeout = min(1, max(QUIET_TIME, min(due) - time.time())) if due else 1
+            try:
+                readable = select.select([self.master], [], [], timeout)[0]
+            except (OSError, select.error):
+                break
+            if readable:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    break
+                if time.time() < self.stalled_until:
+                    log.debug('Stalled, ignoring %r', data)
+                    continue
+                self.last_command = time.time()
+                self.receive(data)
+            if self.next_receive and self.next_receive <= time.time():
+                self.next_receive += self.receive_every
+                heapq.heappush(self.scheduled, (time.time(), 'message', self.incoming()))
+            self.send_unsolicited()
+        self.close()
+
+    def receive(self, data):
+        self.buffer += data
+        while self.alive:
+            if self.pdu_length is not None:
+                end = min(i for i in (self.buffer.find(CTRLZ), self.buffer.find(ESC), len(self.buffer)) if i >= 0)
+                if end == len(self.buffer):
+                    return
+                pdu, terminator, self.buffer = self.buffer[:end], self.buffer[end], self.buffer[end + 1:]
+                if self.echo:
+                    self.write(pdu)
+                self.pdu_length = None
+                if terminator == CTRLZ:
+                    self.submit(pdu.strip())
+                else:
+                    self.respond('OK')
+                continue
+            end = self.buffer.find('\r')
+            if end < 0:
+                return
+            command, self.buffer = self.buffer[:end].strip(), self.buffer[end + 1:].lstrip('\n')
+            if command:
+                if self.echo:
+                    self.write(command + '\r')
+                self.stats['commands'] += 1
+                if self.latency:
+                    time.sleep(self.latency)
+                self.command(command)
+
+    def command(self, command):
+        log.debug('Command %s', command)
+        upper = command.upper()
+        if upper in ('AT', 'ATZ') or re.match(r'AT\+(CMEE|CFUN|COPS|CSMP|CLIP|CRC|CVHU|CSCA)=', upper):
+            self.respond('OK')
+        elif upper in ('ATE0', 'ATE1'):
+            self.echo = upper == 'ATE1'
+            self.respond('OK')
+        elif upper == 'AT+CFUN?':
+            self.respond('+CFUN: 1', 'OK')
+        elif upper == 'AT+CPIN?':
+            self.respond('+CPIN: READY', 'OK')
+        elif upper == 'AT+CLAC':
+            self.respond('+CLAC: +CMGS,+CMGR,+CMGD,+CMGL,+CMGF,+CPMS,+CNMI,+CSMP,+CSCA,+CSQ,+CREG,+COPS', 'OK')
+        elif upper == 'AT+CGMI':
+            self.respond('sgsimulator', 'OK')
+        elif upper == 'AT+CGMM':
+            self.respond('Simulated GSM modem', 'OK')
+        elif upper == 'AT+CGMR':
+            self.respond('1.0', 'OK')
+        elif upper in ('AT+CGSN', 'AT+CIMI'):
+            self.respond('001010123456789', 'OK')
+        elif upper == 'AT+COPS?':
+            self.respond('+COPS: 0,0,"Simulator",2', 'OK')
+        elif upper == 'AT+CSQ':
+            self.respond('+CSQ: 20,99', 'OK')
+        elif upper == 'AT+CREG?':
+            self.respond('+CREG: 0,1', 'OK')
+        elif upper == 'AT+CSCA?':
+            self.respond('+CSCA: "+15550000000",145', 'OK')
+        elif upper == 'AT+CMGF=0':
+            self.respond('OK')
+        elif upper == 'AT+CPMS=?':
+            self.respond('+CPMS: ("SM","SR"),("SM"),("SM")', 'OK')
+        elif upper == 'AT+CPMS?':
+            self.respond('+CPMS: "{0}",{1},{3},"SM",{2},{3},"SM",{2},{3}'.format(
+                self.memory, len(self.storage[self.memory]), len(self.storage['SM']), self.capacity), 'OK')
+        elif upper.startswith('AT+CPMS='):
+            memory = upper[8:].split(',')[0].strip('"')
+            if memory not in self.storage:
+                self.respond('+CMS ERROR: 302') # operation not allowed
+                return
+            self.memory = memory
+            used = len(self.storage[memory])
+            self.respond('+CPMS: {0},{1},{0},{1},{0},{1}'.format(used, self.capacity), 'OK')
+        elif upper.startswith('AT+CNMI='):
+            # <ds> of 1 sends reports straight away, 2 stores them
+            params = upper[8:].split(',')
+            self.reports_to = 'TE' if len(params) > 3 and params[3] == '1' else 'SR'
+            self.respond('OK')
+        elif upper.startswith('AT+CMGS='):
+            self.pdu_length = int(upper[8:])
+            self.write('\r\n> ')
+        elif upper.startswith('AT+CMGR='):
+            entry = self.storage[self.memory].get(int(upper[8:]))
+            if entry is None:
+                self.respond('+CMS ERROR: 321') # invalid memory index
+            else:
+                self.respond('+CMGR: {},,{}'.format(entry[0], len(entry[1]) // 2 - 1), entry[1], 'OK')
+                entry[0] = REC_READ
+        elif upper.startswith('AT+CMGD='):
+            stored = self.storage[self.memory]
+            params = upper[8:].split(',')
+            flag = int(params[1]) if len(params) > 1 and params[1] else 0
+            if flag == 0:
+                stored.pop(int(params[0]), None)
+            else:
+                # 1 deletes the messages read, 2 and 3 also sent and unsent ones, which are not kept here, 4 all
+                for index in [i for i, entry in stored.items() if flag == 4 or entry[0] == REC_READ]:
+                    del stored[index]
+            self.respond('OK')
+        elif upper.startswith('AT+CMGL'):
+            # <stat> 4 lists all, 0 and 1 only the unread or read ones
+            stat = int(upper[8:] or 4) if upper.startswith('AT+CMGL=') else REC_UNREAD
+            lines = []
+            for index, entry in sorted(self.storage[self.memory].items()):
+                if stat == 4 or entry[0] == stat:
+                    lines += ['+CMGL: {},{},,{}'.format(index, entry[0], len(entry[1]) // 2 - 1), entry[1]]
+                    entry[0] = REC_READ
+            self.respond(*(lines + ['OK']))
+        else:
+            self.respond('ERROR')
+
+    def submit(self, pdu):
+        if self.send_latency:
+            time.sleep(self.send_latency)
+        try:
+            sms = decodeSmsPdu(pdu)
+        except Exception as e:
+            log.warn('Unable to decode PDU %s %s', pdu, e.args)
+            self.respond('+CMS ERROR: 304') # invalid PDU parameter
+            return
+        chance = self.random.random()
+        if chance < self.cms_error:
+            self.stats['cms_errors'] += 1
+            self.respond('+CMS ERROR: {}'.format(self.cms_code))
+            return
+        if chance < self.cms_error + self.cme_error:
+            self.stats['cme_errors'] += 1
+            self.respond('+CME ERROR: {}'.format(self.cme_code))
+            return
+        reference = self.reference
+        self.reference = (self.reference + 1) % 256
+        self.stats['parts'] += 1
+        concatenation = [ie for ie in sms.get('udh', []) if isinstance(ie, Concatenation)]
+        last_part = not concatenation or concatenation[0].number == concatenation[0].parts
+        if last_part:
+            self.stats['messages'] += 1
+        log.debug('Message part to %s with reference %d%s', sms['number'], reference,
+                  ' ({}/{})'.format(concatenation[0].number, concatenation[0].parts) if concatenation else '')
+        self.respond('+CMGS: {}'.format(reference), 'OK')
+        # TP-SRR asks for a status report
+        first_octet = bytearray(binascii.unhexlify(pdu))[1 + int(pdu[:2], 16)]
+        if first_octet & 0x20 and (last_part or self.report_all_parts):
+            failed = self.random.random() < self.report_failure
+            due = time.time() + self.report_delay + self.random.uniform(0, self.report_jitter)
+            heapq.heappush(self.scheduled, (due, 'report', [status_report(reference, sms['number'],
+                REPORT_FAILED if failed else REPORT_DELIVERED)]))
+        if self.disconnect_after and self.stats['messages'] >= self.disconnect_after:
+            log.warn('Disconnecting after %d messages', self.stats['messages'])
+            self.alive = False
+        elif self.stall_after and last_part and self.stats['messages'] % self.stall_after == 0:
+            log.warn('Stalling for %ss after %d messages', self.stall_for, self.stats['messages'])
+            self.stalled_until = time.time() + self.stall_for
+
+    def send_unsolicited(self):
+        # the next status report or received message that is due
+        now = time.time()
+        if not self.scheduled or self.scheduled[0][0] > now or now - self.last_command < QUIET_TIME:
+            return
+        if now < self.stalled_until:
+            return
+        # a command on its way would take the report as part of its response
+        if select.select([self.master], [], [], 0)[0]:
+            return
+        due, kind, pdus = heapq.heappop(self.scheduled)
+        # the next one waits for the client to have read this one
+        self.last_command = now
+        if kind == 'message':
+            indexes = [self.store('SM', pdu) for pdu in pdus]
+            if None in indexes:
+                log.warn('Memory full, dropping a received message')
+                self.stats['dropped'] += 1
+            self.respond(*['+CMTI: "SM",{}'.format(index) for index in indexes if index is not None])
+            return
+        self.stats['reports'] += 1
+        pdu = pdus[0]
+        if self.reports_to == 'TE':
+            self.respond('+CDS: {}'.format(len(pdu) // 2 - 1), pdu)
+            return
+        index = self.store('SR', pdu)
+        if index is None:
+            log.warn('Memory full, dropping a status report')
+            self.stats['dropped'] += 1
+        else:
+            self.respond('+CDSI: "SR",{}'.format(index))
+
+    def store(self, memory, pdu):
+        # the index a PDU is stored at, None when the memory is full
+        stored = self.storage[memory]
+        for index in range(1, self.capacity + 1):
+            if index not in stored:
+                stored[index] = [REC_UNREAD, pdu]
+                return index
+        return None
+
+    def incoming(self):
+        # the PDUs of the next message received, in receive_parts parts
+        self.stats['received'] += 1
+        number = self.stats['received']
+        text = 'Received message {} '.format(number)
+        if self.receive_parts > 1:
+            text = (text * 100)[:153 * (self.receive_parts - 1) + 10]
+        return deliver_pdus(SENDER, text, number % 256)
+
+def status_report(reference, number, status):
+    # SMS-STATUS-REPORT PDU without an SMSC address, as a hex string
+    now = datetime.datetime.now(SimpleOffsetTzInfo(0))
+    pdu = bytearray([0x00, 0x06, reference])
+    pdu.extend(_encodeAddressField(number))
+    pdu.extend(_encodeTimestamp(now))
+    pdu.extend(_encodeTimestamp(now))
+    pdu.append(status)
+    return binascii.hexlify(pdu).upper()
+
+def deliver_pdus(number, text, reference):
+    # SMS-DELIVER PDUs of a message from number as hex strings, made from the
+    # SMS-SUBMIT ones gsmmodem encodes, which have the same user data
+    now = datetime.datetime.now(SimpleOffsetTzInfo(0))
+    pdus = []
+    for submit in encodeSmsSubmitPdu(number, text, reference=reference, requestStatusReport=False):
+        data = submit.data
+        i = data[0] + 3 # after the SMSC, first octet and TP-MR, no TP-VP is encoded
+        i += 2 + (data[i] + 1) // 2 # after TP-DA
+        pdu = bytearray([0x00, 0x04 | (data[data[0] + 1] & 0x40)]) # SMS-DELIVER, keeping TP-UDHI
+        pdu.extend(_encodeAddressField(number))
+        pdu.extend(data[i:i + 2]) # TP-PID and TP-DCS
+        pdu.extend(_encodeTimestamp(now))
+        pdu.extend(data[i + 2:]) # TP-UDL and TP-UD
+        pdus.append(binascii.hexlify(pdu).upper())
+    return pdus
+
+def usage():
+    print('\
+        -n --modems <count> : number of simulated modems, 1 by default\n\
+        -L --link <path> : symlink to the pty of each modem, numbered from 0 when there are several\n\
+        --latency <secs> : delay before answering each AT command\n\
+        --send-latency <secs> : extra delay before answering each message part\n\
+        --report-delay <secs> : time from sending to its status report, 1 by default\n\
+        --report-jitter <secs> : random extra report delay up to this\n\
+        --report-failure <fraction> : messages reported as failed\n\
+        --report-all-parts : send a report for every part of a long message, not only the last\n\
+        --cms-error <fraction> : messages answered with +CMS ERROR, code set with --cms-code\n\
+        --cme-error <fraction> : messages answered with +CME ERROR, code set with --cme-code\n\
+        --stall-after <count> : stop answering for --stall-for secs after every count messages\n\
+        --disconnect-after <count> : close the port after count messages\n\
+        --receive-every <secs> : receive a message this often\n\
+        --receive-parts <count> : parts of each message received, 1 by default\n\
+        --stored <count> : messages received before the start, waiting in memory\n\
+        --capacity <count> : messages each memory holds, 100 by default\n\
+        --seed <number> : seed for the error and failure choices\n\
+        -v : enable debugging output')
+
+def get_args(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hn:L:v", [
+                                'help', 'modems=', 'link=', 'latency=', 'send-latency=',
+                                'report-delay=', 'report-jitter=', 'report-failure=', 'report-all-parts',
+                                'cms-error=', 'cms-code=', 'cme-error=', 'cme-code=',
+                                'stall-after=', 'stall-for=', 'disconnect-after=', 'receive-every=',
+                                'receive-parts=', 'stored=', 'capacity=', 'seed=', 'debug'])
+    except getopt.GetoptError:
+        print('Incorrect settings passed')
+        usage()
+        sys.exit(2)
+    count, link, options, level = 1, None, {}, logging.INFO
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-n', '--modems'):
+            count = int(arg)
+        elif opt in ('-L', '--link'):
+            link = arg
+        elif opt in ('-v', '--debug'):
+            level = logging.DEBUG
+        elif opt == '--report-all-parts':
+            options['report_all_parts'] = True
+        elif opt in ('--cms-code', '--cme-code', '--stall-after', '--disconnect-after', '--receive-parts',
+                     '--stored', '--capacity', '--seed'):
+            options[opt[2:].replace('-', '_')] = int(arg)
+        else:
+            options[opt[2:].replace('-', '_')] = float(arg)
+    return count, link, options, level
+
+if __name__ == '__main__':
+    count, link, options, level = get_args(sys.argv[1:])
+    logging.basicConfig(level=level, format='%(asctime)s - %(levelname)s:%(name)s: %(message)s')
+    simulators = []
+    for i in range(count):
+        name = link if link and count == 1 else (link + str(i) if link else None)
+        simulator = ModemSimulator(name, **options)
+        print(simulator.open())
+        sys.stdout.flush()
+        simulator.start('ModemSimulator-{}'.format(i))
+        simulators.append(simulator)
+    try:
+        while any(s.alive for s in simulators):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    for simulator in simulators:
+        simulator.stop()
+        log.info('%s: %s', simulator.link or simulator.path, simulator.stats)
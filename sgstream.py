@@ -0,0 +1,103 @@
+import logging, itertools
+from collections import deque
+from threading import Lock
+from tornado import locks
+
+log = logging.getLogger('sgstream.StatusStream')
+
+class Subscription(object):
+    '''One client of the status stream.  ids is the set of requestIDs it
+    follows, or None for all of them.  cursor is the sequence number of the
+    last event it has been given.'''
+
+    def __init__(self, ids, cursor):
+        self.ids = ids
+        self.cursor = cursor
+        self.event = locks.Event()
+
+class StatusStream(object):
+    '''Fans the sms status updates committed by SMSDatabase out to the
+    clients waiting on them.
+
+    Every update gets a sequence number and the last history updates are
+    kept, so a client that reconnects or polls again with the last number it
+    saw gets what it missed.  In a web worker the updates come numbered by
+    the WorkerPool, so the numbers are the same in every worker and carry on
+    from seq in one forked later.  Subscriptions are plain objects woken through
+    the IOLoop, waiting clients cost no thread.'''
+
+    def __init__(self, ioloop, history=10000, seq=0, logLevel=logging.WARNING):
+        self.ioloop = ioloop
+        self.events = deque(maxlen=history) # (seq, requestID, request_status)
+        self.seq = seq
+        self.by_id = {} # requestID -> set of subscriptions
+        self.everyone = set()
+        self.subscribers = 0
+        self.pending = [] # updates from the database thread not yet published
+        self.lock = Lock()
+        log.setLevel(logLevel)
+
+    def update(self, table, data):
+        # listener for rows committed by SMSDatabase, called from its thread
+        if table != 'sms' or 'request_status' not in data:
+            return
+        with self.lock:
+            self.pending.append((data.get('seq'), data['id'], data['request_status']))
+            if len(self.pending) > 1:
+                return # a publish is scheduled already
+        self.ioloop.add_callback(self.publish)
+
+    def publish(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        woken = set(self.everyone)
+        for seq, requestID, request_status in pending:
+            if seq is not None and seq <= self.seq:
+                continue # numbered before this worker was forked
+            self.seq = seq if seq is not None else self.seq + 1
+            self.events.append((self.seq, requestID, request_status))
+            woken.update(self.by_id.get(requestID, ()))
+        for subscription in woken:
+            subscription.event.set()
+        log.debug('Published %d updates to %d subscribers', len(pending), len(woken))
+
+    def subscribe(self, ids=None, since=None):
+        subscription = Subscription(ids, self.seq if since is None else min(since, self.seq))
+        self.subscribers += 1
+        if ids is None:
+            self.everyone.add(subscription)
+        else:
+            for requestID in ids:
+                self.by_id.setdefault(requestID, set()).add(subscription)
+        if subscription.cursor < self.seq:
+            subscription.event.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers -= 1
+        if subscription.ids is None:
+            self.everyone.discard(subscription)
+            return
+        for requestID in subscription.ids:
+            subscribers = self.by_id.get(requestID)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.by_id[requestID]
+
+    def read(self, subscription):
+        # events after the subscription's cursor that it follows, oldest first
+        subscription.event.clear()
+        events = []
+        if not self.events or self.events[-1][0] <= subscription.cursor:
+            return events
+        # the history is in sequence order, so skip straight to the cursor
+        start = max(0, len(self.events) - (self.seq - subscription.cursor))
+        for event in itertools.islice(self.events, start, None):
+            if subscription.ids is None or event[1] in subscription.ids:
+                events.append(event)
+        subscription.cursor = self.seq
+        return events
+
+    def stats(self):
+        return dict(subscribers=self.subscribers, seq=self.seq)
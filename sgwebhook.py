@@ -0,0 +1,304 @@
+import logging, threading, time, json, random, Queue
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+import sgmodem
+import sgdatabase
+
+log = logging.getLogger('sgwebhook.WebhookDispatcher')
+
+# statuses a callback_url is told about
+NOTIFY_STATUSES = (sgmodem.ENROUTE,) + sgmodem.FINAL_STATUSES
+
+# curl keeps connections to a callback host alive between requests, the
+# simple client of tornado 4.5 opens a new one for each
+KEEPALIVE = False
+try:
+    import pycurl
+    AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient')
+    KEEPALIVE = True
+except ImportError:
+    pass
+
+class WebhookStore(sgdatabase.SQLiteStore):
+    '''SQLite record of the callback_url of every message not yet in a
+    final status and of the callbacks waiting to be retried, so neither is
+    lost on a restart.  Read from the IOLoop thread and written by a
+    WebhookWriter.'''
+
+    def setup(self, conn):
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS watch (
+            id INTEGER PRIMARY KEY,
+            url TEXT NOT NULL)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS retry (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NOT NULL,
+            events TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            next_at REAL NOT NULL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_retry_next_at ON retry (next_at)')
+
+    def watches(self):
+        return dict(self.conn.execute('SELECT id, url FROM watch'))
+
+    def watch(self, pairs):
+        # pairs of (requestID, url)
+        self.conn.executemany('INSERT OR REPLACE INTO watch (id, url) VALUES (?, ?)', pairs)
+
+    def forget(self, requestIDs):
+        self.conn.executemany('DELETE FROM watch WHERE id=?', [(i,) for i in requestIDs])
+
+    def add_retry(self, url, events, attempts, next_at):
+        self.conn.execute('INSERT INTO retry (url, events, attempts, next_at) VALUES (?, ?, ?, ?)',
+                          (url, json.dumps(events), attempts, next_at))
+
+    def update_retry(self, seq, attempts, next_at):
+        self.conn.execute('UPDATE retry SET attempts=?, next_at=? WHERE seq=?', (attempts, next_at, seq))
+
+    def remove_retry(self, seq):
+        self.conn.execute('DELETE FROM retry WHERE seq=?', (seq,))
+
+    def due(self, now, limit):
+        return [(seq, url, json.loads(events), attempts) for seq, url, events, attempts in self.conn.execute(
+            'SELECT seq, url, events, attempts FROM retry WHERE next_at <= ? ORDER BY next_at LIMIT ?', (now, limit))]
+
+    def retries(self):
+        return self.conn.execute('SELECT COUNT(*) FROM retry').fetchone()[0]
+
+class WebhookWriter(object):
+    '''Calls the writing methods of a WebhookStore from a thread of its own
+    and answers with Futures, so the IOLoop never waits on the fsync of a
+    commit.  The calls that arrive while one commit is under way go in the
+    next, one transaction for all.'''
+
+    def __init__(self, store, ioloop, logLevel=logging.WARNING):
+        self.store = store
+        self.ioloop = ioloop
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.log = logging.getLogger('sgwebhook.WebhookWriter')
+        self.log.setLevel(logLevel)
+
+    def call(self, method, *args):
+        # store.method(*args), resolves once it is committed
+        future = Future()
+        self.queue.put((future, method, args))
+        return future
+
+    def sync(self, timeout=10):
+        # blocks until what is queued is committed, for the last writes at shutdown
+        done = threading.Event()
+        self.queue.put((None, None, done))
+        done.wait(timeout)
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            try:
+                while True:
+                    item = self.queue.get_nowait()
+                    if item is None:
+                        self.queue.put(None) # exits after this batch
+                        break
+                    batch.append(item)
+            except Queue.Empty:
+                pass
+            calls = [item for item in batch if item[0] is not None]
+            try:
+                conn = self.store.conn
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    for future, method, args in calls:
+                        getattr(self.store, method)(*args)
+                except:
+                    conn.execute('ROLLBACK')
+                    raise
+                conn.execute('COMMIT')
+            except Exception as e:
+                self.log.error('Writing %d webhook changes failed %s', len(calls), e.args, exc_info=True)
+                for future, method, args in calls:
+                    self.ioloop.add_callback(future.set_exception, e)
+            else:
+                for future, method, args in calls:
+                    self.ioloop.add_callback(future.set_result, None)
+            for future, method, done in batch:
+                if future is None:
+                    done.set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.write_loop, name='WebhookWriterThread')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        # what is queued is still written
+        self.queue.put(None)
+        if self.thread is not None:
+            self.thread.join()
+
+class WebhookDispatcher(object):
+    '''POSTs status changes to the callback_url given with a message.
+
+    Updates come from the database thread as a listener and are handed to
+    the IOLoop, so a slow callback never holds up the database or the
+    modems.  Each URL has at most one request in flight; the events that
+    arrive meanwhile go out together in the next one, up to batch_size per
+    request.  A failed request is kept in the store and retried with
+    exponential backoff until max_attempts.'''
+
+    def __init__(self, ioloop, store, batch_size=100, batch_wait=0.5, timeout=10, max_queued=1000,
+                 max_attempts=10, base_delay=5, max_delay=3600, logLevel=logging.WARNING):
+        self.ioloop = ioloop
+        self.store = store
+        self.writer = WebhookWriter(store, ioloop, logLevel=logLevel)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.timeout = timeout
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.urls = {} # requestID -> callback_url, read from the database thread
+        self.queues = {} # url -> events waiting to be sent
+        self.sending = set() # urls with a request in flight
+        self.pending = [] # updates from the database thread not yet queued
+        self.lock = threading.Lock()
+        self.stats = dict(sent=0, failed=0, dropped=0)
+        log.setLevel(logLevel)
+
+    def start(self):
+        if not KEEPALIVE:
+            log.warn('pycurl is not installed, every callback opens a new connection')
+        self.urls.update(self.store.watches())
+        self.writer.start()
+        self.ioloop.add_callback(self.retry_loop)
+
+    def stop(self):
+        # on the IOLoop at shutdown, the events not sent yet are kept in the
+        # store and go out after the next start
+        self.take_pending()
+        parked = 0
+        for url, events in self.queues.items():
+            for i in range(0, len(events), self.batch_size):
+                self.writer.call('add_retry', url, events[i:i+self.batch_size], 0, time.time())
+            parked += len(events)
+        self.queues = {}
+        self.writer.sync()
+        if parked:
+            log.info('Kept %d callback events to send after the next start', parked)
+
+    def watch(self, pairs):
+        # called by the handlers for messages given a callback_url
+        self.writer.call('watch', pairs)
+        self.urls.update(pairs)
+
+    def update(self, table, data):
+        # listener for rows committed by SMSDatabase, called from its thread
+        if table != 'sms':
+            return
+        if data.get('callback_url') and data['id'] not in self.urls:
+            # given to a web worker process, its watch may still be on the way
+            self.urls[data['id']] = data['callback_url']
+        if data.get('request_status') not in NOTIFY_STATUSES:
+            return
+        url = self.urls.get(data['id'])
+        if url is None:
+            return
+        with self.lock:
+            self.pending.append((url, {
+                "reference": "{}".format(data['id']),
+                "status": "{}".format(data['request_status']),
+                "time": time.time(),
+            }))
+            if len(self.pending) > 1:
+                return # a flush is scheduled already
+        # wait a little so that events close together go in one request
+        self.ioloop.add_callback(self.ioloop.call_later, self.batch_wait, self.flush)
+
+    def take_pending(self):
+        # queue the updates from the database thread by url
+        with self.lock:
+            pending, self.pending = self.pending, []
+        final = []
+        for url, event in pending:
+            self.queues.setdefault(url, []).append(event)
+            if int(event['status']) in sgmodem.FINAL_STATUSES:
+                final.append(int(event['reference']))
+        for requestID in final:
+            self.urls.pop(requestID, None)
+        if final:
+            self.writer.call('forget', final)
+
+    def flush(self):
+        self.take_pending()
+        for url, events in self.queues.items():
+            if len(events) > self.max_queued:
+                # the url is slow, park what it cannot keep up with in the retry store
+                spill, self.queues[url] = events[:-self.max_queued], events[-self.max_queued:]
+                for i in range(0, len(spill), self.batch_size):
+                    self.writer.call('add_retry', url, spill[i:i+self.batch_size], 0, time.time())
+            if url not in self.sending:
+                self.send_next(url)
+
+    def send_next(self, url):
+        events = self.queues.get(url)
+        if not events:
+            self.queues.pop(url, None)
+            return
+        batch, self.queues[url] = events[:self.batch_size], events[self.batch_size:]
+        self.sending.add(url)
+        self.ioloop.add_future(self.post(url, batch), lambda future: self.sent(url, batch, future))
+
+    def sent(self, url, events, future):
+        self.sending.discard(url)
+        if not future.result():
+            self.schedule_retry(url, events, 1)
+        self.send_next(url)
+
+    @gen.coroutine
+    def post(self, url, events):
+        request = HTTPRequest(url, method='POST', body=json.dumps({"events": events}),
+                              headers={'Content-Type': 'application/json'},
+                              connect_timeout=self.timeout, request_timeout=self.timeout)
+        try:
+            yield AsyncHTTPClient().fetch(request)
+        except Exception as e:
+            log.warn('Callback to %s with %d events failed %s', url, len(events), e.args)
+            self.stats['failed'] += 1
+            raise gen.Return(False)
+        self.stats['sent'] += 1
+        raise gen.Return(True)
+
+    def backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        # spread out the retries of callbacks that failed together
+        return delay * random.uniform(0.8, 1.2)
+
+    def schedule_retry(self, url, events, attempts):
+        if attempts >= self.max_attempts:
+            log.error('Giving up on callback to %s with %d events after %d attempts', url, len(events), attempts)
+            self.stats['dropped'] += 1
+            return
+        self.writer.call('add_retry', url, events, attempts, time.time() + self.backoff(attempts))
+
+    @gen.coroutine
+    def retry_loop(self):
+        while True:
+            for seq, url, events, attempts in self.store.due(time.time(), self.batch_size):
+                ok = yield self.post(url, events)
+                # committed before the next look for due retries, which would send it again
+                if ok:
+                    yield self.writer.call('remove_retry', seq)
+                elif attempts + 1 >= self.max_attempts:
+                    yield self.writer.call('remove_retry', seq)
+                    self.schedule_retry(url, events, attempts + 1)
+                else:
+                    yield self.writer.call('update_retry', seq, attempts + 1, time.time() + self.backoff(attempts + 1))
+            yield gen.sleep(1)
+
+    def status(self):
+        return dict(watched=len(self.urls), retries=self.store.retries(), **self.stats)
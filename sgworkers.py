@@ -0,0 +1,186 @@
+import multiprocessing, logging, hashlib, time, ctypes, Queue
+from threading import Thread, Event, Lock
+
+log = logging.getLogger('sgworkers.WorkerPool')
+
+class RequestIDs(object):
+    '''Allocator of request IDs shared by every web process.  The last ID
+    handed out lives in shared memory behind a lock, so processes serving
+    requests at the same time never hand out the same one.'''
+
+    def __init__(self, last=0):
+        self.value = multiprocessing.Value('l', last)
+
+    def allocate(self, count=1):
+        # the first of count consecutive IDs
+        with self.value.get_lock():
+            first = self.value.value + 1
+            self.value.value += count
+        return first
+
+    @property
+    def last(self):
+        return self.value.value
+
+class SharedRecentKeys(object):
+    '''Keys added in the last ttl secs with a (requestID, segments) value,
+    shared by every web process like RequestIDs.  Entries live in a hash
+    table in shared memory, each key in one of PROBES slots from where its
+    hash points.  With those all in use the oldest is replaced, so an entry
+    can be dropped before its ttl.  An idempotency key is then still found
+    through the index.
+
+    Several of them can share a lock, which a caller holds around a check
+    and the add that follows so no other process gets in between.'''
+
+    PROBES = 16
+
+    def __init__(self, ttl, max_entries=100000, lock=None):
+        self.ttl = ttl # set in each process, the entries only keep the time added
+        self.lock = lock or multiprocessing.RLock()
+        size = 1
+        while size < 2 * max_entries:
+            size *= 2
+        self.mask = size - 1
+        # 0 marks a slot never used
+        self.hashes = multiprocessing.RawArray(ctypes.c_longlong, size)
+        self.ids = multiprocessing.RawArray('l', size)
+        self.segments = multiprocessing.RawArray('l', size)
+        self.added = multiprocessing.RawArray('d', size)
+
+    def slots(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h = int(hashlib.sha1(key).hexdigest()[:16], 16) & 0x7fffffffffffffff or 1
+        return h, [(h + i) & self.mask for i in range(self.PROBES)]
+
+    def get(self, key):
+        h, slots = self.slots(key)
+        expired = time.time() - self.ttl
+        with self.lock:
+            for slot in slots:
+                if self.hashes[slot] == h and self.added[slot] > expired:
+                    return (self.ids[slot], self.segments[slot])
+        return None
+
+    def add(self, key, value):
+        h, slots = self.slots(key)
+        now = time.time()
+        with self.lock:
+            # the slot of the key, else a free or expired one, else the oldest
+            slot = ([slot for slot in slots if self.hashes[slot] == h] or
+                    [slot for slot in slots if self.added[slot] <= now - self.ttl] or
+                    [min(slots, key=self.added.__getitem__)])[0]
+            self.hashes[slot] = h
+            self.ids[slot], self.segments[slot] = value
+            self.added[slot] = now
+
+class WatchForwarder(object):
+    '''Stands in for the WebhookDispatcher in a web worker, handing the
+    callback_url of new messages to the dispatcher in the main process.'''
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def watch(self, pairs):
+        self.queue.put(list(pairs))
+
+def follow(updates, listeners, stopped):
+    # runs in a web worker, giving the rows the main process committed
+    # to the listeners of the worker
+    while not stopped.is_set():
+        try:
+            rows = updates.get(timeout=1)
+        except Queue.Empty:
+            continue
+        for table, data in rows:
+            for listener in listeners:
+                try:
+                    listener(table, data)
+                except Exception as e:
+                    log.error('Listener failed %s', e.args, exc_info=True)
+
+class WorkerPool(object):
+    '''Forks count web worker processes which accept on the same listen
+    sockets, so the kernel spreads the connections between them.
+
+    Messages from every worker go into the same database and modem queues.
+    The sms rows the database commits are copied to every worker, which
+    keeps its status cache and status stream current with them, and so are
+    the settings saved, which the worker applies as well.  Status updates
+    are numbered here, so every worker gives one the same event id, also a
+    worker forked after it.  The
+    callback_urls the workers are given come back to the one webhook
+    dispatcher of the main process.'''
+
+    def __init__(self, count, logLevel=logging.WARNING):
+        self.count = count
+        self.updates = [multiprocessing.Queue() for i in range(count)]
+        self.watches = multiprocessing.Queue()
+        self.processes = []
+        self.pending = [] # rows committed and not yet sent to the workers
+        self.seq = 0 # status updates numbered, the last event id of the status streams
+        self.lock = Lock()
+        self.ready = Event()
+        self.stopped = Event()
+        log.setLevel(logLevel)
+
+    def start(self, target, args=()):
+        # target(index, updates, watches, *args) runs in each worker
+        self.stopped.clear()
+        for i in range(self.count):
+            process = multiprocessing.Process(target=target, args=(i, self.updates[i], self.watches) + tuple(args),
+                                              name='WebWorker-{}'.format(i))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        thread = Thread(target=self.feed_loop, name='WorkerFeedThread')
+        thread.daemon = True
+        thread.start()
+
+    def update(self, table, data):
+        # listener for rows committed by SMSDatabase
+        if table not in ('sms', 'settings'):
+            return
+        with self.lock:
+            if table == 'sms' and 'request_status' in data:
+                self.seq += 1
+                data = dict(data, seq=self.seq)
+            self.pending.append((table, data))
+        self.ready.set()
+
+    def feed_loop(self):
+        # one message per worker for all the rows committed since the last
+        while not self.stopped.is_set():
+            if not self.ready.wait(1):
+                continue
+            with self.lock:
+                self.ready.clear()
+                rows, self.pending = self.pending, []
+            for updates in self.updates:
+                updates.put(rows)
+
+    def watch_loop(self, watch):
+        # hands the callback_urls from the workers to watch(pairs)
+        while not self.stopped.is_set():
+            try:
+                pairs = self.watches.get(timeout=1)
+            except Queue.Empty:
+                continue
+            watch(pairs)
+
+    def start_watching(self, watch):
+        thread = Thread(target=self.watch_loop, args=(watch,), name='WorkerWatchThread')
+        thread.daemon = True
+        thread.start()
+
+    def pids(self):
+        return [process.pid for process in self.processes]
+
+    def stop(self, timeout=10):
+        self.stopped.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                log.warn('Web worker %s did not stop, terminating it', process.name)
+                process.terminate()
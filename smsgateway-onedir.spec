@@ -9,7 +9,7 @@ a = Analysis(['smsgateway.py'],
              pathex=['C:\\Users\\cheese\\workspace\\smsgateway'],
              binaries=[],
              datas=[('assets', 'assets')],
-             hiddenimports=[],
+             hiddenimports=['tornado.curl_httpclient'],
              hookspath=[],
              runtime_hooks=[],
              excludes=['FixTk', 'tcl', 'tk', '_tkinter', 'tkinter', 'Tkinter'],
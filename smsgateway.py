@@ -11,7 +11,6 @@ For now, the demo at the bottom shows how to use it...'''
          
 import os
 import sys
-import time
 import multiprocessing
 import logging
 import win32api
@@ -345,38 +344,45 @@ def toggle_server(sysTrayIcon):
         server_running = False
         sysTrayIcon.icon = get_icon('mobile-phone-off')
         sysTrayIcon.refresh_icon()
-        sysTrayIcon.log.debug('Waiting 10 secs for web and modem server to shutdown')
-        time.sleep(10) # wait 10 secs
+        sysTrayIcon.log.debug('Waiting for web and modem server to shutdown')
+        sgserver.wait_stopped()
 
 def server_port(sysTrayIcon):
-    current_val = sg_settings.get('web_port')
+    current_val = sg_settings.raw('web_port')
     new_val = dialog.GetSimpleInput('Port', current_val, 'Web API Server Port')
     if new_val is not None: 
-        sg_settings.save('web_port', new_val)
+        save_setting(sysTrayIcon, 'web_port', new_val)
 
 def modem_port(sysTrayIcon):
-    current_val = sg_settings.get('com_port')
+    current_val = sg_settings.raw('com_port')
     new_val = dialog.GetSimpleInput('Port, i.e. COM3', current_val, 'GSM Modem Port')
     if new_val is not None: 
-        sg_settings.save('com_port', new_val)
+        save_setting(sysTrayIcon, 'com_port', new_val)
 
 def min_send_interval(sysTrayIcon):
-    current_val = sg_settings.get('min_send_interval')
+    current_val = sg_settings.raw('min_send_interval')
     new_val = dialog.GetSimpleInput('Min time between SMS in secs', current_val, 'SMS Send Rate Limiting')
     if new_val is not None: 
-        sg_settings.save('min_send_interval', new_val)
+        save_setting(sysTrayIcon, 'min_send_interval', new_val)
 
 def set_key(sysTrayIcon):
-    current_val = sg_settings.get('key')
+    current_val = sg_settings.raw('key')
     new_val = dialog.GetSimpleInput('Key', current_val, 'Secret Key')
     if new_val is not None: 
-        sg_settings.save('key', new_val)
+        save_setting(sysTrayIcon, 'key', new_val)
 
 def autostart(sysTrayIcon, is_checked):
-    sg_settings.save('autostart', is_checked)
+    save_setting(sysTrayIcon, 'autostart', int(is_checked))
 
 def keyprotection(sysTrayIcon, is_checked):
-    sg_settings.save('keyprotection', is_checked)
+    save_setting(sysTrayIcon, 'keyprotection', int(is_checked))
+
+def save_setting(sysTrayIcon, key, value):
+    # a running server applies the change without a restart, see sgserver.apply_setting
+    try:
+        sg_settings.save(key, value)
+    except ValueError as e:
+        sysTrayIcon.log.warn('Invalid value %s for %s %s', value, key, e.args)
 
 # Module multiprocessing is organized differently in Python 3.4+
 # try:
@@ -424,6 +430,7 @@ if __name__ == '__main__':
         global server_running, db_server
         if (server_running):
             sgserver.signal_exit()
+            sgserver.wait_stopped()
         db_server.stop_thread()
         print 'Bye, then.'
     
@@ -436,11 +443,11 @@ if __name__ == '__main__':
                     ('Set Modem Port', get_icon('plug-connect'), modem_port, None),
                     ('Set Send Interval', get_icon('time-remain'), min_send_interval, None),
                     ('Set Secret Key', get_icon('key'), set_key, None),
-                    ('Require Secret Key', get_icon('lock'), keyprotection, int(sg_settings.get('keyprotection'))),
-                    ('Autostart', get_icon('lightning-arrow'), autostart, int(sg_settings.get('autostart'))),
+                    ('Require Secret Key', get_icon('lock'), keyprotection, sg_settings.get('keyprotection')),
+                    ('Autostart', get_icon('lightning-arrow'), autostart, sg_settings.get('autostart')),
                     )
 
-    if int(sg_settings.get('autostart')):
+    if sg_settings.get('autostart'):
         sgserver.start_server(sg_settings, db_server)
         server_running = True
         runningicon = get_icon('mobile_phone')
@@ -449,6 +456,4 @@ if __name__ == '__main__':
 
     SysTrayIcon(runningicon, hover_text, menu_options, on_quit=bye, default_menu_index=1)
 
-    if server_running:
-        logging.getLogger('smsgateway').debug('Waiting 10 secs for everything to shutdown')
-        time.sleep(10) # wait 10 secs
+    db_server.thread.join()
@@ -0,0 +1,26 @@
+import os, sys, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sgmodem
+
+class InflightTrackerTest(unittest.TestCase):
+
+    def test_matched_records_do_not_pile_up_behind_an_unmatched_one(self):
+        tracker = sgmodem.InflightTracker(max_entries=1000)
+        tracker.add(1, '+15550100', 0) # its report never arrives
+        for i in range(1, 200001):
+            tracker.add(i % 256, '+15550101', i)
+            self.assertEqual(tracker.match(i % 256, '+15550101'), i)
+        self.assertEqual(len(tracker), 1)
+        self.assertLessEqual(len(tracker.by_age), 2 * tracker.max_entries)
+        self.assertEqual(tracker.match(1, '+15550100'), 0)
+
+    def test_oldest_dropped_beyond_max_entries(self):
+        tracker = sgmodem.InflightTracker(max_entries=10)
+        for i in range(20):
+            tracker.add(i, '+15550100', i)
+        self.assertEqual(len(tracker), 10)
+        self.assertIsNone(tracker.match(0, '+15550100'))
+        self.assertEqual(tracker.match(19, '+15550100'), 19)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os, sys, shutil, tempfile, threading, unittest
+from tornado import gen
+from tornado.ioloop import IOLoop
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sgdatabase
+
+class SMSReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        database = sgdatabase.SMSDatabase(url='sqlite:///' + os.path.join(self.tmpdir, 'database.db'))
+        database.connect()
+        database.db.close()
+        self.ioloop = IOLoop()
+        self.reader = sgdatabase.SMSReader(database.path, self.ioloop, size=1)
+        self.reader.start()
+
+    def tearDown(self):
+        self.ioloop.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_queries_waiting_fail_on_stop(self):
+        started, release = threading.Event(), threading.Event()
+        def slow(db):
+            started.set()
+            release.wait(5)
+            return 'done'
+
+        @gen.coroutine
+        def run():
+            running = self.reader.run(slow)
+            waiting = [self.reader.get_one(dict(id=i), 'sms') for i in range(3)]
+            started.wait(5)
+            stopper = threading.Thread(target=self.reader.stop)
+            stopper.start()
+            # the slow query finishes once the others are failed
+            while list(self.reader.queue.queue) != [None]:
+                yield gen.sleep(0.01)
+            release.set()
+            stopper.join()
+            result = yield running
+            errors = []
+            for future in waiting + [self.reader.get_one(dict(id=1), 'sms')]:
+                try:
+                    yield future
+                except Exception as e:
+                    errors.append(e)
+            raise gen.Return((result, errors))
+
+        result, errors = self.ioloop.run_sync(run, timeout=10)
+        self.assertEqual(result, 'done')
+        self.assertEqual(len(errors), 4)
+
+if __name__ == '__main__':
+    unittest.main()
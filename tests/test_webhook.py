@@ -0,0 +1,114 @@
+import os, sys, json, time, shutil, tempfile, unittest
+from tornado import gen, web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sgmodem
+import sgwebhook
+
+class CallbackHandler(web.RequestHandler):
+    def initialize(self, received, failures):
+        self.received = received
+        self.failures = failures
+
+    def post(self):
+        if self.failures:
+            self.failures.pop()
+            raise web.HTTPError(500)
+        self.received.append(json.loads(self.request.body)['events'])
+
+class WebhookDispatcherTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.received = [] # events of each callback request answered
+        self.failures = [] # the next requests answered with a 500
+        return web.Application([(r'/callback', CallbackHandler, dict(received=self.received, failures=self.failures))])
+
+    def setUp(self):
+        super(WebhookDispatcherTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = self.get_url('/callback')
+        self.dispatcher = self.make_dispatcher()
+
+    def tearDown(self):
+        self.dispatcher.writer.stop()
+        shutil.rmtree(self.tmpdir)
+        super(WebhookDispatcherTest, self).tearDown()
+
+    def make_dispatcher(self, **options):
+        dispatcher = sgwebhook.WebhookDispatcher(self.io_loop, sgwebhook.WebhookStore(os.path.join(self.tmpdir, 'webhooks.db')),
+            batch_wait=0.05, **options)
+        dispatcher.start()
+        return dispatcher
+
+    def report(self, requestID, status):
+        # a row committed by the database thread
+        self.dispatcher.update('sms', dict(id=requestID, request_status=status))
+
+    @gen.coroutine
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            yield gen.sleep(0.05)
+
+    @gen_test
+    def test_events_batched_per_url(self):
+        self.dispatcher.batch_size = 10
+        self.dispatcher.watch([(i, self.url) for i in range(1, 26)])
+        for i in range(1, 26):
+            self.report(i, sgmodem.ENROUTE)
+        yield self.wait_for(lambda: sum(len(events) for events in self.received) == 25)
+        self.assertEqual([len(events) for events in self.received], [10, 10, 5])
+        self.assertEqual(self.dispatcher.stats['sent'], 3)
+
+    @gen_test
+    def test_final_status_forgets_the_url(self):
+        self.dispatcher.watch([(1, self.url)])
+        self.report(1, sgmodem.DELIVERED)
+        self.report(1, sgmodem.DELIVERED)
+        yield self.wait_for(lambda: self.received)
+        yield gen.sleep(0.2)
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.dispatcher.store.watches(), {})
+
+    @gen_test
+    def test_failed_callback_retried(self):
+        self.dispatcher.base_delay = 0.01
+        self.failures.append(True)
+        self.dispatcher.watch([(1, self.url)])
+        self.report(1, sgmodem.ENROUTE)
+        yield self.wait_for(lambda: self.received, timeout=10)
+        self.assertEqual(self.dispatcher.stats['failed'], 1)
+        self.assertEqual([[event['reference'] for event in events] for events in self.received], [['1']])
+        yield self.wait_for(lambda: self.dispatcher.store.retries() == 0)
+        self.assertEqual(self.dispatcher.store.retries(), 0)
+
+    @gen_test
+    def test_kept_for_the_next_start(self):
+        self.dispatcher.watch([(1, self.url)])
+        self.dispatcher.watch([(2, self.url)])
+        self.dispatcher.queues[self.url] = [dict(reference='1', status='1', time=0)]
+        self.dispatcher.stop()
+        # a new store reads what the writer committed
+        store = sgwebhook.WebhookStore(os.path.join(self.tmpdir, 'webhooks.db'))
+        self.assertEqual(store.watches(), {1: self.url, 2: self.url})
+        self.assertEqual(store.retries(), 1)
+
+    def test_backoff(self):
+        dispatcher = self.dispatcher
+        dispatcher.base_delay, dispatcher.max_delay = 5, 60
+        for attempts, delay in ((1, 5), (2, 10), (3, 20), (4, 40), (5, 60), (9, 60)):
+            for i in range(20):
+                self.assertTrue(delay * 0.8 <= dispatcher.backoff(attempts) <= delay * 1.2)
+
+    def test_gives_up_after_max_attempts(self):
+        self.dispatcher.max_attempts = 3
+        self.dispatcher.schedule_retry(self.url, [dict(reference='1')], 3)
+        self.dispatcher.writer.sync()
+        self.assertEqual(self.dispatcher.stats['dropped'], 1)
+        self.assertEqual(self.dispatcher.store.retries(), 0)
+        self.dispatcher.schedule_retry(self.url, [dict(reference='1')], 2)
+        self.dispatcher.writer.sync()
+        self.assertEqual(self.dispatcher.store.retries(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
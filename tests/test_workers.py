@@ -0,0 +1,124 @@
+import os, sys, time, json, socket, signal, shutil, subprocess, tempfile, unittest, urllib2, multiprocessing
+from multiprocessing.pool import ThreadPool
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+from tornado.ioloop import IOLoop
+import sgworkers
+import sgstream
+
+def claim(recent, request_ids, key, results):
+    # what SendSMSHandler does with the keys of a request
+    with recent.lock:
+        original = recent.get(key)
+        if original is None:
+            original = (request_ids.allocate(), 1)
+            recent.add(key, original)
+    results.put(original[0])
+
+class SharedRecentKeysTest(unittest.TestCase):
+
+    def test_one_request_claims_a_key_across_processes(self):
+        recent = sgworkers.SharedRecentKeys(60)
+        request_ids = sgworkers.RequestIDs()
+        results = multiprocessing.Queue()
+        for attempt in range(20):
+            workers = [multiprocessing.Process(target=claim, args=(recent, request_ids, 'key-{}'.format(attempt), results))
+                       for i in range(2)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            first, second = results.get(), results.get()
+            self.assertEqual(first, second)
+        self.assertEqual(request_ids.last, 20)
+
+    def test_expired_and_replaced(self):
+        recent = sgworkers.SharedRecentKeys(60, max_entries=8)
+        recent.add(u'k\xe9y', (1, 2))
+        self.assertEqual(recent.get(u'k\xe9y'), (1, 2))
+        recent.ttl = 0
+        self.assertIsNone(recent.get(u'k\xe9y'))
+        # many more keys than slots, the latest are still found
+        recent.ttl = 60
+        for i in range(1000):
+            recent.add(str(i), (i, 1))
+        self.assertEqual(recent.get('999'), (999, 1))
+
+class StatusNumbersTest(unittest.TestCase):
+
+    def publish(self, stream, rows):
+        for table, data in rows:
+            stream.update(table, data)
+        stream.publish()
+
+    def test_same_event_ids_in_every_worker(self):
+        pool = sgworkers.WorkerPool(2)
+        for i in range(1, 6):
+            pool.update('sms', dict(id=i, request_status=0))
+        pool.update('sms', dict(id=1, message='no status'))
+        early = sgstream.StatusStream(IOLoop())
+        self.publish(early, pool.pending)
+        # forked once the first updates were numbered and fed
+        pool.pending, seq = [], pool.seq
+        for i in range(6, 9):
+            pool.update('sms', dict(id=i, request_status=1))
+        late = sgstream.StatusStream(IOLoop(), seq=seq)
+        for stream in (early, late):
+            self.publish(stream, pool.pending)
+        for stream in (early, late):
+            events = stream.read(stream.subscribe(since=6))
+            self.assertEqual([(event[0], event[1]) for event in events], [(7, 7), (8, 8)])
+
+class TwoWorkersTest(unittest.TestCase):
+    '''A server with two web workers answering the same request.'''
+
+    port = 8931
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, 'key'), 'w') as f:
+            f.write('secret')
+        self.server = subprocess.Popen([sys.executable, os.path.join(root, 'sgserver.py'), '-p', str(self.port),
+            '-c', os.path.join(self.tmpdir, 'nomodem'), '-d', os.path.join(self.tmpdir, 'database.db'),
+            '-l', self.tmpdir, '-k', os.path.join(self.tmpdir, 'key'), '-w', '2'], cwd=self.tmpdir)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('localhost', self.port)).close()
+                break
+            except socket.error:
+                time.sleep(0.1)
+        else:
+            self.fail('Server did not start')
+
+    def tearDown(self):
+        self.server.send_signal(signal.SIGINT)
+        self.server.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def post(self, path, body):
+        request = urllib2.Request('http://localhost:{}{}'.format(self.port, path), json.dumps(body),
+                                  {'Content-Type': 'application/json'})
+        return json.loads(urllib2.urlopen(request).read())['data']
+
+    def send(self, body):
+        # on a new connection each, so the kernel hands them to either worker
+        return int(self.post('/v1/sendsms', dict(key='', number='+15550100', **body))['reference'])
+
+    def test_duplicate_idempotency_key(self):
+        pool = ThreadPool(8)
+        references = pool.map(self.send, [dict(message='Hello', idempotency_key='kk')] * 40)
+        pool.close()
+        self.assertEqual(len(set(references)), 1)
+        self.assertNotEqual(self.send(dict(message='Hello', idempotency_key='other')), references[0])
+
+    def test_duplicate_message_in_dedup_window(self):
+        self.post('/v1/settings', dict(key='secret', settings=dict(dedup_window='60')))
+        time.sleep(1) # until both workers applied it
+        pool = ThreadPool(8)
+        references = pool.map(self.send, [dict(message='Same message')] * 40)
+        pool.close()
+        self.assertEqual(len(set(references)), 1)
+
+if __name__ == '__main__':
+    unittest.main()